@@ -0,0 +1,219 @@
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Callable
+import google.generativeai as genai
+from alert_detector import normalize_text
+from instrumentation import AI_REQUEST_SECONDS, AI_CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-1.5-flash")
+# Endpoint alternativo da API (ex.: "http://127.0.0.1:9102", o stub dos benchmarks); usa o transporte REST
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")
+AI_TIMEOUT_SECONDS = float(os.getenv("AI_TIMEOUT_SECONDS", "20"))
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "8"))
+AI_CACHE_SIZE = int(os.getenv("AI_CACHE_SIZE", "2048"))
+AI_CACHE_TTL_SECONDS = float(os.getenv("AI_CACHE_TTL_SECONDS", str(24 * 3600)))
+
+AUTO_REPLY_SYSTEM_PROMPT = ("Você é um assistente de saúde. Analise a mensagem de um paciente. Sua tarefa é decidir se uma resposta automática de apoio é apropriada. Responda APENAS com um objeto JSON. Se a mensagem for uma simples atualização, um agradecimento ou uma afirmação positiva, retorne: {\"responder\": true, \"texto_resposta\": \"[uma frase curta de apoio]\"}. Exemplos de frases: 'Obrigado por compartilhar!', 'Entendido, continue assim!', 'Registro feito!'. Se a mensagem for uma pergunta, um pedido de ajuda, uma queixa (mesmo que sutil), ou qualquer coisa que exija atenção humana, retorne: {\"responder\": false}")
+
+if GOOGLE_API_KEY and GEMINI_API_ENDPOINT:
+    genai.configure(api_key=GOOGLE_API_KEY, transport="rest", client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+elif GOOGLE_API_KEY:
+    genai.configure(api_key=GOOGLE_API_KEY)
+else:
+    logger.warning("Chave da API do Google não encontrada. A funcionalidade de IA estará desativada.")
+
+# A interrogação fica na chave: perguntas não recebem resposta automática
+_PUNCTUATION = re.compile(r"[^\w\s?]")
+_QUESTION_MARKS = re.compile(r"\?+")
+_JSON_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+
+def auto_reply_cache_key(message_text: str) -> str:
+    # "Tomei o remédio!" e "tomei o remedio" têm a mesma decisão; "Tudo bem?" e "tudo bem", não.
+    # O prompt só contém o texto: a decisão vale para qualquer paciente que mande a mesma mensagem
+    text = _QUESTION_MARKS.sub(" ? ", _PUNCTUATION.sub(" ", normalize_text(message_text)))
+    return " ".join(text.split())
+
+
+class TTLCache:
+    """
+    Cache LRU limitado em que cada item expira após `ttl` segundos.
+    """
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: str):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key: str, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _CallStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def to_dict(self):
+        return {"calls": self.calls, "errors": self.errors, "timeouts": self.timeouts,
+                "avg_seconds": self.total_seconds / self.calls if self.calls else None, "max_seconds": self.max_seconds}
+
+
+class StubModel:
+    """
+    Modelo local para testes e benchmarks: responde sem rede, com latência configurável.
+    """
+    def __init__(self, latency: float = 0.0, reply: str = "Obrigado por compartilhar!"):
+        self.latency = latency
+        self.reply = reply
+        self.calls = 0
+
+    class _Response:
+        def __init__(self, text: str):
+            self.text = text
+
+    async def generate_content_async(self, prompt: str):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if prompt.startswith(AUTO_REPLY_SYSTEM_PROMPT):
+            return self._Response(json.dumps({"responder": True, "texto_resposta": self.reply}, ensure_ascii=False))
+        return self._Response("- Resumo gerado pelo modelo local.")
+
+
+class AIGateway:
+    """
+    Ponto único de acesso ao Gemini: uma instância do modelo reutilizada, chamadas assíncronas
+    com timeout, limite de chamadas simultâneas e cache das decisões de resposta automática.
+    """
+    def __init__(self, model_factory: Callable[[], Any] | None = None, timeout: float = AI_TIMEOUT_SECONDS,
+                 max_concurrency: int = AI_MAX_CONCURRENCY, cache_size: int = AI_CACHE_SIZE,
+                 cache_ttl: float = AI_CACHE_TTL_SECONDS):
+        self.enabled = model_factory is not None or bool(GOOGLE_API_KEY)
+        self._model_factory = model_factory or (lambda: genai.GenerativeModel(GEMINI_MODEL_NAME))
+        self._model = None
+        # O transporte REST do SDK não tem chamada assíncrona utilizável: nesse caso a chamada vai para uma thread
+        self._async_calls = model_factory is not None or not GEMINI_API_ENDPOINT
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._stats: dict[str, _CallStats] = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = self._model_factory()
+        return self._model
+
+    async def _call_model(self, prompt: str) -> str:
+        model = self.model
+        if self._async_calls and hasattr(model, "generate_content_async"):
+            response = await model.generate_content_async(prompt)
+        else:
+            response = await asyncio.to_thread(model.generate_content, prompt)
+        return response.text
+
+    async def generate(self, prompt: str, kind: str = "generate") -> str:
+        """
+        Gera texto com o modelo. Lança asyncio.TimeoutError se passar de `timeout` segundos.
+        """
+        stats = self._stats.setdefault(kind, _CallStats())
+        async with self._semaphore:
+            started = time.perf_counter()
+            outcome = "ok"
+            try:
+                return await asyncio.wait_for(self._call_model(prompt), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                stats.timeouts += 1
+                outcome = "timeout"
+                raise
+            except Exception:
+                stats.errors += 1
+                outcome = "error"
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                AI_REQUEST_SECONDS.labels(kind, outcome).observe(elapsed)
+                stats.calls += 1
+                stats.total_seconds += elapsed
+                stats.max_seconds = max(stats.max_seconds, elapsed)
+
+    async def decide_auto_reply(self, message_text: str) -> dict:
+        """
+        Decide se a mensagem recebe resposta automática ({"responder": bool, "texto_resposta": str}).
+        Mensagens equivalentes após normalização reaproveitam a decisão em cache, e pedidos
+        simultâneos para a mesma mensagem compartilham uma única chamada ao modelo.
+        """
+        key = auto_reply_cache_key(message_text)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.cache_hits += 1
+            AI_CACHE_LOOKUPS.labels("hit").inc()
+            return cached
+        if key in self._inflight:
+            self.cache_hits += 1
+            AI_CACHE_LOOKUPS.labels("hit").inc()
+            return await asyncio.shield(self._inflight[key])
+        self.cache_misses += 1
+        AI_CACHE_LOOKUPS.labels("miss").inc()
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            user_prompt = f"Analise esta mensagem do paciente: \"{message_text}\""
+            text = await self.generate(f"{AUTO_REPLY_SYSTEM_PROMPT}\n\n{user_prompt}", kind="auto_reply")
+            decision = json.loads(_JSON_FENCE.sub("", text.strip()))
+            self.cache.put(key, decision)
+            future.set_result(decision)
+            return decision
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Evita o aviso de exceção nunca lida quando ninguém mais aguardava
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    def stats(self):
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "enabled": self.enabled,
+            "model": GEMINI_MODEL_NAME,
+            "cache": {"size": len(self.cache), "hits": self.cache_hits, "misses": self.cache_misses,
+                      "hit_rate": self.cache_hits / lookups if lookups else None},
+            "calls": {kind: stats.to_dict() for kind, stats in self._stats.items()},
+        }
+
+
+ai_gateway = AIGateway()
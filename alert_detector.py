@@ -0,0 +1,133 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+import unicodedata
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+ALERT_LEXICON_PATH = os.getenv("ALERT_LEXICON_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "alert_lexicon.json"))
+# Intervalo mínimo entre verificações de alteração do arquivo do léxico
+ALERT_LEXICON_CHECK_INTERVAL = float(os.getenv("ALERT_LEXICON_CHECK_INTERVAL", "5"))
+
+# A negação não atravessa o fim de uma frase ou oração
+_CLAUSE_BREAK = re.compile(r"[.,;:!?\n]")
+
+
+def normalize_text(text: str) -> str:
+    """
+    Minúsculas, sem acentos e com espaços simples, para que "Difícil" e "dificil" sejam iguais.
+    Caracteres sem equivalente ASCII (emojis etc.) são descartados, já que nenhum termo os usa.
+    """
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
+    return " ".join(text.casefold().split())
+
+
+@dataclass
+class AlertResult:
+    terms: list[str] = field(default_factory=list)
+    negated: list[str] = field(default_factory=list)
+    score: float = 0.0
+    threshold: float = 1.0
+
+    @property
+    def has_alert(self) -> bool:
+        return self.score >= self.threshold
+
+
+class _CompiledLexicon:
+    def __init__(self, config: dict):
+        self.threshold = float(config.get("threshold", 1))
+        self.negations = {normalize_text(word) for word in config.get("negations", [])}
+        # Verbos aceitos entre a negação e o termo ("não tenho febre", "nunca senti dor")
+        self.negation_verbs = {normalize_text(word) for word in config.get("negation_verbs", [])}
+        self.terms = []
+        alternatives = []
+        first_chars = set()
+        for index, entry in enumerate(config["terms"]):
+            normalized = normalize_text(entry["term"])
+            self.terms.append((entry["term"], float(entry.get("severity", 1)), entry.get("negatable", True)))
+            # "*" no fim do termo aceita qualquer terminação ("ansios*" -> ansioso, ansiosa, ...)
+            prefix, wildcard = (normalized[:-1], r"\w*") if normalized.endswith("*") else (normalized, "")
+            pattern = r"\s+".join(re.escape(word) for word in prefix.split()) + wildcard
+            first_chars.add(prefix[0])
+            alternatives.append(f"(?P<t{index}>{pattern})")
+        # Uma única expressão com limites de palavra: "dor" não casa com "cuidador" nem "adorei"
+        # O lookahead pela primeira letra descarta rápido as posições que não iniciam nenhum termo.
+        lookahead = "(?=[" + "".join(re.escape(ch) for ch in sorted(first_chars)) + "])"
+        self.pattern = re.compile(r"\b" + lookahead + "(?:" + "|".join(alternatives) + r")\b") if alternatives else None
+
+    def _is_negated(self, normalized: str, start: int) -> bool:
+        # Só a negação logo antes do termo ("sem febre") ou separada dele por um dos verbos da
+        # lista ("não tenho febre"). Na dúvida o alerta fica: "não aguento a dor" é alerta.
+        preceding = _CLAUSE_BREAK.split(normalized[:start])[-1].split()
+        if preceding and preceding[-1] in self.negations:
+            return True
+        return len(preceding) >= 2 and preceding[-1] in self.negation_verbs and preceding[-2] in self.negations
+
+    def detect(self, text: str) -> AlertResult:
+        result = AlertResult(threshold=self.threshold)
+        if self.pattern is None:
+            return result
+        normalized = normalize_text(text)
+        for match in self.pattern.finditer(normalized):
+            term, severity, negatable = self.terms[int(match.lastgroup[1:])]
+            if negatable and self._is_negated(normalized, match.start()):
+                if term not in result.negated:
+                    result.negated.append(term)
+                continue
+            if term not in result.terms:
+                result.terms.append(term)
+                result.score += severity
+        return result
+
+
+class AlertDetector:
+    """
+    Detector de alertas compilado a partir de um léxico em JSON (termo, gravidade e se aceita
+    negação). O arquivo é relido automaticamente quando muda, sem reiniciar o servidor.
+    """
+    def __init__(self, path: str = ALERT_LEXICON_PATH, check_interval: float = ALERT_LEXICON_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lexicon = self._load()
+
+    def _load(self) -> _CompiledLexicon:
+        self._mtime = os.path.getmtime(self.path)
+        with open(self.path, encoding="utf-8") as f:
+            return _CompiledLexicon(json.load(f))
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+            try:
+                if os.path.getmtime(self.path) != self._mtime:
+                    self._lexicon = self._load()
+                    logger.info("Léxico de alertas recarregado de %s.", self.path)
+            except (OSError, ValueError, KeyError) as e:
+                # Mantém o léxico anterior se o arquivo novo estiver inválido
+                logger.error("Erro ao recarregar o léxico de alertas: %s", e)
+
+    def detect(self, text: str) -> AlertResult:
+        self._maybe_reload()
+        return self._lexicon.detect(text)
+
+    @property
+    def threshold(self) -> float:
+        self._maybe_reload()
+        return self._lexicon.threshold
+
+
+alert_detector = AlertDetector()
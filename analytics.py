@@ -0,0 +1,161 @@
+"""
+Indicadores de engajamento para o painel do profissional: taxa de resposta aos lembretes,
+frequência de alertas, tempo de resposta do profissional e dias desde o último contato.
+
+Os contadores diários (patient_daily_stats) são mantidos pelo crud a cada mensagem e a cada
+lembrete enviado; o relatório só lê esses contadores. Para reconstruí-los a partir do histórico
+(banco existente ou mudança de ANALYTICS_TIMEZONE / REMINDER_REPLY_WINDOW_HOURS):
+    python analytics.py backfill
+"""
+import time
+import logging
+import argparse
+from collections import defaultdict
+from datetime import datetime, timezone, timedelta
+from sqlalchemy import select
+from database.database import with_session
+from database import crud, models
+from alert_detector import alert_detector
+from instrumentation import configure_logging
+
+# Pacientes reconstruídos por transação: limita a memória e o tempo de cada lote
+BACKFILL_BATCH_SIZE = 200
+
+logger = logging.getLogger(__name__)
+
+
+# ### RELATÓRIO ###
+
+def _as_utc(value: datetime) -> datetime:
+    # O SQLite devolve datas sem fuso; elas são gravadas sempre em UTC
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+def _with_rates(counters: dict) -> dict:
+    sent, replies = counters["reminders_sent"], counters["professional_replies"]
+    counters["reminder_response_rate"] = round(counters["reminders_answered"] / sent, 4) if sent else None
+    counters["avg_professional_response_seconds"] = (round(counters["professional_response_seconds"] / replies, 1)
+                                                     if replies else None)
+    return counters
+
+def _counters(row) -> dict:
+    return {name: getattr(row, name) or 0 for name in crud.DAILY_STATS_COUNTERS}
+
+def engagement_report(db, days: int = 30, patient_id: int | None = None) -> dict:
+    """
+    Indicadores dos últimos `days` dias (incluindo hoje, no fuso ANALYTICS_TIMEZONE): totais,
+    um item por paciente e a série diária. Lembretes de ontem e de hoje ainda podem ser respondidos.
+    """
+    today = crud.analytics_day(datetime.now(timezone.utc))
+    since = today - timedelta(days=days - 1)
+    patients, daily = crud.get_engagement_stats(db, since, today, patient_id=patient_id)
+    totals = dict.fromkeys(crud.DAILY_STATS_COUNTERS, 0)
+    items = []
+    for row in patients:
+        counters = _counters(row)
+        for name, value in counters.items():
+            totals[name] += value
+        last_contact = row.last_patient_message_at
+        items.append({"patient_id": row.id, "name": row.name, "phone_number": row.phone_number,
+                      "last_patient_message_at": _as_utc(last_contact).isoformat() if last_contact else None,
+                      "days_since_last_contact": (today - crud.analytics_day(last_contact)).days if last_contact else None,
+                      "alert_days": row.alert_days or 0, **_with_rates(counters)})
+    return {
+        "since": since.isoformat(),
+        "until": today.isoformat(),
+        "timezone": crud.ANALYTICS_TIMEZONE,
+        "totals": {"patients": len(items), "patients_with_alerts": sum(1 for item in items if item["alert_messages"]),
+                   **_with_rates(totals)},
+        "patients": items,
+        "daily": [{"day": row.day.isoformat(), **_with_rates(_counters(row))} for row in daily],
+    }
+
+
+# ### RECONSTRUÇÃO ###
+
+class EngagementReplay:
+    """
+    Reaplica os eventos do histórico com as mesmas regras de crud.create_message e
+    crud.record_reminder_sent, acumulando os contadores por (paciente, dia) e o estado final
+    de cada paciente.
+    """
+    def __init__(self):
+        self.days: dict = defaultdict(lambda: dict.fromkeys(crud.DAILY_STATS_COUNTERS, 0))
+        self.states: dict[int, dict] = defaultdict(dict)
+
+    def add(self, patient_id: int, at: datetime, kind: str, has_alert: bool):
+        state = self.states[patient_id]
+        counters = self.days[(patient_id, crud.analytics_day(at))]
+        if kind == "reminder":
+            counters["reminders_sent"] += 1
+            state["pending_reminder_at"] = at
+            return
+        if has_alert:
+            counters["alert_messages"] += 1
+        if kind == "patient":
+            counters["patient_messages"] += 1
+            state["last_patient_message_at"] = at
+            reminder_at = state.pop("pending_reminder_at", None)
+            if reminder_at is not None and at - reminder_at <= crud.REMINDER_REPLY_WINDOW:
+                self.days[(patient_id, crud.analytics_day(reminder_at))]["reminders_answered"] += 1
+            state.setdefault("awaiting_reply_since", at)
+        else:
+            counters["professional_messages"] += 1
+            waiting_since = state.pop("awaiting_reply_since", None)
+            if waiting_since is not None:
+                counters["professional_replies"] += 1
+                counters["professional_response_seconds"] += max(0.0, (at - waiting_since).total_seconds())
+
+
+def rebuild_engagement_batch(db, after_id: int, limit: int, alert_threshold: float):
+    """
+    Reconstrói os contadores do próximo lote de pacientes (id > `after_id`) em uma transação.
+    Devolve (último id do lote ou None ao fim da tabela, pacientes do lote, eventos lidos).
+    """
+    patient_ids = db.scalars(select(models.Patient.id).where(models.Patient.id > after_id)
+                             .order_by(models.Patient.id).limit(limit)).all()
+    if not patient_ids:
+        return None, 0, 0
+    replay = EngagementReplay()
+    events = 0
+    for event in crud.iter_engagement_events(db, patient_ids, alert_threshold):
+        replay.add(*event)
+        events += 1
+    crud.replace_engagement_stats(db, patient_ids, replay.days, replay.states)
+    return patient_ids[-1], len(patient_ids), events
+
+def backfill(batch_size: int = BACKFILL_BATCH_SIZE) -> tuple[int, int]:
+    """
+    Reconstrói patient_daily_stats e o estado de engajamento de todos os pacientes a partir das
+    mensagens (em uso e arquivadas) e dos lembretes enviados. Cada lote é uma transação curta, e
+    as mensagens são lidas em blocos: a memória depende do lote, não do tamanho do histórico.
+    Devolve (pacientes, eventos).
+    """
+    started = time.perf_counter()
+    threshold = alert_detector.threshold
+    after_id, patients, events = 0, 0, 0
+    while True:
+        last_id, batch_patients, batch_events = with_session(rebuild_engagement_batch, after_id, batch_size, threshold)
+        if last_id is None:
+            break
+        after_id = last_id
+        patients += batch_patients
+        events += batch_events
+        logger.info("Indicadores reconstruídos até o paciente %s.", last_id, extra={"events": events})
+    logger.info("Indicadores de %s pacientes reconstruídos.", patients,
+                extra={"events": events, "seconds": round(time.perf_counter() - started, 2)})
+    return patients, events
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    rebuild = commands.add_parser("backfill", help="reconstrói os contadores diários a partir do histórico")
+    rebuild.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE, help="pacientes por transação")
+    args = parser.parse_args()
+
+    configure_logging()
+    backfill(args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
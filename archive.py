@@ -0,0 +1,226 @@
+"""
+Armazenamento frio das mensagens: retenção (move as mensagens antigas para messages_archive)
+e exportação em streaming para arquivos compactados (JSONL .gz ou Parquet, se o pyarrow
+estiver instalado).
+
+Uso (a partir da raiz do projeto):
+    python archive.py archive
+    python archive.py export --patient 12
+    python archive.py export --month 2026-03 --format parquet --archive-only
+"""
+import os
+import json
+import gzip
+import time
+import asyncio
+import logging
+import argparse
+from datetime import datetime, timezone, timedelta
+from database.database import SessionLocal, async_engine, run_in_transaction, with_session
+from database import crud
+from instrumentation import configure_logging
+
+# Mensagens mais antigas que isso saem da tabela messages (0 desativa a retenção)
+MESSAGE_RETENTION_DAYS = int(os.getenv("MESSAGE_RETENTION_DAYS", "180"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
+ARCHIVE_INTERVAL_SECONDS = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))
+ARCHIVE_EXPORT_DIR = os.getenv("ARCHIVE_EXPORT_DIR", "exports")
+# Linhas lidas do banco (e gravadas no Parquet) por vez: limita a memória da exportação
+EXPORT_BATCH_SIZE = 5000
+EXPORT_FORMATS = ("jsonl", "parquet")
+
+logger = logging.getLogger(__name__)
+
+
+class MessageArchiver:
+    """
+    Laço em segundo plano que move, em lotes de transações curtas, as mensagens mais antigas
+    que a retenção para messages_archive. Várias instâncias podem rodar juntas: no Postgres
+    cada lote reserva suas linhas com SKIP LOCKED.
+    """
+    def __init__(self, retention_days: int = MESSAGE_RETENTION_DAYS, batch_size: int = ARCHIVE_BATCH_SIZE,
+                 interval: float = ARCHIVE_INTERVAL_SECONDS):
+        self.retention = timedelta(days=retention_days) if retention_days > 0 else None
+        self.batch_size = batch_size
+        self.interval = interval
+        self._task: asyncio.Task | None = None
+        self.archived_count = 0
+        self.last_run_at: datetime | None = None
+        self.last_run_seconds: float | None = None
+        self.last_error: str | None = None
+
+    async def start(self):
+        if self.retention is not None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def run_once(self) -> int:
+        """
+        Arquiva tudo o que passou da retenção e devolve quantas mensagens foram movidas.
+        """
+        if self.retention is None:
+            return 0
+        started = time.perf_counter()
+        cutoff = datetime.now(timezone.utc) - self.retention
+        moved = 0
+        while True:
+            batch = await run_in_transaction(crud.archive_messages, cutoff, self.batch_size)
+            moved += batch
+            self.archived_count += batch
+            if batch < self.batch_size:
+                break
+        self.last_run_at = datetime.now(timezone.utc)
+        self.last_run_seconds = time.perf_counter() - started
+        if moved:
+            logger.info("%s mensagens movidas para o arquivo.", moved, extra={"archived": moved, "cutoff": cutoff.isoformat()})
+        return moved
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.last_error = str(e)
+                logger.exception("Erro ao arquivar mensagens antigas.")
+            await asyncio.sleep(self.interval)
+
+    def stats(self):
+        oldest = with_session(crud.get_oldest_message_at)
+        return {
+            "retention_days": self.retention.days if self.retention is not None else None,
+            "running": self._task is not None and not self._task.done(),
+            "archived": self.archived_count,
+            "oldest_hot_message_at": oldest.isoformat() if oldest else None,
+            "last_run_at": self.last_run_at.isoformat() if self.last_run_at else None,
+            "last_run_seconds": self.last_run_seconds,
+            "last_error": self.last_error,
+        }
+
+
+message_archiver = MessageArchiver()
+
+
+# ### EXPORTAÇÃO ###
+
+def month_range(month: str) -> tuple[datetime, datetime]:
+    """
+    "2026-03" -> (início do mês, início do mês seguinte), em UTC.
+    """
+    try:
+        start = datetime.strptime(month, "%Y-%m").replace(tzinfo=timezone.utc)
+    except ValueError as e:
+        raise ValueError(f"Mês inválido: {month!r}. Use AAAA-MM.") from e
+    end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    return start, end
+
+def _as_utc(value: datetime | None) -> datetime | None:
+    # O SQLite devolve datas sem fuso; elas são gravadas sempre em UTC
+    return value.replace(tzinfo=timezone.utc) if value is not None and value.tzinfo is None else value
+
+def _record(row) -> dict:
+    return {"id": row.id, "patient_id": row.patient_id, "text": row.text, "sender": row.sender,
+            "has_alert": bool(row.has_alert), "alert_score": row.alert_score or 0.0, "alert_terms": row.alert_terms or [],
+            "timestamp": _as_utc(row.timestamp), "external_id": row.external_id}
+
+def _write_jsonl(rows, path: str) -> int:
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for row in rows:
+            record = _record(row)
+            record["timestamp"] = record["timestamp"].isoformat() if record["timestamp"] else None
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+def _write_parquet(rows, path: str) -> int:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError("A exportação em Parquet requer o pacote pyarrow (pip install pyarrow).") from e
+    schema = pa.schema([("id", pa.int64()), ("patient_id", pa.int64()), ("text", pa.string()), ("sender", pa.string()),
+                        ("has_alert", pa.bool_()), ("alert_score", pa.float64()), ("alert_terms", pa.list_(pa.string())),
+                        ("timestamp", pa.timestamp("us", tz="UTC")), ("external_id", pa.string())])
+    count, batch = 0, []
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        for row in rows:
+            batch.append(_record(row))
+            if len(batch) >= EXPORT_BATCH_SIZE:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                count += len(batch)
+                batch = []
+        if batch or not count:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            count += len(batch)
+    return count
+
+def export_messages(out_dir: str = ARCHIVE_EXPORT_DIR, patient_id: int | None = None, month: str | None = None,
+                    fmt: str = "jsonl", archive_only: bool = False) -> tuple[str, int]:
+    """
+    Exporta as mensagens de um paciente e/ou de um mês para um arquivo compactado em `out_dir`,
+    lendo o banco em blocos (a memória não cresce com o tamanho do histórico). O arquivo só
+    aparece com o nome final quando completo. Devolve (caminho, quantidade de mensagens).
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Formato inválido: {fmt!r}. Use {' ou '.join(EXPORT_FORMATS)}.")
+    since, until = month_range(month) if month else (None, None)
+    name = "mensagens"
+    if patient_id is not None:
+        name += f"_paciente-{patient_id}"
+    if month:
+        name += f"_{month}"
+    if archive_only:
+        name += "_arquivo"
+    path = os.path.join(out_dir, name + (".jsonl.gz" if fmt == "jsonl" else ".parquet"))
+    os.makedirs(out_dir, exist_ok=True)
+    partial = path + ".partial"
+    writer = _write_jsonl if fmt == "jsonl" else _write_parquet
+    try:
+        with SessionLocal() as db:
+            rows = crud.iter_messages_for_export(db, patient_id=patient_id, since=since, until=until,
+                                                 include_hot=not archive_only, batch_size=EXPORT_BATCH_SIZE)
+            count = writer(rows, partial)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.replace(partial, path)
+    return path, count
+
+
+async def _archive_standalone():
+    try:
+        return await message_archiver.run_once()
+    finally:
+        await async_engine.dispose()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("archive", help="move agora as mensagens que passaram da retenção")
+    export = commands.add_parser("export", help="exporta mensagens para um arquivo compactado")
+    export.add_argument("--patient", type=int, help="id do paciente")
+    export.add_argument("--month", help="mês no formato AAAA-MM (UTC)")
+    export.add_argument("--format", choices=EXPORT_FORMATS, default="jsonl")
+    export.add_argument("--out", default=ARCHIVE_EXPORT_DIR, help="diretório de saída")
+    export.add_argument("--archive-only", action="store_true", help="apenas as mensagens já arquivadas")
+    args = parser.parse_args()
+
+    configure_logging()
+    if args.command == "archive":
+        if not asyncio.run(_archive_standalone()):
+            logger.info("Nenhuma mensagem para arquivar.")
+        return
+    if args.patient is None and args.month is None:
+        parser.error("informe --patient e/ou --month")
+    path, count = export_messages(args.out, args.patient, args.month, args.format, args.archive_only)
+    logger.info("%s mensagens exportadas para %s.", count, path)
+
+
+if __name__ == "__main__":
+    main()
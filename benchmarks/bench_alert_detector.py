@@ -0,0 +1,68 @@
+"""
+Micro-benchmark do alert_detector sobre um corpus sintético de mensagens em português.
+
+Uso (a partir da raiz do projeto):
+    python -m benchmarks.bench_alert_detector --messages 200000
+"""
+import sys
+import time
+import random
+import argparse
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from alert_detector import AlertDetector
+
+OPENINGS = ["Bom dia", "Oi", "Olá doutora", "Boa tarde", "Boa noite", "Oi, tudo bem?", ""]
+BODIES = [
+    "tomei o remédio no horário certo", "tudo bem hoje", "obrigado pelo lembrete", "fiz a caminhada de 30 minutos",
+    "minha pressão estava 12 por 8", "pesei 82 kg hoje", "comi bem no almoço", "o cuidador me ajudou com os exercícios",
+    "adorei a consulta de ontem", "estou com dor nas costas desde cedo", "tive febre à noite", "hoje foi um dia difícil",
+    "hoje foi dificil", "não tomei o remédio da manhã", "passei a noite sem dormir", "estou me sentindo ansiosa",
+    "estou triste com a notícia", "estou sem dor hoje", "não senti nenhuma dor", "sem febre desde ontem",
+]
+CLOSINGS = ["", "Obrigado!", "Até amanhã.", "Abraço", "😊", "Qualquer coisa aviso."]
+
+
+def build_corpus(size: int, seed: int = 42) -> list[str]:
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        parts = [rng.choice(OPENINGS), rng.choice(BODIES)]
+        if rng.random() < 0.3:
+            parts.append(rng.choice(BODIES))
+        parts.append(rng.choice(CLOSINGS))
+        corpus.append(". ".join(part for part in parts if part))
+    return corpus
+
+
+def naive_detect(text: str, keywords: list[str]) -> bool:
+    # Implementação anterior: varredura linear de substrings
+    lower = text.lower()
+    return any(keyword in lower for keyword in keywords)
+
+
+def measure(label: str, fn, corpus: list[str]):
+    started = time.perf_counter()
+    alerts = sum(1 for text in corpus if fn(text))
+    elapsed = time.perf_counter() - started
+    print(f"{label:<20} {len(corpus) / elapsed:>12,.0f} msg/s  {elapsed * 1e6 / len(corpus):>8.2f} µs/msg  alertas={alerts}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.messages, args.seed)
+    detector = AlertDetector()
+    keywords = ["dor", "febre", "difícil", "não tomei", "sem dormir", "ansioso", "triste"]
+    print(f"Corpus: {len(corpus):,} mensagens, {sum(map(len, corpus)) / len(corpus):.0f} caracteres em média")
+    measure("substring (antigo)", lambda text: naive_detect(text, keywords), corpus)
+    measure("alert_detector", lambda text: detector.detect(text).has_alert, corpus)
+
+
+if __name__ == "__main__":
+    main()
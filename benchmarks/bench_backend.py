@@ -0,0 +1,400 @@
+"""
+Benchmark de ponta a ponta do backend contra os stubs da Graph API e do Gemini (benchmarks.stubs).
+Sobe os stubs e o uvicorn com um banco descartável, popula o banco e mede:
+
+  read      GET /api/patients e GET /api/messages/{id}: latência para cada tamanho de --sizes
+  webhook   POST /webhook com rajadas de payloads: req/s, p50/p99 e tempo até a fila esvaziar
+  ws        latência webhook -> /ws/panel com vários painéis conectados
+  run_task  vazão do disparo em massa (send_scheduled_messages.run_bulk_send)
+
+O relatório JSON inclui o commit e a configuração; compare dois relatórios com benchmarks.compare.
+
+Uso (a partir da raiz do projeto):
+    python -m benchmarks.bench_backend --sizes 1000,10000
+    python -m benchmarks.bench_backend --database-url postgresql://localhost/bench --workers 4 --scenarios webhook,ws
+"""
+import sys
+import os
+import json
+import math
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+import tempfile
+from datetime import datetime, timezone, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx
+from benchmarks.payloads import WebhookPayloadGenerator, patient_phone, FIRST_NAMES
+
+SCENARIOS = ["read", "webhook", "ws", "run_task"]
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+SEED_CHUNK = 5000
+
+
+def summarize(latencies: list[float]) -> dict:
+    """
+    Estatísticas de latência (segundos na entrada, milissegundos na saída), percentil por posição.
+    """
+    if not latencies:
+        return {"count": 0}
+    ordered = sorted(latencies)
+
+    def percentile(q: float) -> float:
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))] * 1000
+
+    return {"count": len(ordered), "mean_ms": sum(ordered) / len(ordered) * 1000, "p50_ms": percentile(0.50),
+            "p90_ms": percentile(0.90), "p99_ms": percentile(0.99), "max_ms": ordered[-1] * 1000}
+
+
+def git_info() -> dict:
+    def git(*args):
+        result = subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True)
+        return result.stdout.strip() if result.returncode == 0 else None
+    return {"commit": git("rev-parse", "HEAD"), "branch": git("rev-parse", "--abbrev-ref", "HEAD"),
+            "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def configure_environment(args, database_url: str):
+    """
+    Variáveis lidas pelo backend (subprocesso) e pelos módulos importados aqui (run_task).
+    Precisa rodar antes de importar qualquer módulo da aplicação.
+    """
+    os.environ.update({
+        "DATABASE_URL": database_url,
+        "WHATSAPP_API_BASE_URL": f"http://127.0.0.1:{args.graph_port}",
+        "WHATSAPP_TOKEN": "bench", "PHONE_NUMBER_ID": "100000000000001",
+        "WHATSAPP_RATE_PER_SECOND": str(args.wa_rate), "WHATSAPP_BURST": str(args.wa_rate),
+        "GEMINI_API_ENDPOINT": f"http://127.0.0.1:{args.gemini_port}", "GOOGLE_API_KEY": "bench",
+        "CRON_SECRET": "bench",
+        # Os lembretes agendados disparariam no meio das medições
+        "DEFAULT_REMINDERS_ENABLED": "false",
+    })
+
+
+def start_process(command: list[str], log_path: str) -> subprocess.Popen:
+    log = open(log_path, "w")
+    return subprocess.Popen(command, cwd=ROOT, env=os.environ.copy(), stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_ready(url: str, process: subprocess.Popen, log_path: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                break
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.25)
+    with open(log_path) as f:
+        raise RuntimeError(f"{url} não respondeu. Log:\n{f.read()[-3000:]}")
+
+
+class Dataset:
+    """
+    Popula o banco diretamente (inserções em lote) até o número de pacientes pedido, com
+    `messages_per_patient` mensagens cada e ~5% dos pacientes com alertas pendentes.
+    """
+    def __init__(self, messages_per_patient: int, seed: int):
+        from sqlalchemy import func, select
+        from database.database import engine, upgrade_schema
+        from database import models
+        models.Base.metadata.create_all(bind=engine)
+        upgrade_schema()
+        self.engine = engine
+        self.models = models
+        self.messages_per_patient = messages_per_patient
+        self.rng = random.Random(seed)
+        with engine.connect() as conn:
+            self.patients = conn.execute(select(func.count()).select_from(models.Patient.__table__)).scalar()
+        if self.patients:
+            raise RuntimeError("O banco de benchmark já tem pacientes; use um banco vazio (--database-url).")
+
+    def grow_to(self, size: int):
+        Patient, Message = self.models.Patient.__table__, self.models.Message.__table__
+        now = datetime.now(timezone.utc)
+        while self.patients < size:
+            start, stop = self.patients, min(size, self.patients + SEED_CHUNK)
+            patients, messages = [], []
+            for index in range(start, stop):
+                alerts = self.rng.randint(1, 3) if self.rng.random() < 0.05 else 0
+                last_at = now - timedelta(seconds=self.rng.randrange(30 * 24 * 3600))
+                patients.append({"id": index + 1, "phone_number": patient_phone(index), "name": FIRST_NAMES[index % len(FIRST_NAMES)],
+                                 "status": "manual" if self.rng.random() < 0.05 else "automatico", "unread_alert_count": alerts,
+                                 "last_message_at": last_at, "last_message_preview": "Tomei o remédio no horário."})
+                for position in range(self.messages_per_patient):
+                    messages.append({"patient_id": index + 1, "text": f"Mensagem {position} do paciente {index}.",
+                                     "sender": "patient" if position % 2 == 0 else "professional",
+                                     "has_alert": position >= self.messages_per_patient - alerts, "alert_score": 0.0,
+                                     "timestamp": last_at - timedelta(hours=self.messages_per_patient - position)})
+            with self.engine.begin() as conn:
+                conn.execute(Patient.insert(), patients)
+                for offset in range(0, len(messages), SEED_CHUNK):
+                    conn.execute(Message.insert(), messages[offset:offset + SEED_CHUNK])
+            self.patients = stop
+        if self.engine.dialect.name == "postgresql":
+            with self.engine.begin() as conn:
+                # Ids explícitos acima: ajusta a sequência para os pacientes criados pelos webhooks
+                conn.exec_driver_sql("SELECT setval('patients_id_seq', (SELECT max(id) FROM patients))")
+                conn.exec_driver_sql("ANALYZE")
+
+
+async def measure_requests(client: httpx.AsyncClient, paths: list[str]) -> dict:
+    latencies, errors = [], 0
+    for path in paths:
+        started = time.perf_counter()
+        response = await client.get(path)
+        latencies.append(time.perf_counter() - started)
+        errors += response.status_code >= 400
+    return {**summarize(latencies), "errors": errors}
+
+
+async def bench_read(client: httpx.AsyncClient, size: int, requests: int, rng: random.Random) -> dict:
+    first_page = await measure_requests(client, ["/api/patients?limit=100"] * requests)
+    # Percorre a lista pelo cursor: a latência não deve crescer com a profundidade da página
+    page_latencies, cursor, pages = [], None, 0
+    while pages < min(requests, 50):
+        started = time.perf_counter()
+        response = await client.get("/api/patients", params={"limit": 100, **({"cursor": cursor} if cursor else {})})
+        page_latencies.append(time.perf_counter() - started)
+        pages += 1
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    messages = await measure_requests(client, [f"/api/messages/{rng.randint(1, size)}?limit=100" for _ in range(requests)])
+    return {"patients": size, "patients_first_page": first_page, "patients_cursor_walk": summarize(page_latencies),
+            "messages_page": messages}
+
+
+async def wait_queue_drained(client: httpx.AsyncClient, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = (await client.get("/api/webhook-queue/stats")).json()
+        if stats["depth"] == 0 and stats["in_progress"] == 0:
+            return True
+        await asyncio.sleep(0.1)
+    return False
+
+
+async def bench_webhook(client: httpx.AsyncClient, generator: WebhookPayloadGenerator, payloads: int, concurrency: int,
+                        drain_timeout: float) -> dict:
+    bodies = [json.dumps(payload).encode() for payload in generator.burst(payloads)]
+    messages = sum(len(change["value"].get("messages", [])) for body in bodies
+                   for entry in json.loads(body)["entry"] for change in entry["changes"])
+    queue: asyncio.Queue[bytes] = asyncio.Queue()
+    for body in bodies:
+        queue.put_nowait(body)
+    latencies, errors = [], 0
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            body = queue.get_nowait()
+            started = time.perf_counter()
+            response = await client.post("/webhook", content=body, headers={"Content-Type": "application/json"})
+            latencies.append(time.perf_counter() - started)
+            errors += response.status_code != 200
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    accepted_in = time.perf_counter() - started
+    drained = await wait_queue_drained(client, drain_timeout)
+    processed_in = time.perf_counter() - started
+    return {"payloads": payloads, "messages": messages, "concurrency": concurrency, "errors": errors,
+            "requests_per_second": payloads / accepted_in, "latency": summarize(latencies),
+            "drained": drained, "drain_seconds": processed_in,
+            "processed_messages_per_second": messages / processed_in if drained else None}
+
+
+async def bench_ws(base_url: str, client: httpx.AsyncClient, generator: WebhookPayloadGenerator, clients: int, messages: int,
+                   interval: float, patients: int) -> dict:
+    from websockets.asyncio.client import connect
+    ws_url = base_url.replace("http://", "ws://") + "/ws/panel"
+    sent: dict[str, float] = {}
+    received: list[float] = []
+    done = asyncio.Event()
+    expected = clients * messages
+
+    async def listen(connection):
+        async for raw in connection:
+            data = json.loads(raw)
+            if data.get("type") != "patient_update":
+                continue
+            preview = data["patient"].get("last_message_preview")
+            if preview in sent:
+                received.append(time.perf_counter() - sent[preview])
+                if len(received) >= expected:
+                    done.set()
+
+    connections = [await connect(ws_url) for _ in range(clients)]
+    listeners = [asyncio.create_task(listen(connection)) for connection in connections]
+    await asyncio.sleep(0.5)
+    rng = random.Random(7)
+    for index in range(messages):
+        marker = f"bench-ws:{index}:{uuid.uuid4().hex[:8]}"
+        payload = generator.messages_payload([rng.randrange(patients)], [marker])
+        sent[marker] = time.perf_counter()
+        await client.post("/webhook", json=payload)
+        await asyncio.sleep(interval)
+    try:
+        await asyncio.wait_for(done.wait(), timeout=10)
+    except asyncio.TimeoutError:
+        pass
+    for task in listeners:
+        task.cancel()
+    for connection in connections:
+        await connection.close()
+    return {"clients": clients, "messages": messages, "delivered_ratio": len(received) / expected,
+            "webhook_to_panel": summarize(received)}
+
+
+async def bench_run_task() -> dict:
+    # Importado só aqui: os módulos leem as variáveis de ambiente configuradas pelo benchmark
+    import send_scheduled_messages
+    from whatsapp import whatsapp_client
+    from database.database import async_engine
+    job = send_scheduled_messages.BulkSendJob("Lembrete de benchmark.", key=f"bench:{uuid.uuid4().hex}")
+    started = time.perf_counter()
+    try:
+        await send_scheduled_messages.run_bulk_send(job)
+    finally:
+        await whatsapp_client.aclose()
+        await async_engine.dispose()
+    elapsed = time.perf_counter() - started
+    return {"patients": job.total, "sent": job.success_count, "failed": job.failure_count, "seconds": elapsed,
+            "messages_per_second": job.success_count / elapsed if elapsed else None}
+
+
+async def run(args, workdir: str) -> dict:
+    database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    configure_environment(args, database_url)
+    is_postgres = database_url.startswith(("postgres://", "postgresql"))
+    if args.workers > 1 and not is_postgres:
+        print("AVISO: com SQLite e vários workers o broadcast não atravessa processos (use Postgres).")
+    dataset = Dataset(args.messages_per_patient, args.seed)
+
+    stubs_log, server_log = os.path.join(workdir, "stubs.log"), os.path.join(workdir, "server.log")
+    stubs = start_process([sys.executable, "-m", "benchmarks.stubs", "--graph-port", str(args.graph_port),
+                           "--gemini-port", str(args.gemini_port), "--latency-ms", str(args.graph_latency_ms),
+                           "--gemini-latency-ms", str(args.gemini_latency_ms), "--error-rate", str(args.error_rate),
+                           "--seed", str(args.seed)], stubs_log)
+    server = start_process([sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(args.port),
+                            "--workers", str(args.workers), "--log-level", "warning", "--no-access-log"], server_log)
+    base_url = f"http://127.0.0.1:{args.port}"
+    results = {}
+    try:
+        await wait_ready(f"http://127.0.0.1:{args.graph_port}/stats", stubs, stubs_log)
+        await wait_ready(base_url + "/", server, server_log)
+        rng = random.Random(args.seed)
+        generator = WebhookPayloadGenerator(patients=max(args.sizes), seed=args.seed)
+        limits = httpx.Limits(max_connections=max(args.concurrency, 10))
+        async with httpx.AsyncClient(base_url=base_url, timeout=60, limits=limits) as client:
+            for size in args.sizes:
+                print(f"Populando o banco até {size:,} pacientes...")
+                dataset.grow_to(size)
+                if "read" in args.scenarios:
+                    results.setdefault("read", {})[str(size)] = await bench_read(client, size, args.read_requests, rng)
+            if "webhook" in args.scenarios:
+                print(f"Webhook: {args.payloads} payloads com concorrência {args.concurrency}...")
+                results["webhook"] = await bench_webhook(client, generator, args.payloads, args.concurrency, args.drain_timeout)
+            if "ws" in args.scenarios:
+                print(f"WebSocket: {args.ws_clients} painéis, {args.ws_messages} mensagens...")
+                results["ws"] = await bench_ws(base_url, client, generator, args.ws_clients, args.ws_messages,
+                                               args.ws_interval, max(args.sizes))
+            async with httpx.AsyncClient() as stub_client:
+                results["stubs"] = {
+                    "graph": (await stub_client.get(f"http://127.0.0.1:{args.graph_port}/stats")).json(),
+                    "gemini": (await stub_client.get(f"http://127.0.0.1:{args.gemini_port}/stats")).json(),
+                }
+        if "run_task" in args.scenarios:
+            print("run_task: disparo em massa para todos os pacientes...")
+            results["run_task"] = await bench_run_task()
+    finally:
+        for process in (server, stubs):
+            process.terminate()
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+    return {"database": "postgresql" if is_postgres else "sqlite", "results": results}
+
+
+def print_summary(report: dict):
+    results = report["results"]
+    for size, read in results.get("read", {}).items():
+        print(f"read  {int(size):>9,} pacientes  /api/patients p50={read['patients_first_page']['p50_ms']:.1f}ms "
+              f"p99={read['patients_first_page']['p99_ms']:.1f}ms  /api/messages p50={read['messages_page']['p50_ms']:.1f}ms "
+              f"p99={read['messages_page']['p99_ms']:.1f}ms")
+    if "webhook" in results:
+        webhook = results["webhook"]
+        print(f"webhook  {webhook['requests_per_second']:,.0f} req/s  p50={webhook['latency']['p50_ms']:.1f}ms "
+              f"p99={webhook['latency']['p99_ms']:.1f}ms  fila vazia em {webhook['drain_seconds']:.1f}s")
+    if "ws" in results:
+        ws = results["ws"]
+        print(f"ws  entregues={ws['delivered_ratio']:.1%}  p50={ws['webhook_to_panel'].get('p50_ms', 0):.1f}ms "
+              f"p99={ws['webhook_to_panel'].get('p99_ms', 0):.1f}ms")
+    if "run_task" in results:
+        task = results["run_task"]
+        print(f"run_task  {task['sent']:,} enviadas em {task['seconds']:.1f}s ({task['messages_per_second'] or 0:,.0f} msg/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", type=lambda value: value.split(","), default=SCENARIOS)
+    parser.add_argument("--sizes", type=lambda value: sorted(int(size) for size in value.split(",")), default=[1000, 10000],
+                        help="tamanhos do banco (pacientes) em que as leituras são medidas")
+    parser.add_argument("--messages-per-patient", type=int, default=20)
+    parser.add_argument("--read-requests", type=int, default=200)
+    parser.add_argument("--payloads", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--drain-timeout", type=float, default=300)
+    parser.add_argument("--ws-clients", type=int, default=50)
+    parser.add_argument("--ws-messages", type=int, default=50)
+    parser.add_argument("--ws-interval", type=float, default=0.2)
+    parser.add_argument("--workers", type=int, default=1, help="workers do uvicorn")
+    parser.add_argument("--database-url", help="banco vazio para o teste (padrão: SQLite temporário)")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--graph-port", type=int, default=9101)
+    parser.add_argument("--gemini-port", type=int, default=9102)
+    parser.add_argument("--graph-latency-ms", type=float, default=80)
+    parser.add_argument("--gemini-latency-ms", type=float, default=400)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--wa-rate", type=float, default=500, help="limite de envios/s do cliente do WhatsApp (produção: 80)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="arquivo do relatório (padrão: benchmarks/results/<data>-<commit>.json)")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"cenários desconhecidos: {', '.join(sorted(unknown))}")
+
+    git = git_info()
+    started_at = datetime.now(timezone.utc)
+    with tempfile.TemporaryDirectory(prefix="cuideme-bench-") as workdir:
+        outcome = asyncio.run(run(args, workdir))
+    report = {
+        "git": git,
+        "created_at": started_at.isoformat(),
+        "duration_seconds": (datetime.now(timezone.utc) - started_at).total_seconds(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+                        "database": outcome["database"]},
+        "config": {key: value for key, value in vars(args).items() if key not in ("database_url", "output")},
+        "results": outcome["results"],
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{started_at:%Y%m%d-%H%M%S}-{(git['commit'] or 'nogit')[:8]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print_summary(report)
+    print(f"Relatório: {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Compara dois relatórios do benchmarks.bench_backend (ex.: main x branch) métrica a métrica.
+
+Uso (a partir da raiz do projeto):
+    python -m benchmarks.compare benchmarks/results/antes.json benchmarks/results/depois.json --threshold 10
+
+Com --fail-on-regression, termina com código 1 se alguma métrica piorar mais que o limite (útil em CI).
+"""
+import sys
+import json
+import argparse
+
+# Sufixos das métricas comparadas e se "maior é melhor"
+DIRECTIONS = [("_per_second", True), ("delivered_ratio", True), ("_ms", False), ("_seconds", False), ("seconds", False)]
+
+
+def flatten(results: dict, prefix: str = "") -> dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = float(value)
+    return flat
+
+
+def higher_is_better(metric: str) -> bool | None:
+    for suffix, higher in DIRECTIONS:
+        if metric.endswith(suffix):
+            return higher
+    return None
+
+
+def describe(report: dict) -> str:
+    git = report.get("git", {})
+    commit = (git.get("commit") or "?")[:8] + ("+alterações" if git.get("dirty") else "")
+    return f"{commit} ({report.get('created_at', '?')}, {report.get('environment', {}).get('database', '?')})"
+
+
+def compare(old: dict, new: dict, threshold: float):
+    old_metrics, new_metrics = flatten(old["results"]), flatten(new["results"])
+    rows, regressions = [], []
+    for metric in sorted(old_metrics.keys() & new_metrics.keys()):
+        higher = higher_is_better(metric)
+        if higher is None:
+            continue
+        before, after = old_metrics[metric], new_metrics[metric]
+        change = (after - before) / before * 100 if before else 0.0
+        worse = change < -threshold if higher else change > threshold
+        better = change > threshold if higher else change < -threshold
+        flag = "PIOROU" if worse else ("melhorou" if better else "")
+        rows.append((metric, before, after, change, flag))
+        if worse:
+            regressions.append(metric)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=10.0, help="variação (%%) a partir da qual a mudança é sinalizada")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if old.get("environment") != new.get("environment"):
+        print("AVISO: os relatórios foram gerados em ambientes diferentes; compare com cautela.")
+    if old.get("config") != new.get("config"):
+        print("AVISO: os relatórios usaram configurações diferentes.")
+
+    rows, regressions = compare(old, new, args.threshold)
+    print(f"antes:  {describe(old)}\ndepois: {describe(new)}\n")
+    width = max((len(row[0]) for row in rows), default=10)
+    print(f"{'métrica':<{width}}  {'antes':>12}  {'depois':>12}  {'variação':>9}")
+    for metric, before, after, change, flag in rows:
+        print(f"{metric:<{width}}  {before:>12.2f}  {after:>12.2f}  {change:>+8.1f}%  {flag}")
+    if regressions:
+        print(f"\n{len(regressions)} métrica(s) pioraram mais de {args.threshold:.0f}%.")
+        if args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
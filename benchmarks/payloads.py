@@ -0,0 +1,99 @@
+"""
+Gerador de payloads de webhook no formato da Meta (mensagens de texto e callbacks de status),
+reproduzível pela semente, para simular rajadas de respostas dos pacientes.
+
+Uso (a partir da raiz do projeto), grava um payload JSON por linha:
+    python -m benchmarks.payloads --payloads 1000 --patients 500 > rajada.jsonl
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_alert_detector import build_corpus
+
+PHONE_NUMBER_ID = "100000000000001"
+DISPLAY_PHONE_NUMBER = "5511900000000"
+FIRST_NAMES = ["Maria", "José", "Ana", "João", "Antônia", "Francisco", "Adriana", "Carlos", "Juliana", "Paulo"]
+
+
+def patient_phone(index: int) -> str:
+    # Mesmo formato usado ao popular o banco, para que as mensagens caiam em pacientes existentes
+    return f"5511{9_0000_0000 + index:09d}"
+
+
+class WebhookPayloadGenerator:
+    """
+    Gera payloads com 1 a `max_messages` mensagens de pacientes sorteados entre `patients`.
+    Uma fração `status_ratio` dos payloads traz callbacks de status em vez de mensagens.
+    """
+    def __init__(self, patients: int = 1000, max_messages: int = 3, status_ratio: float = 0.2, seed: int = 42):
+        self.patients = patients
+        self.max_messages = max_messages
+        self.status_ratio = status_ratio
+        self.rng = random.Random(seed)
+        self.corpus = build_corpus(2000, seed)
+        self.sequence = 0
+
+    def _next_id(self) -> str:
+        self.sequence += 1
+        return f"wamid.bench{self.rng.getrandbits(64):016x}{self.sequence:08d}"
+
+    def message(self, index: int, text: str | None = None) -> tuple[dict, dict]:
+        phone = patient_phone(index)
+        contact = {"profile": {"name": FIRST_NAMES[index % len(FIRST_NAMES)]}, "wa_id": phone}
+        message = {"from": phone, "id": self._next_id(), "timestamp": str(int(time.time())), "type": "text",
+                   "text": {"body": text if text is not None else self.rng.choice(self.corpus)}}
+        return contact, message
+
+    def _wrap(self, value: dict) -> dict:
+        value = {"messaging_product": "whatsapp",
+                 "metadata": {"display_phone_number": DISPLAY_PHONE_NUMBER, "phone_number_id": PHONE_NUMBER_ID}, **value}
+        return {"object": "whatsapp_business_account",
+                "entry": [{"id": "200000000000001", "changes": [{"field": "messages", "value": value}]}]}
+
+    def messages_payload(self, indexes: list[int], texts: list[str] | None = None) -> dict:
+        contacts, messages = [], []
+        for position, index in enumerate(indexes):
+            contact, message = self.message(index, texts[position] if texts else None)
+            contacts.append(contact)
+            messages.append(message)
+        return self._wrap({"contacts": contacts, "messages": messages})
+
+    def statuses_payload(self, count: int) -> dict:
+        # Ids de envio inexistentes: exercita o caminho de atualização em lote sem depender da outbox
+        statuses = [{"id": self._next_id(), "status": self.rng.choice(["sent", "delivered", "read"]),
+                     "timestamp": str(int(time.time())), "recipient_id": patient_phone(self.rng.randrange(self.patients))}
+                    for _ in range(count)]
+        return self._wrap({"statuses": statuses})
+
+    def next_payload(self) -> dict:
+        if self.rng.random() < self.status_ratio:
+            return self.statuses_payload(self.rng.randint(1, self.max_messages))
+        count = self.rng.randint(1, self.max_messages)
+        return self.messages_payload([self.rng.randrange(self.patients) for _ in range(count)])
+
+    def burst(self, count: int) -> list[dict]:
+        return [self.next_payload() for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--payloads", type=int, default=1000)
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--max-messages", type=int, default=3)
+    parser.add_argument("--status-ratio", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    generator = WebhookPayloadGenerator(args.patients, args.max_messages, args.status_ratio, args.seed)
+    for payload in generator.burst(args.payloads):
+        sys.stdout.write(json.dumps(payload, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
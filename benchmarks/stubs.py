@@ -0,0 +1,129 @@
+"""
+Servidores stub da Graph API do WhatsApp (/messages) e da API do Gemini, com latência e
+taxa de erros configuráveis, para medir o backend sem chamar a Meta nem o Google.
+
+Uso (a partir da raiz do projeto):
+    python -m benchmarks.stubs --graph-port 9101 --gemini-port 9102 --latency-ms 80 --error-rate 0.01
+
+O backend usa os stubs com:
+    WHATSAPP_API_BASE_URL=http://127.0.0.1:9101 GEMINI_API_ENDPOINT=http://127.0.0.1:9102 GOOGLE_API_KEY=bench
+"""
+import sys
+import json
+import uuid
+import random
+import asyncio
+import argparse
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+class StubBehavior:
+    """
+    Latência (média e variação uniforme, em ms) e fração de respostas com erro. Metade dos
+    erros é 429 (limite de taxa, com Retry-After) e metade 500, como a Graph API devolve.
+    """
+    def __init__(self, latency_ms: float = 50.0, jitter_ms: float = 20.0, error_rate: float = 0.0, seed: int = 42):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+
+    async def delay(self):
+        latency = self.latency_ms + self.rng.uniform(-self.jitter_ms, self.jitter_ms)
+        await asyncio.sleep(max(0.0, latency) / 1000)
+
+    def error_response(self) -> JSONResponse | None:
+        self.requests += 1
+        if self.rng.random() >= self.error_rate:
+            return None
+        self.errors += 1
+        if self.rng.random() < 0.5:
+            return JSONResponse({"error": {"message": "Rate limit hit (stub)", "code": 130429}}, status_code=429, headers={"Retry-After": "1"})
+        return JSONResponse({"error": {"message": "Internal error (stub)", "code": 2}}, status_code=500)
+
+    def stats(self):
+        return {"requests": self.requests, "errors": self.errors}
+
+
+def create_graph_app(behavior: StubBehavior) -> FastAPI:
+    app = FastAPI(title="Stub da Graph API")
+
+    @app.post("/{version}/{phone_number_id}/messages")
+    async def send_message(version: str, phone_number_id: str, request: Request):
+        body = await request.json()
+        await behavior.delay()
+        error = behavior.error_response()
+        if error is not None:
+            return error
+        return {"messaging_product": "whatsapp", "contacts": [{"input": body.get("to"), "wa_id": body.get("to")}],
+                "messages": [{"id": f"wamid.stub{uuid.uuid4().hex}"}]}
+
+    @app.get("/stats")
+    def stats():
+        return behavior.stats()
+
+    return app
+
+
+def create_gemini_app(behavior: StubBehavior, reply: str = "Obrigado por compartilhar!") -> FastAPI:
+    app = FastAPI(title="Stub da API do Gemini")
+
+    # Mesma rota do transporte REST do SDK: POST /v1beta/models/<modelo>:generateContent
+    @app.post("/{version}/models/{model_action}")
+    async def generate_content(version: str, model_action: str, request: Request):
+        body = await request.json()
+        await behavior.delay()
+        error = behavior.error_response()
+        if error is not None:
+            return error
+        prompt = " ".join(part.get("text", "") for content in body.get("contents", []) for part in content.get("parts", []))
+        if "responder" in prompt:
+            text = json.dumps({"responder": True, "texto_resposta": reply}, ensure_ascii=False)
+        else:
+            text = "- Resumo gerado pelo stub do Gemini."
+        return {"candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP", "index": 0}],
+                "usageMetadata": {"promptTokenCount": len(prompt) // 4, "candidatesTokenCount": len(text) // 4}}
+
+    @app.get("/stats")
+    def stats():
+        return behavior.stats()
+
+    return app
+
+
+def _server(app: FastAPI, port: int) -> uvicorn.Server:
+    return uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", access_log=False))
+
+
+async def serve(graph_port: int, gemini_port: int, graph: StubBehavior, gemini: StubBehavior):
+    await asyncio.gather(_server(create_graph_app(graph), graph_port).serve(),
+                         _server(create_gemini_app(gemini), gemini_port).serve())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--graph-port", type=int, default=9101)
+    parser.add_argument("--gemini-port", type=int, default=9102)
+    parser.add_argument("--latency-ms", type=float, default=80.0, help="latência média da Graph API")
+    parser.add_argument("--gemini-latency-ms", type=float, default=400.0, help="latência média do Gemini")
+    parser.add_argument("--jitter-ms", type=float, default=20.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fração de respostas com erro (0 a 1)")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    graph = StubBehavior(args.latency_ms, args.jitter_ms, args.error_rate, args.seed)
+    gemini = StubBehavior(args.gemini_latency_ms, args.jitter_ms, args.error_rate, args.seed + 1)
+    print(f"Graph API stub em http://127.0.0.1:{args.graph_port}, Gemini stub em http://127.0.0.1:{args.gemini_port}")
+    asyncio.run(serve(args.graph_port, args.gemini_port, graph, gemini))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,80 @@
+import os
+import re
+import json
+import heapq
+import base64
+from datetime import date, datetime, timezone, timedelta
+from zoneinfo import ZoneInfo
+from sqlalchemy import (func, select, insert, delete, update, union_all, or_, tuple_, bindparam, literal, literal_column,
+                        exists, table, column, cast, case, DateTime, Double)
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session
 from . import models
+from .database import SEARCH_TS_CONFIG
+
+# As funções deste módulo não fazem commit: quem chama define a transação (with_session,
+# run_in_transaction ou db.commit() no endpoint), para que várias operações saiam juntas.
+
+# Tamanho do trecho da última mensagem exibido na lista de pacientes
+MESSAGE_PREVIEW_LENGTH = 120
+
+def _insert(db: Session, model):
+    """
+    INSERT com suporte a ON CONFLICT no dialeto em uso (Postgres em produção, SQLite local).
+    """
+    return (postgresql.insert if db.get_bind().dialect.name == "postgresql" else sqlite.insert)(model)
 
 # ... (funções existentes get_or_create_patient, create_message, get_all_patients) ...
 def get_or_create_patient(db: Session, phone_number: str):
     """
     Busca um paciente pelo número de telefone. Se não existir, cria um novo.
+    Um único INSERT ... ON CONFLICT DO UPDATE ... RETURNING: duas primeiras mensagens
+    simultâneas do mesmo número chegam ao mesmo paciente, sem erro de chave duplicada.
     """
-    patient = db.query(models.Patient).filter(models.Patient.phone_number == phone_number).first()
-    if not patient:
-        patient = models.Patient(phone_number=phone_number)
-        db.add(patient)
-        db.commit()
-        db.refresh(patient)
-    return patient
+    stmt = _insert(db, models.Patient).values(phone_number=phone_number)
+    # O UPDATE sem efeito faz o RETURNING devolver também a linha que já existia
+    stmt = stmt.on_conflict_do_update(index_elements=["phone_number"], set_={"phone_number": stmt.excluded.phone_number})
+    return db.scalars(stmt.returning(models.Patient), execution_options={"populate_existing": True}).one()
 
-def create_message(db: Session, patient_id: int, text: str, has_alert: bool, sender: str = "patient"):
+def create_message(db: Session, patient_id: int, text: str, has_alert: bool, sender: str = "patient", external_id: str | None = None,
+                   alert_score: float = 0.0, alert_terms: list[str] | None = None, delivery_status: str | None = None):
     """
-    Cria e salva uma nova mensagem no banco de dados.
+    Cria e salva uma nova mensagem no banco de dados e atualiza, na mesma transação,
+    o estado de alertas e de última atividade do paciente. Com `external_id` (id do WhatsApp),
+    uma reentrega da mesma mensagem é descartada pelo índice único e a função devolve None.
     """
-    db_message = models.Message(
+    stmt = _insert(db, models.Message).values(
         patient_id=patient_id,
         text=text,
         has_alert=has_alert,
-        sender=sender
+        sender=sender,
+        external_id=external_id,
+        alert_score=alert_score,
+        alert_terms=alert_terms,
+        delivery_status=delivery_status
     )
-    db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
+    if external_id is not None:
+        stmt = stmt.on_conflict_do_nothing(index_elements=["external_id"])
+    db_message = db.scalars(stmt.returning(models.Message)).first()
+    if db_message is None:
+        return None
+    # Horário gravado na própria mensagem (RETURNING): a lista e os indicadores usam o mesmo valor do histórico
+    now = _as_utc(db_message.timestamp)
+    # A mensagem do profissional que ainda vai pela outbox só conta como resposta quando o envio der certo
+    if delivery_status != "pending":
+        _record_message_engagement(db, patient_id, sender, has_alert, now)
+    # O RETURNING atualiza o paciente já carregado na sessão, sem nova consulta
+    Patient = models.Patient
+    values = {
+        Patient.unread_alert_count: Patient.unread_alert_count + (1 if has_alert else 0),
+        Patient.last_message_at: now,
+        Patient.last_message_preview: text[:MESSAGE_PREVIEW_LENGTH],
+    }
+    if sender == "patient":
+        values[Patient.last_patient_message_at] = now
+        values[Patient.awaiting_reply_since] = func.coalesce(Patient.awaiting_reply_since, now)
+    db.execute(update(Patient).where(Patient.id == patient_id).values(values).returning(Patient),
+               execution_options={"synchronize_session": False, "populate_existing": True}).all()
     return db_message
 
 def get_all_patients(db: Session):
@@ -35,6 +83,763 @@ def get_all_patients(db: Session):
     """
     return db.query(models.Patient).all()
 
+def count_patients(db: Session):
+    return db.query(models.Patient).count()
+
+def get_patients_batch(db: Session, after_id: int = 0, limit: int = 500):
+    """
+    Retorna o próximo lote de pacientes com id maior que `after_id` (paginação por chave),
+    para percorrer a tabela inteira sem carregá-la de uma vez na memória.
+    """
+    return (db.query(models.Patient)
+            .filter(models.Patient.id > after_id)
+            .order_by(models.Patient.id.asc())
+            .limit(limit)
+            .all())
+
+def clear_patient_alerts(db: Session, patient_id: int):
+    """
+    Marca os alertas do paciente como lidos. As mensagens só são tocadas quando o paciente
+    tem alertas pendentes, e a atualização usa o índice parcial ix_messages_unread_alerts.
+    """
+    updated = db.query(models.Patient).filter(models.Patient.id == patient_id, models.Patient.unread_alert_count > 0).update({"unread_alert_count": 0}, synchronize_session=False)
+    if updated:
+        db.query(models.Message).filter(models.Message.patient_id == patient_id, models.Message.has_alert == True).update({"has_alert": False}, synchronize_session=False)
+    return bool(updated)
+
+def rebuild_patient_activity(db: Session):
+    """
+    Recalcula o estado de alertas e de última atividade de todos os pacientes a partir
+    das mensagens (usado após adicionar as colunas em um banco existente).
+    """
+    Message = models.Message
+    alerts = select(func.count(Message.id)).where(Message.patient_id == models.Patient.id, Message.has_alert == True).scalar_subquery()
+    last_at = select(func.max(Message.timestamp)).where(Message.patient_id == models.Patient.id).scalar_subquery()
+    last_text = (select(Message.text).where(Message.patient_id == models.Patient.id)
+                 .order_by(Message.timestamp.desc(), Message.id.desc()).limit(1).scalar_subquery())
+    db.query(models.Patient).update({
+        models.Patient.unread_alert_count: alerts,
+        models.Patient.last_message_at: func.coalesce(last_at, func.now()),
+        models.Patient.last_message_preview: func.substr(last_text, 1, MESSAGE_PREVIEW_LENGTH),
+    }, synchronize_session=False)
+
+def _encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def _decode_cursor(cursor: str) -> list:
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+def get_patients_page(db: Session, limit: int | None = 100, cursor: str | None = None):
+    """
+    Lista os pacientes com alertas primeiro e depois pela atividade mais recente, em uma única
+    consulta sobre o índice ix_patients_inbox. Sem `limit`, devolve todos. Devolve (pacientes,
+    cursor da próxima página).
+    """
+    Patient = models.Patient
+    has_alert = Patient.unread_alert_count > 0
+    query = db.query(Patient)
+    if cursor:
+        try:
+            alert, last_at, patient_id = _decode_cursor(cursor)
+            alert = bool(alert)
+            last_at = datetime.fromisoformat(last_at) if last_at else None
+        except (ValueError, TypeError) as e:
+            raise ValueError("Cursor inválido") from e
+        query = query.filter(tuple_(has_alert, Patient.last_message_at, Patient.id) < tuple_(alert, last_at, patient_id))
+    query = query.order_by(has_alert.desc(), Patient.last_message_at.desc(), Patient.id.desc())
+    if limit is None:
+        return query.all(), None
+    patients = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(patients) > limit:
+        patients = patients[:limit]
+        last = patients[-1]
+        next_cursor = _encode_cursor([last.has_alert, last.last_message_at.isoformat() if last.last_message_at else None, last.id])
+    return patients, next_cursor
+
+def get_messages_page(db: Session, patient_id: int, limit: int = 100, before: int | None = None, after: int | None = None,
+                      include_archive: bool = False):
+    """
+    Página do histórico de um paciente em ordem cronológica, por chave (timestamp, id) sobre o
+    índice ix_messages_patient_timeline. `before`/`after` são ids de mensagens usados como cursor;
+    sem cursor, devolve as mensagens mais recentes. Com `include_archive`, a paginação continua
+    pelas mensagens arquivadas. Devolve (mensagens, há_mais_nessa_direção).
+    """
+    if include_archive:
+        return _get_timeline_page(db, patient_id, limit, before, after)
+    Message = models.Message
+    key = tuple_(Message.timestamp, Message.id)
+    query = db.query(Message).filter(Message.patient_id == patient_id)
+    if after is not None:
+        anchor = select(Message.timestamp, Message.id).where(Message.id == after).scalar_subquery()
+        query = query.filter(key > anchor).order_by(Message.timestamp.asc(), Message.id.asc())
+    else:
+        if before is not None:
+            anchor = select(Message.timestamp, Message.id).where(Message.id == before).scalar_subquery()
+            query = query.filter(key < anchor)
+        query = query.order_by(Message.timestamp.desc(), Message.id.desc())
+    messages = query.limit(limit + 1).all()
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if after is None:
+        messages.reverse()
+    return messages, has_more
+
+def iter_patient_messages(db: Session, patient_id: int, batch_size: int = 1000, include_archive: bool = False):
+    """
+    Percorre todo o histórico do paciente em ordem cronológica sem carregá-lo inteiro na memória.
+    """
+    if include_archive:
+        yield from iter_messages_for_export(db, patient_id=patient_id, batch_size=batch_size)
+        return
+    Message = models.Message
+    stmt = (select(Message).where(Message.patient_id == patient_id)
+            .order_by(Message.timestamp.asc(), Message.id.asc())
+            .execution_options(yield_per=batch_size))
+    for message in db.execute(stmt).scalars():
+        yield message
+
+def _not_failed(delivery_status):
+    # Mensagens do profissional cujo envio falhou nunca chegaram ao paciente
+    return or_(delivery_status == None, delivery_status != "failed")
+
+def get_messages_after(db: Session, patient_id: int, after_id: int = 0, limit: int = 500, include_archive: bool = False):
+    """
+    Mensagens do paciente com id maior que `after_id`, em ordem de chegada, sem as do
+    profissional que não foram entregues.
+    """
+    if include_archive:
+        timeline = _message_timeline(patient_id)
+        return db.execute(select(timeline).where(timeline.c.id > after_id, _not_failed(timeline.c.delivery_status))
+                          .order_by(timeline.c.id.asc()).limit(limit)).all()
+    return (db.query(models.Message)
+            .filter(models.Message.patient_id == patient_id, models.Message.id > after_id, _not_failed(models.Message.delivery_status))
+            .order_by(models.Message.id.asc())
+            .limit(limit)
+            .all())
+
+def get_conversation_summary(db: Session, patient_id: int):
+    return db.query(models.ConversationSummary).filter(models.ConversationSummary.patient_id == patient_id).first()
+
+def save_conversation_summary(db: Session, patient_id: int, summary: str, last_message_id: int, new_messages: int,
+                              includes_archive: bool = False):
+    """
+    Grava (ou atualiza) o resumo do paciente e a última mensagem coberta por ele.
+    """
+    stored = get_conversation_summary(db, patient_id)
+    if stored is None:
+        stored = models.ConversationSummary(patient_id=patient_id, summary=summary, last_message_id=last_message_id,
+                                            message_count=new_messages, includes_archive=includes_archive)
+        db.add(stored)
+    else:
+        # Resumo refeito desde o início do arquivo: a contagem recomeça
+        if includes_archive and not stored.includes_archive:
+            stored.message_count = 0
+        stored.summary = summary
+        stored.last_message_id = last_message_id
+        stored.message_count += new_messages
+        stored.includes_archive = includes_archive
+    return stored
+
+
+# ### ARQUIVO DE MENSAGENS ###
+# As leituras que incluem o arquivo devolvem linhas (Row) com os mesmos atributos de Message
+
+_MESSAGE_FIELDS = ("id", "patient_id", "text", "sender", "has_alert", "alert_score", "alert_terms", "timestamp", "external_id",
+                   "delivery_status")
+
+def _message_timeline(patient_id: int | None = None, hot: bool = True, cold: bool = True,
+                      patient_ids: list[int] | None = None):
+    """
+    UNION ALL das mensagens em uso e das arquivadas (filtradas por paciente em cada lado,
+    para que cada consulta use o índice de linha do tempo da sua tabela).
+    """
+    selects = []
+    for model, included in ((models.Message, hot), (models.ArchivedMessage, cold)):
+        if not included:
+            continue
+        stmt = select(*(getattr(model, field) for field in _MESSAGE_FIELDS))
+        if patient_id is not None:
+            stmt = stmt.where(model.patient_id == patient_id)
+        if patient_ids is not None:
+            stmt = stmt.where(model.patient_id.in_(patient_ids))
+        selects.append(stmt)
+    return union_all(*selects).subquery("timeline")
+
+def _get_timeline_page(db: Session, patient_id: int, limit: int, before: int | None, after: int | None):
+    timeline = _message_timeline(patient_id)
+    key = tuple_(timeline.c.timestamp, timeline.c.id)
+    stmt = select(timeline)
+    anchor_id = after if after is not None else before
+    if anchor_id is not None:
+        anchor = db.execute(select(timeline.c.timestamp, timeline.c.id).where(timeline.c.id == anchor_id)).first()
+        if anchor is None:
+            return [], False
+        stmt = stmt.where(key > tuple_(*anchor) if after is not None else key < tuple_(*anchor))
+    if after is not None:
+        stmt = stmt.order_by(timeline.c.timestamp.asc(), timeline.c.id.asc())
+    else:
+        stmt = stmt.order_by(timeline.c.timestamp.desc(), timeline.c.id.desc())
+    messages = db.execute(stmt.limit(limit + 1)).all()
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if after is None:
+        messages.reverse()
+    return messages, has_more
+
+def iter_messages_for_export(db: Session, patient_id: int | None = None, since: datetime | None = None,
+                             until: datetime | None = None, include_hot: bool = True, batch_size: int = 1000):
+    """
+    Percorre as mensagens (arquivadas e, com `include_hot`, as em uso) em ordem cronológica,
+    lidas do banco em blocos de `batch_size` por um cursor no servidor. `until` é exclusivo.
+    """
+    timeline = _message_timeline(patient_id, hot=include_hot)
+    stmt = select(timeline)
+    if since is not None:
+        stmt = stmt.where(timeline.c.timestamp >= since)
+    if until is not None:
+        stmt = stmt.where(timeline.c.timestamp < until)
+    stmt = stmt.order_by(timeline.c.timestamp.asc(), timeline.c.id.asc()).execution_options(yield_per=batch_size)
+    yield from db.execute(stmt)
+
+def archive_messages(db: Session, cutoff: datetime, limit: int):
+    """
+    Move para messages_archive até `limit` mensagens anteriores a `cutoff`, na mesma transação.
+    Mensagens com alerta ainda não lido ficam onde estão até o profissional abrir o paciente.
+    Devolve quantas mensagens foram movidas.
+    """
+    Message = models.Message
+    # Os ids crescem com o tempo: as candidatas vêm antes da primeira mensagem recente na chave
+    # primária, e a busca não precisa de um índice por data na tabela mais escrita
+    boundary = select(func.min(Message.id)).where(Message.timestamp >= cutoff).scalar_subquery()
+    ids = db.scalars(select(Message.id)
+                     .where(Message.timestamp < cutoff, Message.has_alert == False, or_(boundary == None, Message.id < boundary))
+                     .order_by(Message.id.asc())
+                     .limit(limit)
+                     .with_for_update(skip_locked=True)).all()
+    if not ids:
+        return 0
+    columns = [getattr(Message, field) for field in _MESSAGE_FIELDS]
+    db.execute(insert(models.ArchivedMessage).from_select(list(_MESSAGE_FIELDS), select(*columns).where(Message.id.in_(ids))))
+    # O envio continua na outbox; a mensagem mantém o id no arquivo
+    db.execute(update(models.OutboundMessage).where(models.OutboundMessage.message_id.in_(ids)).values(message_id=None))
+    db.execute(delete(Message).where(Message.id.in_(ids)))
+    return len(ids)
+
+def get_oldest_message_at(db: Session):
+    # Pela chave primária (sem varrer a tabela): a mensagem mais antiga ainda em uso
+    return db.scalar(select(models.Message.timestamp).order_by(models.Message.id.asc()).limit(1))
+
+
+# ### FILA DE WEBHOOKS ###
+def enqueue_webhook_event(db: Session, payload: str):
+    # Horário da aplicação (não o do banco): base da latência webhook -> painel, com precisão de microssegundos
+    event = models.WebhookEvent(payload=payload, status="pending", received_at=datetime.now(timezone.utc))
+    db.add(event)
+    db.flush()
+    return event.id
+
+def claim_webhook_events(db: Session, limit: int, visibility_timeout: float):
+    """
+    Reserva até `limit` eventos prontos para processamento. No Postgres usa SKIP LOCKED,
+    para que várias instâncias dividam a fila sem processar o mesmo evento. Eventos presos
+    em "processing" além de `visibility_timeout` segundos (ex.: queda do processo) voltam à fila.
+    """
+    Event = models.WebhookEvent
+    now = datetime.now(timezone.utc)
+    stale = now - timedelta(seconds=visibility_timeout)
+    events = (db.query(Event)
+              .filter(((Event.status == "pending") & ((Event.available_at == None) | (Event.available_at <= now)))
+                      | ((Event.status == "processing") & (Event.locked_at < stale)))
+              .order_by(Event.id.asc())
+              .limit(limit)
+              .with_for_update(skip_locked=True)
+              .all())
+    for event in events:
+        event.status = "processing"
+        event.locked_at = now
+        event.attempts += 1
+    return [(event.id, event.payload, event.attempts, event.received_at) for event in events]
+
+def complete_webhook_event(db: Session, event_id: int):
+    db.query(models.WebhookEvent).filter(models.WebhookEvent.id == event_id).update(
+        {"status": "done", "processed_at": datetime.now(timezone.utc), "last_error": None}, synchronize_session=False)
+
+def fail_webhook_event(db: Session, event_id: int, error: str, retry_in: float | None):
+    """
+    Registra a falha; com `retry_in` o evento volta para a fila após esse intervalo, sem ele é descartado.
+    """
+    values = {"last_error": error[:1000]}
+    if retry_in is None:
+        values.update(status="failed", processed_at=datetime.now(timezone.utc))
+    else:
+        values.update(status="pending", available_at=datetime.now(timezone.utc) + timedelta(seconds=retry_in))
+    db.query(models.WebhookEvent).filter(models.WebhookEvent.id == event_id).update(values, synchronize_session=False)
+
+def purge_webhook_events(db: Session, older_than: timedelta):
+    """
+    Remove eventos já processados com sucesso há mais de `older_than`.
+    """
+    cutoff = datetime.now(timezone.utc) - older_than
+    deleted = db.query(models.WebhookEvent).filter(models.WebhookEvent.status == "done", models.WebhookEvent.processed_at < cutoff).delete(synchronize_session=False)
+    return deleted
+
+def get_webhook_queue_stats(db: Session):
+    Event = models.WebhookEvent
+    counts = dict(db.query(Event.status, func.count(Event.id)).filter(Event.status.in_(["pending", "processing", "failed"])).group_by(Event.status).all())
+    oldest = db.query(func.min(Event.received_at)).filter(Event.status.in_(["pending", "processing"])).scalar()
+    return counts, oldest
+
+
+# ### OUTBOX DE ENVIOS ###
+# Ordem dos estados de um envio; callbacks atrasados nunca fazem o estado regredir
+OUTBOUND_STATUS_RANK = {"pending": 0, "sending": 1, "sent": 2, "delivered": 3, "read": 4, "failed": 5}
+OUTBOUND_STATUS_TIME_COLUMN = {"sent": "sent_at", "delivered": "delivered_at", "read": "read_at"}
+
+def _add_outbound_message(db: Session, idempotency_key: str, to_number: str, text: str, source: str,
+                          patient_id: int | None = None, message_id: int | None = None):
+    Outbound = models.OutboundMessage
+    stmt = (_insert(db, Outbound)
+            .values(idempotency_key=idempotency_key, to_number=to_number, text=text, source=source,
+                    patient_id=patient_id, message_id=message_id, status="pending", attempts=0)
+            .on_conflict_do_nothing(index_elements=["idempotency_key"])
+            .returning(Outbound))
+    return db.scalars(stmt).first()
+
+def enqueue_outbound_message(db: Session, idempotency_key: str, to_number: str, text: str, source: str, patient_id: int | None = None):
+    """
+    Registra um envio na outbox. Se a chave de idempotência já foi usada, devolve o envio existente.
+    """
+    outbound = _add_outbound_message(db, idempotency_key, to_number, text, source, patient_id=patient_id)
+    if outbound is None:
+        outbound = db.query(models.OutboundMessage).filter(models.OutboundMessage.idempotency_key == idempotency_key).one()
+    return outbound
+
+def enqueue_outbound_batch(db: Session, rows: list[dict]):
+    """
+    Registra vários envios de uma vez (chaves já existentes são ignoradas) e devolve os ids
+    dos envios deste lote que ainda estão pendentes.
+    """
+    if not rows:
+        return []
+    Outbound = models.OutboundMessage
+    db.execute(_insert(db, Outbound.__table__).values([{"status": "pending", "attempts": 0, **row} for row in rows])
+               .on_conflict_do_nothing(index_elements=["idempotency_key"]))
+    keys = [row["idempotency_key"] for row in rows]
+    ids = [outbound_id for (outbound_id,) in db.query(Outbound.id).filter(Outbound.idempotency_key.in_(keys), Outbound.status == "pending").order_by(Outbound.id)]
+    return ids
+
+def count_outbound_by_status(db: Session, idempotency_keys: list[str], status: str):
+    Outbound = models.OutboundMessage
+    return db.scalar(select(func.count()).where(Outbound.idempotency_key.in_(idempotency_keys), Outbound.status == status))
+
+def create_professional_message(db: Session, patient_id: int, text: str, idempotency_key: str):
+    """
+    Grava a mensagem do profissional (com delivery_status "pending") e o envio correspondente na
+    outbox na mesma transação. Uma repetição com a mesma chave devolve o par já existente, com o
+    estado atual do envio. Devolve None se o paciente não existe.
+    """
+    existing = db.query(models.OutboundMessage).filter(models.OutboundMessage.idempotency_key == idempotency_key).first()
+    if existing is not None:
+        return existing, db.get(models.Message, existing.message_id)
+    patient = db.query(models.Patient).filter(models.Patient.id == patient_id).first()
+    if not patient:
+        return None
+    outbound = _add_outbound_message(db, idempotency_key, patient.phone_number, text, "manual", patient_id=patient.id)
+    if outbound is None:
+        # Outra requisição com a mesma chave gravou primeiro (o ON CONFLICT espera a
+        # transação dela terminar, então a nova consulta já enxerga o envio gravado)
+        return create_professional_message(db, patient_id, text, idempotency_key)
+    db_message = create_message(db, patient_id=patient.id, text=text, has_alert=False, sender="professional",
+                                delivery_status="pending")
+    outbound.message_id = db_message.id
+    return outbound, db_message
+
+def claim_outbound_message(db: Session, outbound_id: int):
+    """
+    Passa o envio de "pending" para "sending" de forma atômica. Só quem reservou envia;
+    devolve (número, texto, tentativas) ou None se o envio já foi feito ou está em andamento.
+    """
+    Outbound = models.OutboundMessage
+    row = db.execute(update(Outbound)
+                     .where(Outbound.id == outbound_id, Outbound.status == "pending")
+                     .values(status="sending", sending_at=datetime.now(timezone.utc), attempts=Outbound.attempts + 1)
+                     .returning(Outbound.to_number, Outbound.text, Outbound.attempts)).first()
+    return tuple(row) if row else None
+
+def record_outbound_result(db: Session, outbound_id: int, ok: bool, wa_message_id: str | None = None,
+                           error: str | None = None, retry_in: float | None = None):
+    """
+    Registra o resultado do envio. Falhas com `retry_in` voltam para "pending" e serão tentadas de novo.
+    A mensagem do profissional ligada ao envio passa a "sent" (e entra nos indicadores de engajamento,
+    no horário em que foi escrita) ou, em falha definitiva, a "failed". Um lembrete enviado também
+    entra nos indicadores do paciente.
+    """
+    now = datetime.now(timezone.utc)
+    if ok:
+        values = {"status": "sent", "sent_at": now, "wa_message_id": wa_message_id, "last_error": None}
+    elif retry_in is not None:
+        values = {"status": "pending", "next_attempt_at": now + timedelta(seconds=retry_in), "last_error": (error or "")[:1000]}
+    else:
+        values = {"status": "failed", "last_error": (error or "")[:1000]}
+    Outbound = models.OutboundMessage
+    sent = db.execute(update(Outbound).where(Outbound.id == outbound_id).values(values)
+                      .returning(Outbound.source, Outbound.patient_id, Outbound.message_id),
+                      execution_options={"synchronize_session": False}).first()
+    if sent is None:
+        return
+    if sent.message_id is not None:
+        if ok:
+            Message = models.Message
+            message = db.execute(update(Message).where(Message.id == sent.message_id).values(delivery_status="sent")
+                                 .returning(Message.patient_id, Message.timestamp),
+                                 execution_options={"synchronize_session": False}).first()
+            _record_message_engagement(db, message.patient_id, "professional", False, _as_utc(message.timestamp))
+        elif retry_in is None:
+            _mark_messages_failed(db, [sent.message_id])
+    if ok and sent.source in REMINDER_SOURCES and sent.patient_id is not None:
+        record_reminder_sent(db, sent.patient_id, now)
+
+def _mark_messages_failed(db: Session, message_ids: list[int]):
+    """
+    Marca as mensagens do profissional como não enviadas e devolve a última atividade de cada
+    paciente à mensagem anterior, para que a lista não mostre um texto que o paciente não recebeu.
+    """
+    Message, Patient = models.Message, models.Patient
+    patient_ids = db.scalars(update(Message).where(Message.id.in_(message_ids)).values(delivery_status="failed")
+                             .returning(Message.patient_id), execution_options={"synchronize_session": False}).all()
+    for patient_id in set(patient_ids):
+        last = db.execute(select(Message.timestamp, Message.text)
+                          .where(Message.patient_id == patient_id, _not_failed(Message.delivery_status))
+                          .order_by(Message.timestamp.desc(), Message.id.desc()).limit(1)).first()
+        values = {"last_message_at": last.timestamp, "last_message_preview": last.text[:MESSAGE_PREVIEW_LENGTH]} if last else {"last_message_preview": None}
+        db.execute(update(Patient).where(Patient.id == patient_id).values(values), execution_options={"synchronize_session": False})
+
+def get_outbound_state(db: Session, outbound_id: int):
+    """
+    (envio, mensagem do profissional, paciente) de um envio da outbox, para responder ao profissional.
+    """
+    outbound = db.get(models.OutboundMessage, outbound_id)
+    message = db.get(models.Message, outbound.message_id) if outbound.message_id is not None else None
+    return outbound, message, db.get(models.Patient, outbound.patient_id)
+
+def get_due_outbound_ids(db: Session, limit: int, orphan_age: timedelta = timedelta(minutes=1)):
+    """
+    Envios pendentes prontos para nova tentativa. Envios novos (sem tentativas) só entram depois de
+    `orphan_age`, para não disputar com quem os acabou de registrar e vai enviá-los em seguida.
+    """
+    Outbound = models.OutboundMessage
+    now = datetime.now(timezone.utc)
+    return [outbound_id for (outbound_id,) in db.query(Outbound.id)
+            .filter(Outbound.status == "pending",
+                    (Outbound.attempts > 0) | (Outbound.created_at < now - orphan_age),
+                    (Outbound.next_attempt_at == None) | (Outbound.next_attempt_at <= now))
+            .order_by(Outbound.id).limit(limit)]
+
+def fail_stale_outbound_messages(db: Session, timeout: timedelta):
+    """
+    Envios presos em "sending" (queda do processo no meio do envio) não são repetidos, pois a
+    mensagem pode ter saído: ficam como "failed" para revisão.
+    """
+    Outbound = models.OutboundMessage
+    cutoff = datetime.now(timezone.utc) - timeout
+    message_ids = db.scalars(update(Outbound).where(Outbound.status == "sending", Outbound.sending_at < cutoff)
+                             .values(status="failed", last_error="Envio interrompido; não repetido para evitar duplicidade.")
+                             .returning(Outbound.message_id), execution_options={"synchronize_session": False}).all()
+    failed_messages = [message_id for message_id in message_ids if message_id is not None]
+    if failed_messages:
+        _mark_messages_failed(db, failed_messages)
+    return len(message_ids)
+
+def apply_outbound_statuses(db: Session, statuses: list[dict]):
+    """
+    Aplica os callbacks de status da Meta (value.statuses[]) aos envios da outbox, com uma
+    atualização em lote por tipo de status.
+    """
+    latest: dict[str, dict] = {}
+    for status in statuses:
+        wa_id, name = status.get("id"), status.get("status")
+        if not wa_id or name not in OUTBOUND_STATUS_TIME_COLUMN and name != "failed":
+            continue
+        current = latest.get(wa_id)
+        if current is None or OUTBOUND_STATUS_RANK[name] >= OUTBOUND_STATUS_RANK[current["status"]]:
+            latest[wa_id] = status
+    by_status: dict[str, list[dict]] = {}
+    for wa_id, status in latest.items():
+        timestamp = datetime.fromtimestamp(int(status.get("timestamp") or datetime.now(timezone.utc).timestamp()), tz=timezone.utc)
+        errors = status.get("errors") or [{}]
+        error = errors[0].get("title") or errors[0].get("message")
+        by_status.setdefault(status["status"], []).append({"b_wa_id": wa_id, "b_time": timestamp, "b_error": error})
+    table = models.OutboundMessage.__table__
+    for name, params in by_status.items():
+        previous = [s for s, rank in OUTBOUND_STATUS_RANK.items() if rank < OUTBOUND_STATUS_RANK[name]]
+        values = {"status": name}
+        if name == "failed":
+            values["last_error"] = bindparam("b_error")
+        else:
+            values[OUTBOUND_STATUS_TIME_COLUMN[name]] = bindparam("b_time")
+        stmt = update(table).where(table.c.wa_message_id == bindparam("b_wa_id"), table.c.status.in_(previous)).values(values)
+        db.execute(stmt, params)
+        if name == "failed":
+            # A Meta recusou depois de aceitar: a mensagem do profissional não chegou ao paciente
+            message_ids = db.scalars(select(table.c.message_id).where(table.c.wa_message_id.in_([p["b_wa_id"] for p in params]),
+                                                                      table.c.status == "failed", table.c.message_id != None)).all()
+            if message_ids:
+                _mark_messages_failed(db, message_ids)
+    return len(latest)
+
+
+
+# ### LEMBRETES AGENDADOS ###
+def get_patient_schedules(db: Session, patient_id: int):
+    return db.query(models.ReminderSchedule).filter(models.ReminderSchedule.patient_id == patient_id).order_by(models.ReminderSchedule.id).all()
+
+def get_schedule(db: Session, schedule_id: int):
+    return db.get(models.ReminderSchedule, schedule_id)
+
+def create_schedule(db: Session, patient_id: int, **fields):
+    """
+    Cria uma agenda para o paciente. Devolve None se o paciente não existe.
+    """
+    if db.get(models.Patient, patient_id) is None:
+        return None
+    schedule = models.ReminderSchedule(patient_id=patient_id, **fields)
+    db.add(schedule)
+    db.flush()
+    return schedule
+
+def ensure_default_schedules(db: Session, send_time: str, timezone_name: str, next_run_at: datetime,
+                             patient_ids: list[int] | None = None):
+    """
+    Cria, com um único INSERT ... SELECT, a agenda padrão (diária) dos pacientes que ainda
+    não têm nenhuma agenda (só entre `patient_ids`, se informados). Devolve quantas foram criadas.
+    """
+    Schedule, Patient = models.ReminderSchedule, models.Patient
+    without_schedule = (select(Patient.id, literal(send_time), literal(timezone_name), literal("daily"), literal(True), literal(True),
+                               literal(True), literal(next_run_at, DateTime(timezone=True)))
+                        .where(~exists().where(Schedule.patient_id == Patient.id)))
+    if patient_ids is not None:
+        without_schedule = without_schedule.where(Patient.id.in_(patient_ids))
+    stmt = (_insert(db, Schedule.__table__)
+            .from_select(["patient_id", "send_time", "timezone", "recurrence", "active", "skip_manual", "is_default", "next_run_at"], without_schedule)
+            .on_conflict_do_nothing(index_elements=["patient_id"], index_where=Schedule.is_default == True))
+    return db.execute(stmt).rowcount
+
+def get_upcoming_schedules(db: Session, until: datetime):
+    """
+    (id, next_run_at) das agendas ativas com ocorrência até `until`, pelo índice ix_reminder_schedules_due.
+    """
+    Schedule = models.ReminderSchedule
+    return db.query(Schedule.id, Schedule.next_run_at).filter(Schedule.active == True, Schedule.next_run_at <= until).all()
+
+def lock_due_schedules(db: Session, schedule_ids: list[int], now: datetime):
+    """
+    Reserva as agendas (com os pacientes) que continuam vencidas. No Postgres usa SKIP LOCKED,
+    para que duas instâncias não processem a mesma ocorrência ao mesmo tempo.
+    """
+    Schedule = models.ReminderSchedule
+    return (db.query(Schedule, models.Patient)
+            .join(models.Patient, models.Patient.id == Schedule.patient_id)
+            .filter(Schedule.id.in_(schedule_ids), Schedule.active == True, Schedule.next_run_at <= now)
+            .order_by(Schedule.id)
+            .with_for_update(skip_locked=True, of=Schedule)
+            .all())
+
+# ### BUSCA NAS MENSAGENS ###
+
+_WORD = re.compile(r"\w+")
+
+def _fts5_query(query: str) -> str | None:
+    # Aspas e operadores soltos são erro de sintaxe no MATCH do FTS5: cada palavra vira um
+    # prefixo entre aspas ("febre"* encontra também "febres"), todas obrigatórias
+    words = _WORD.findall(query)
+    return " ".join(f'"{word}"*' for word in words) if words else None
+
+def _as_utc(value: datetime) -> datetime:
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+def search_messages(db: Session, query: str, patient_id: int | None = None, sender: str | None = None,
+                    since: datetime | None = None, until: datetime | None = None, has_alert: bool | None = None,
+                    limit: int = 50, cursor: str | None = None, alert_threshold: float = 1.0):
+    """
+    Busca textual nas mensagens de todos os pacientes, das mais relevantes para as menos, usando
+    o índice criado por `ensure_search_index` (tsvector/GIN no Postgres, FTS5 no SQLite). Datas
+    sem fuso são tratadas como UTC. `has_alert` considera também os alertas já lidos (pela
+    pontuação gravada, como em iter_engagement_events). Devolve ([(mensagem, nome do paciente, relevância)], cursor
+    da próxima página).
+    """
+    Message, Patient = models.Message, models.Patient
+    if db.get_bind().dialect.name == "postgresql":
+        # websearch_to_tsquery aceita a sintaxe de buscador: "frase exata", OR e -palavra
+        tsquery = func.websearch_to_tsquery(literal_column(f"'{SEARCH_TS_CONFIG}'::regconfig"), query)
+        vector = literal_column("messages.search_vector")
+        # ts_rank devolve real; em double precision o valor volta exato no cursor da próxima página
+        score = cast(func.ts_rank(vector, tsquery), Double)
+        stmt = select(Message, Patient.name, score).where(vector.op("@@")(tsquery))
+    else:
+        terms = _fts5_query(query)
+        if terms is None:
+            return [], None
+        fts = table("messages_fts", column("rowid"))
+        # O bm25 é menor para os melhores resultados; com o sinal invertido a ordem é a mesma do Postgres
+        score = -func.bm25(literal_column("messages_fts"))
+        stmt = (select(Message, Patient.name, score).join(fts, fts.c.rowid == Message.id)
+                .where(literal_column("messages_fts").op("MATCH")(terms)))
+    stmt = stmt.join(Patient, Patient.id == Message.patient_id)
+    if patient_id is not None:
+        stmt = stmt.where(Message.patient_id == patient_id)
+    if sender is not None:
+        stmt = stmt.where(Message.sender == sender)
+    if since is not None:
+        stmt = stmt.where(Message.timestamp >= _as_utc(since))
+    if until is not None:
+        stmt = stmt.where(Message.timestamp <= _as_utc(until))
+    if has_alert is not None:
+        # has_alert é desmarcado quando o profissional abre o paciente; a pontuação fica
+        alerted = or_(Message.has_alert == True, Message.alert_score >= alert_threshold)
+        stmt = stmt.where(alerted if has_alert else ~alerted)
+    if cursor:
+        try:
+            last_score, last_id = _decode_cursor(cursor)
+            last_score, last_id = float(last_score), int(last_id)
+        except (ValueError, TypeError) as e:
+            raise ValueError("Cursor inválido") from e
+        stmt = stmt.where(tuple_(score, Message.id) < tuple_(last_score, last_id))
+    rows = db.execute(stmt.order_by(score.desc(), Message.id.desc()).limit(limit + 1)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor([rows[-1][2], rows[-1][0].id])
+    return [tuple(row) for row in rows], next_cursor
+
+
+# ### INDICADORES DE ENGAJAMENTO ###
+# Os contadores de PatientDailyStats são somados a cada evento (mensagem ou lembrete enviado),
+# na mesma transação: o painel de indicadores nunca lê as mensagens
+
+# Dia dos contadores no fuso da clínica (o mesmo dos lembretes, se não for definido)
+ANALYTICS_TIMEZONE = os.getenv("ANALYTICS_TIMEZONE", os.getenv("DEFAULT_REMINDER_TIMEZONE", "America/Sao_Paulo"))
+_ANALYTICS_ZONE = ZoneInfo(ANALYTICS_TIMEZONE)
+# Uma mensagem do paciente até esse prazo depois do lembrete conta como resposta a ele
+REMINDER_REPLY_WINDOW = timedelta(hours=float(os.getenv("REMINDER_REPLY_WINDOW_HOURS", "24")))
+# Origens da outbox que são lembretes: as agendas por paciente e o disparo diário em massa
+REMINDER_SOURCES = ("schedule", "daily")
+DAILY_STATS_COUNTERS = ("patient_messages", "professional_messages", "alert_messages", "reminders_sent",
+                        "reminders_answered", "professional_replies", "professional_response_seconds")
+
+def analytics_day(moment: datetime) -> date:
+    return _as_utc(moment).astimezone(_ANALYTICS_ZONE).date()
+
+def _add_daily_stats(db: Session, patient_id: int, day: date, counters: dict):
+    # Um INSERT ... ON CONFLICT DO UPDATE: a primeira mensagem do dia cria a linha, as seguintes somam
+    Stats = models.PatientDailyStats
+    stmt = _insert(db, Stats).values(patient_id=patient_id, day=day, **counters)
+    stmt = stmt.on_conflict_do_update(index_elements=["patient_id", "day"],
+                                      set_={name: getattr(Stats, name) + stmt.excluded[name] for name in counters})
+    db.execute(stmt)
+
+def _clear_patient_state(db: Session, column, patient_id: int, seen: datetime) -> bool:
+    # Só quem encontrou o valor lido é que o limpa: com duas mensagens simultâneas, uma única conta a transição
+    Patient = models.Patient
+    result = db.execute(update(Patient).where(Patient.id == patient_id, column == seen).values({column: None}),
+                        execution_options={"synchronize_session": False})
+    return result.rowcount == 1
+
+def _record_message_engagement(db: Session, patient_id: int, sender: str, has_alert: bool, now: datetime):
+    """
+    Soma a mensagem aos contadores do dia. A do paciente responde ao lembrete pendente (contado
+    no dia do lembrete); a do profissional encerra a espera do paciente e soma o tempo de resposta.
+    """
+    # Em geral o paciente já está na sessão (get_or_create_patient), sem nova consulta
+    patient = db.get(models.Patient, patient_id)
+    today = analytics_day(now)
+    counters = {"patient_messages" if sender == "patient" else "professional_messages": 1}
+    if has_alert:
+        counters["alert_messages"] = 1
+    if sender == "patient":
+        reminder_at = patient.pending_reminder_at
+        if (reminder_at is not None and _clear_patient_state(db, models.Patient.pending_reminder_at, patient_id, reminder_at)
+                and now - _as_utc(reminder_at) <= REMINDER_REPLY_WINDOW):
+            if analytics_day(reminder_at) == today:
+                counters["reminders_answered"] = 1
+            else:
+                _add_daily_stats(db, patient_id, analytics_day(reminder_at), {"reminders_answered": 1})
+    else:
+        waiting_since = patient.awaiting_reply_since
+        if waiting_since is not None and _clear_patient_state(db, models.Patient.awaiting_reply_since, patient_id, waiting_since):
+            counters["professional_replies"] = 1
+            counters["professional_response_seconds"] = max(0.0, (now - _as_utc(waiting_since)).total_seconds())
+    _add_daily_stats(db, patient_id, today, counters)
+
+def record_reminder_sent(db: Session, patient_id: int, sent_at: datetime):
+    """
+    Conta o lembrete no dia do envio e o deixa pendente até a próxima mensagem do paciente.
+    """
+    Patient = models.Patient
+    db.execute(update(Patient).where(Patient.id == patient_id).values(pending_reminder_at=sent_at),
+               execution_options={"synchronize_session": False})
+    _add_daily_stats(db, patient_id, analytics_day(sent_at), {"reminders_sent": 1})
+
+def get_engagement_stats(db: Session, since: date, until: date, patient_id: int | None = None):
+    """
+    Indicadores dos dias [since, until] lidos só de patient_daily_stats e patients: o custo cresce
+    com pacientes × dias, não com o volume de mensagens. Devolve (uma linha por paciente, com os
+    contadores somados no período, e uma linha por dia com os totais de todos os pacientes).
+    """
+    Stats, Patient = models.PatientDailyStats, models.Patient
+    in_period = [Stats.day >= since, Stats.day <= until]
+    if patient_id is not None:
+        in_period.append(Stats.patient_id == patient_id)
+    sums = [func.sum(getattr(Stats, name)).label(name) for name in DAILY_STATS_COUNTERS]
+    alert_days = func.sum(case((Stats.alert_messages > 0, 1), else_=0)).label("alert_days")
+    per_patient = select(Stats.patient_id, alert_days, *sums).where(*in_period).group_by(Stats.patient_id).subquery()
+    stmt = (select(Patient.id, Patient.name, Patient.phone_number, Patient.last_patient_message_at,
+                   *(func.coalesce(per_patient.c[name], 0).label(name) for name in ("alert_days",) + DAILY_STATS_COUNTERS))
+            .outerjoin(per_patient, per_patient.c.patient_id == Patient.id)
+            .order_by(Patient.id))
+    if patient_id is not None:
+        stmt = stmt.where(Patient.id == patient_id)
+    patients = db.execute(stmt).all()
+    daily = db.execute(select(Stats.day, *sums).where(*in_period).group_by(Stats.day).order_by(Stats.day)).all()
+    return patients, daily
+
+def iter_engagement_events(db: Session, patient_ids: list[int], alert_threshold: float, batch_size: int = 5000):
+    """
+    Eventos que alimentam os contadores, em ordem (paciente, horário), para reconstruí-los do
+    histórico: mensagens em uso e arquivadas e lembretes enviados, lidos em blocos por cursores
+    no servidor. Gera (patient_id, horário, tipo, alerta) com tipo "patient", "professional" ou
+    "reminder". O alerta lido já foi desmarcado na mensagem: conta a pontuação gravada. Mensagens
+    do profissional ainda não enviadas ou que falharam não contam, como em record_outbound_result.
+    """
+    timeline = _message_timeline(patient_ids=patient_ids)
+    messages = db.execute(select(timeline.c.patient_id, timeline.c.timestamp, timeline.c.sender,
+                                 or_(timeline.c.has_alert == True, timeline.c.alert_score >= alert_threshold))
+                          .where(or_(timeline.c.delivery_status == None, timeline.c.delivery_status.notin_(("pending", "failed"))))
+                          .order_by(timeline.c.patient_id, timeline.c.timestamp, timeline.c.id)
+                          .execution_options(yield_per=batch_size))
+    Outbound = models.OutboundMessage
+    reminders = db.execute(select(Outbound.patient_id, Outbound.sent_at)
+                           .where(Outbound.patient_id.in_(patient_ids), Outbound.source.in_(REMINDER_SOURCES),
+                                  Outbound.sent_at != None)
+                           .order_by(Outbound.patient_id, Outbound.sent_at, Outbound.id)
+                           .execution_options(yield_per=batch_size))
+    message_events = ((patient_id, _as_utc(at), "patient" if sender == "patient" else "professional", bool(alert))
+                      for patient_id, at, sender, alert in messages)
+    reminder_events = ((patient_id, _as_utc(at), "reminder", False) for patient_id, at in reminders)
+    yield from heapq.merge(message_events, reminder_events, key=lambda event: event[:2])
+
+def replace_engagement_stats(db: Session, patient_ids: list[int], days: dict, states: dict):
+    """
+    Substitui os contadores e o estado de engajamento dos pacientes pelos reconstruídos:
+    `days` é {(patient_id, dia): contadores} e `states` é {patient_id: valores das colunas de Patient}.
+    """
+    Stats, Patient = models.PatientDailyStats, models.Patient
+    db.execute(delete(Stats).where(Stats.patient_id.in_(patient_ids)))
+    if days:
+        db.execute(insert(Stats), [{"patient_id": patient_id, "day": day, **counters} for (patient_id, day), counters in days.items()])
+    empty = {"last_patient_message_at": None, "awaiting_reply_since": None, "pending_reminder_at": None}
+    db.execute(update(Patient), [{"id": patient_id, **empty, **states.get(patient_id, {})} for patient_id in patient_ids])
+
 
 # ### NOVAS FUNÇÕES CRUD PARA O PROFISSIONAL ###
 def get_professional_by_email(db: Session, email: str):
@@ -43,7 +848,6 @@ def get_professional_by_email(db: Session, email: str):
 def create_professional(db: Session, email: str, hashed_password: str):
     db_professional = models.Professional(email=email, hashed_password=hashed_password)
     db.add(db_professional)
-    db.commit()
-    db.refresh(db_professional)
+    db.flush()
     return db_professional
 # ###########################################
\ No newline at end of file
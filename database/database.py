@@ -1,5 +1,9 @@
 import os
-from sqlalchemy import create_engine
+import logging
+from sqlalchemy import create_engine, inspect, make_url, text
+from sqlalchemy.engine import URL
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -9,8 +13,52 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if DATABASE_URL and DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Pool de conexões (por engine; cada processo tem um engine síncrono e um assíncrono)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Recicla conexões antes que o Postgres gerenciado ou um proxy as derrube por inatividade
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+# Configuração de texto do Postgres usada na busca: a 'portuguese' (stemming e stopwords) com
+# unaccent antes do stemming, para ignorar acentos como o FTS5 do SQLite
+SEARCH_TS_CONFIG = "portuguese_unaccent"
+
+SYNC_DRIVERS = {"postgresql": "psycopg2"}
+ASYNC_DRIVERS = {"postgresql": "asyncpg", "sqlite": "aiosqlite"}
+
+logger = logging.getLogger(__name__)
+
+
+def _with_driver(url: str, drivers: dict) -> URL:
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend in drivers:
+        parsed = parsed.set(drivername=f"{backend}+{drivers[backend]}")
+    if parsed.drivername == "postgresql+asyncpg" and "sslmode" in parsed.query:
+        # O asyncpg recebe o modo de SSL como "ssl", não "sslmode"
+        query = dict(parsed.query)
+        query["ssl"] = query.pop("sslmode")
+        parsed = parsed.set(query=query)
+    return parsed
+
+def _engine_options(url: URL) -> dict:
+    options = {"pool_pre_ping": DB_POOL_PRE_PING}
+    if url.get_backend_name() != "sqlite":
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                       pool_timeout=DB_POOL_TIMEOUT, pool_recycle=DB_POOL_RECYCLE)
+    return options
+
+
+SYNC_DATABASE_URL = _with_driver(DATABASE_URL, SYNC_DRIVERS)
+ASYNC_DATABASE_URL = _with_driver(DATABASE_URL, ASYNC_DRIVERS)
+
+engine = create_engine(SYNC_DATABASE_URL, **_engine_options(SYNC_DATABASE_URL))
+# expire_on_commit=False: os objetos devolvidos continuam legíveis depois do commit, sem nova consulta
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **_engine_options(ASYNC_DATABASE_URL))
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 def get_db():
@@ -19,3 +67,132 @@ def get_db():
         yield db
     finally:
         db.close()
+
+def with_session(fn, *args, **kwargs):
+    """
+    Executa `fn(db, ...)` em uma única transação, confirmada ao final (desfeita em caso de erro).
+    As funções do crud não fazem commit, então várias delas podem ser combinadas em uma só `fn`.
+    """
+    with SessionLocal.begin() as db:
+        return fn(db, *args, **kwargs)
+
+async def run_in_transaction(fn, *args, **kwargs):
+    """
+    Versão assíncrona de `with_session`: executa as mesmas funções do crud em uma única
+    transação sobre o engine assíncrono (asyncpg/aiosqlite), sem ocupar threads nem
+    bloquear o loop de eventos.
+    """
+    async with AsyncSessionLocal.begin() as db:
+        return await db.run_sync(fn, *args, **kwargs)
+
+# Índices substituídos por outros nos modelos, removidos dos bancos existentes
+DROPPED_INDEXES = ("ix_patients_inbox_order",)
+
+def _lock_schema(conn, name: str):
+    # Vários workers sobem juntos: no Postgres, um de cada vez altera o esquema (até o fim da transação)
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": name})
+
+def upgrade_schema():
+    """
+    Cria as tabelas que faltam e, como `create_all` não altera tabelas existentes, adiciona as
+    colunas e índices novos dos modelos que ainda não existem no banco, remove os índices de
+    DROPPED_INDEXES e devolve as colunas criadas ("tabela.coluna"). O esquema é inspecionado
+    depois de obtida a trava: os workers que esperaram já encontram as colunas criadas.
+    """
+    added = set()
+    with engine.begin() as conn:
+        _lock_schema(conn, "upgrade_schema")
+        Base.metadata.create_all(bind=conn)
+        inspector = inspect(conn)
+        for name in DROPPED_INDEXES:
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=engine.dialect)}"
+                # Apenas padrões constantes: o SQLite não aceita expressões como now() em ADD COLUMN
+                if column.server_default is not None and isinstance(column.server_default.arg, str):
+                    ddl += f" DEFAULT '{column.server_default.arg}'"
+                    if not column.nullable:
+                        ddl += " NOT NULL"
+                conn.execute(text(ddl))
+                added.add(f"{table.name}.{column.name}")
+            # IF NOT EXISTS: a inspeção do SQLite não lista índices de expressão
+            for index in table.indexes:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+    return added
+
+def _ensure_search_config(conn) -> bool:
+    """
+    Cria SEARCH_TS_CONFIG no Postgres e liga o dicionário unaccent às palavras. Sem a extensão
+    unaccent no servidor, a configuração fica igual à 'portuguese' até que ela seja instalada.
+    Devolve True se a configuração mudou: os vetores já gravados precisam ser refeitos.
+    """
+    changed = False
+    if conn.execute(text("SELECT 1 FROM pg_ts_config WHERE cfgname = :name"), {"name": SEARCH_TS_CONFIG}).first() is None:
+        conn.execute(text(f"CREATE TEXT SEARCH CONFIGURATION {SEARCH_TS_CONFIG} (COPY = portuguese)"))
+        changed = True
+    with_unaccent = conn.execute(text(
+        "SELECT 1 FROM pg_ts_config_map m JOIN pg_ts_dict d ON d.oid = m.mapdict "
+        "WHERE m.mapcfg = CAST(:name AS regconfig) AND d.dictname = 'unaccent'"), {"name": SEARCH_TS_CONFIG}).first()
+    if with_unaccent is not None:
+        return changed
+    if conn.execute(text("SELECT 1 FROM pg_available_extensions WHERE name = 'unaccent'")).first() is None:
+        logger.warning("Extensão unaccent indisponível no Postgres: a busca diferencia palavras com e sem acento.")
+        return changed
+    conn.execute(text("CREATE EXTENSION IF NOT EXISTS unaccent"))
+    conn.execute(text(f"ALTER TEXT SEARCH CONFIGURATION {SEARCH_TS_CONFIG} "
+                      "ALTER MAPPING FOR hword, hword_part, word WITH unaccent, portuguese_stem"))
+    return True
+
+def ensure_search_index():
+    """
+    Cria o índice de busca textual das mensagens, mantido pelo próprio banco a cada INSERT,
+    UPDATE e DELETE. No Postgres é uma coluna tsvector gerada com índice GIN (a criação, ou a
+    troca da configuração de texto, reescreve a tabela messages); no SQLite, uma tabela FTS5
+    de conteúdo externo atualizada por triggers. Devolve True se o índice foi criado agora.
+    """
+    with engine.begin() as conn:
+        # Um só worker cria a configuração e a coluna; os outros inspecionam depois dele
+        _lock_schema(conn, "ensure_search_index")
+        inspector = inspect(conn)
+        if engine.dialect.name == "postgresql":
+            exists = "search_vector" in {column["name"] for column in inspector.get_columns("messages")}
+            config_changed = _ensure_search_config(conn)
+            # A coluna gerada não é recalculada quando a configuração muda: é recriada (com o índice)
+            if exists and (config_changed or not conn.execute(text(
+                    "SELECT 1 FROM pg_attrdef d JOIN pg_attribute a ON a.attrelid = d.adrelid AND a.attnum = d.adnum "
+                    "WHERE a.attrelid = 'messages'::regclass AND a.attname = 'search_vector' "
+                    "AND pg_get_expr(d.adbin, d.adrelid) LIKE :config"), {"config": f"%{SEARCH_TS_CONFIG}%"}).first()):
+                conn.execute(text("ALTER TABLE messages DROP COLUMN search_vector"))
+                exists = False
+            created = not exists
+            if created:
+                conn.execute(text(
+                    "ALTER TABLE messages ADD COLUMN search_vector tsvector "
+                    f"GENERATED ALWAYS AS (to_tsvector('{SEARCH_TS_CONFIG}'::regconfig, coalesce(text, ''))) STORED"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_search ON messages USING GIN (search_vector)"))
+            return created
+        if engine.dialect.name != "sqlite":
+            return False
+        created = not inspector.has_table("messages_fts")
+        if created:
+            # remove_diacritics: "febre" encontra "Febre" e "cabeca" encontra "cabeça"
+            conn.execute(text("CREATE VIRTUAL TABLE messages_fts USING fts5(text, content='messages', content_rowid='id', "
+                              "tokenize='unicode61 remove_diacritics 2')"))
+        conn.execute(text("CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+                          "INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text); END"))
+        conn.execute(text("CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN "
+                          "INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text); END"))
+        conn.execute(text("CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages BEGIN "
+                          "INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text); "
+                          "INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text); END"))
+        if created:
+            # Indexa as mensagens que já existiam
+            conn.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+        return created
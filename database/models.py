@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, Date, DateTime, Boolean, Float, JSON, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
@@ -22,9 +22,29 @@ class Patient(Base):
     phone_number = Column(String, unique=True, index=True, nullable=False)
     name = Column(String, nullable=True)
     status = Column(String, default="automatico", nullable=False)
+
+    # Estado mantido por crud.create_message para evitar consultas por paciente no painel
+    unread_alert_count = Column(Integer, default=0, server_default="0", nullable=False)
+    last_message_at = Column(DateTime(timezone=True), server_default=func.now())
+    last_message_preview = Column(String, nullable=True)
+    # Estado do engajamento, também mantido por crud.create_message (ver PatientDailyStats)
+    last_patient_message_at = Column(DateTime(timezone=True), nullable=True)
+    # Primeira mensagem do paciente ainda sem resposta do profissional
+    awaiting_reply_since = Column(DateTime(timezone=True), nullable=True)
+    # Último lembrete enviado que o paciente ainda não respondeu
+    pending_reminder_at = Column(DateTime(timezone=True), nullable=True)
     
     messages = relationship("Message", back_populates="patient")
 
+    @property
+    def has_alert(self):
+        return (self.unread_alert_count or 0) > 0
+
+
+# Ordem da lista do painel: pacientes com alerta primeiro (quantos alertas não importa),
+# depois a atividade mais recente
+Index("ix_patients_inbox", (Patient.unread_alert_count > 0), Patient.last_message_at, Patient.id)
+
 
 class Message(Base):
     __tablename__ = "messages"
@@ -34,6 +54,187 @@ class Message(Base):
     text = Column(String, nullable=False)
     sender = Column(String, default="patient")
     has_alert = Column(Boolean, default=False)
+    # Resultado do alert_detector: pontuação (soma das gravidades) e termos encontrados
+    alert_score = Column(Float, default=0, server_default="0", nullable=False)
+    alert_terms = Column(JSON, nullable=True)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
+    # Id da mensagem no WhatsApp (messages[].id); único para descartar reentregas do webhook
+    external_id = Column(String, unique=True, index=True, nullable=True)
+    # Mensagens do profissional: "pending" até o envio pela outbox, depois "sent" ou "failed"
+    delivery_status = Column(String, nullable=True)
+
+    patient = relationship("Patient", back_populates="messages")
+
+    __table_args__ = (
+        # Histórico paginado por paciente: (patient_id, timestamp, id)
+        Index("ix_messages_patient_timeline", "patient_id", "timestamp", "id"),
+    )
+
+
+# Índice parcial: só as mensagens com alerta pendente, para limpá-las sem varrer o histórico
+Index("ix_messages_unread_alerts", Message.patient_id,
+      postgresql_where=Message.has_alert == True, sqlite_where=Message.has_alert == True)
+
+
+class ArchivedMessage(Base):
+    """
+    Armazenamento frio: mensagens mais antigas que a retenção saem de `messages` para cá
+    (archive.py), com o mesmo id. Só são lidas quando o histórico antigo é pedido explicitamente.
+    """
+    __tablename__ = "messages_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    patient_id = Column(Integer, ForeignKey("patients.id"), nullable=False)
+    text = Column(String, nullable=False)
+    sender = Column(String, default="patient")
+    has_alert = Column(Boolean, default=False)
+    alert_score = Column(Float, default=0, server_default="0", nullable=False)
+    alert_terms = Column(JSON, nullable=True)
+    timestamp = Column(DateTime(timezone=True))
+    external_id = Column(String, nullable=True)
+    delivery_status = Column(String, nullable=True)
+    archived_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_messages_archive_patient_timeline", "patient_id", "timestamp", "id"),
+    )
+
+
+class PatientDailyStats(Base):
+    """
+    Contadores diários de engajamento por paciente (dia no fuso ANALYTICS_TIMEZONE), somados
+    a cada mensagem e a cada lembrete enviado. O painel de indicadores lê só esta tabela;
+    `python analytics.py backfill` a reconstrói a partir do histórico.
+    """
+    __tablename__ = "patient_daily_stats"
+
+    patient_id = Column(Integer, ForeignKey("patients.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    patient_messages = Column(Integer, default=0, server_default="0", nullable=False)
+    professional_messages = Column(Integer, default=0, server_default="0", nullable=False)
+    alert_messages = Column(Integer, default=0, server_default="0", nullable=False)
+    reminders_sent = Column(Integer, default=0, server_default="0", nullable=False)
+    # Lembretes deste dia respondidos pelo paciente dentro de REMINDER_REPLY_WINDOW_HOURS
+    reminders_answered = Column(Integer, default=0, server_default="0", nullable=False)
+    # Respostas do profissional a mensagens pendentes e a soma dos tempos de espera
+    professional_replies = Column(Integer, default=0, server_default="0", nullable=False)
+    professional_response_seconds = Column(Float, default=0, server_default="0", nullable=False)
+
+    __table_args__ = (
+        # Indicadores de um período para todos os pacientes
+        Index("ix_patient_daily_stats_day", "day"),
+    )
+
+
+class WebhookEvent(Base):
+    """
+    Fila durável de webhooks recebidos: o endpoint só grava o payload bruto e os
+    workers de webhook_queue processam em segundo plano.
+    """
+    __tablename__ = "webhook_events"
+
+    id = Column(Integer, primary_key=True, index=True)
+    payload = Column(Text, nullable=False)
+    status = Column(String, default="pending", nullable=False)  # pending, processing, done, failed
+    attempts = Column(Integer, default=0, nullable=False)
+    received_at = Column(DateTime(timezone=True), server_default=func.now())
+    available_at = Column(DateTime(timezone=True), nullable=True)
+    locked_at = Column(DateTime(timezone=True), nullable=True)
+    processed_at = Column(DateTime(timezone=True), nullable=True)
+    last_error = Column(String, nullable=True)
+
+    __table_args__ = (
+        Index("ix_webhook_events_status_id", "status", "id"),
+    )
+
+
+class OutboundMessage(Base):
+    """
+    Outbox de envios pelo WhatsApp. A linha é gravada antes do envio, com uma chave de
+    idempotência única, para que novas tentativas nunca enviem a mesma mensagem duas vezes.
+    """
+    __tablename__ = "outbound_messages"
+
+    id = Column(Integer, primary_key=True, index=True)
+    idempotency_key = Column(String, unique=True, index=True, nullable=False)
+    patient_id = Column(Integer, ForeignKey("patients.id"), nullable=True)
+    # Indexado para que arquivar (apagar) mensagens não varra a outbox a cada linha
+    message_id = Column(Integer, ForeignKey("messages.id"), index=True, nullable=True)
+    to_number = Column(String, nullable=False)
+    text = Column(Text, nullable=False)
+    source = Column(String, nullable=False)  # manual, auto_reply, daily, schedule
+    status = Column(String, default="pending", nullable=False)  # pending, sending, sent, delivered, read, failed
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=True)
+    wa_message_id = Column(String, unique=True, index=True, nullable=True)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    sending_at = Column(DateTime(timezone=True), nullable=True)
+    sent_at = Column(DateTime(timezone=True), nullable=True)
+    delivered_at = Column(DateTime(timezone=True), nullable=True)
+    read_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        Index("ix_outbound_messages_status_id", "status", "id"),
+    )
+
+
+class ConversationSummary(Base):
+    """
+    Último resumo gerado da conversa de um paciente e até qual mensagem ele cobre,
+    para que um novo resumo só precise processar as mensagens seguintes. `includes_archive`
+    indica se o resumo partiu do início do arquivo ou só das mensagens em uso.
+    """
+    __tablename__ = "conversation_summaries"
+
+    id = Column(Integer, primary_key=True, index=True)
+    patient_id = Column(Integer, ForeignKey("patients.id"), unique=True, index=True, nullable=False)
+    summary = Column(Text, nullable=False)
+    last_message_id = Column(Integer, nullable=False)
+    message_count = Column(Integer, default=0, nullable=False)
+    includes_archive = Column(Boolean, default=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class RealtimePayload(Base):
+    """
+    Mensagens do realtime grandes demais para o NOTIFY do Postgres: o PostgresBroker grava o
+    payload aqui e notifica só o id. As linhas expiram depois de alguns minutos.
+    """
+    __tablename__ = "realtime_payloads"
+
+    id = Column(Integer, primary_key=True)
+    payload = Column(Text, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True, nullable=False)
+
+
+class ReminderSchedule(Base):
+    """
+    Lembrete recorrente de um paciente: horário local, fuso, texto e dias da semana.
+    `next_run_at` (UTC) é a próxima ocorrência; `last_occurrence` é a última já enviada
+    (data local), que também compõe a chave de idempotência do envio na outbox.
+    """
+    __tablename__ = "reminder_schedules"
+
+    id = Column(Integer, primary_key=True, index=True)
+    patient_id = Column(Integer, ForeignKey("patients.id"), index=True, nullable=False)
+    send_time = Column(String, nullable=False)  # "HH:MM" no fuso do paciente
+    timezone = Column(String, default="America/Sao_Paulo", nullable=False)
+    template = Column(Text, nullable=True)  # None: lembrete padrão; aceita {nome}
+    recurrence = Column(String, default="daily", nullable=False)  # daily, weekdays ou "mon,wed,fri"
+    active = Column(Boolean, default=True, nullable=False)
+    # Pacientes em atendimento manual não recebem o lembrete automático
+    skip_manual = Column(Boolean, default=True, nullable=False)
+    # Criada automaticamente para pacientes sem nenhuma agenda
+    is_default = Column(Boolean, default=False, nullable=False)
+    next_run_at = Column(DateTime(timezone=True), nullable=True)
+    last_run_at = Column(DateTime(timezone=True), nullable=True)
+    last_occurrence = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
 
-    patient = relationship("Patient", back_populates="messages")
\ No newline at end of file
+    __table_args__ = (
+        Index("ix_reminder_schedules_due", "active", "next_run_at"),
+        # No máximo uma agenda padrão por paciente, mesmo com várias instâncias criando ao mesmo tempo
+        Index("ux_reminder_schedules_default", "patient_id", unique=True,
+              postgresql_where=is_default == True, sqlite_where=is_default == True),
+    )
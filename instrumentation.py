@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import uuid
+import logging
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from sqlalchemy import event
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "json" (uma linha por evento, para o agregador de logs) ou "text" (desenvolvimento local)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Requisições mais lentas que isso saem no log como aviso
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "1.0"))
+# Com vários workers (uvicorn --workers), aponte para um diretório vazio compartilhado por eles
+# para que o /metrics some os valores de todos os processos
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+REQUEST_ID_HEADER = "x-request-id"
+
+logger = logging.getLogger("cuideme.http")
+
+# Identificador da requisição (ou do evento de webhook) em andamento, incluído em todos os logs
+request_id_var: ContextVar[str | None] = ContextVar("request_id", default=None)
+# Momento (epoch) em que o webhook em processamento foi recebido, para a latência ponta a ponta
+webhook_received_at: ContextVar[float | None] = ContextVar("webhook_received_at", default=None)
+_query_stats: ContextVar["_QueryStats | None"] = ContextVar("query_stats", default=None)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+HTTP_REQUESTS = Counter("http_requests_total", "Requisições HTTP por rota e status.", ["method", "route", "status"])
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "Latência das requisições HTTP.", ["method", "route"],
+                         buckets=LATENCY_BUCKETS)
+HTTP_DB_QUERIES = Histogram("http_request_db_queries", "Consultas SQL por requisição (N+1 aparece aqui).", ["route"],
+                            buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100))
+HTTP_DB_SECONDS = Histogram("http_request_db_seconds", "Tempo gasto em SQL por requisição.", ["route"], buckets=LATENCY_BUCKETS)
+DB_QUERY_SECONDS = Histogram("db_query_duration_seconds", "Duração de cada consulta SQL.", ["operation"], buckets=LATENCY_BUCKETS)
+WHATSAPP_REQUEST_SECONDS = Histogram("whatsapp_request_duration_seconds", "Chamadas HTTP à Graph API, por resultado.",
+                                     ["outcome"], buckets=LATENCY_BUCKETS)
+WHATSAPP_SENDS = Counter("whatsapp_sends_total", "Envios de mensagem (após as novas tentativas).", ["result"])
+AI_REQUEST_SECONDS = Histogram("ai_request_duration_seconds", "Chamadas ao Gemini, por tipo e resultado.",
+                               ["kind", "outcome"], buckets=LATENCY_BUCKETS)
+AI_CACHE_LOOKUPS = Counter("ai_auto_reply_cache_total", "Consultas ao cache de respostas automáticas.", ["result"])
+WS_CONNECTIONS = Gauge("websocket_connections", "Conexões WebSocket abertas.", ["channel_type"], multiprocess_mode="livesum")
+WS_EVICTIONS = Counter("websocket_evictions_total", "Conexões WebSocket desconectadas por lentidão.")
+WS_BROADCAST_SECONDS = Histogram("websocket_broadcast_latency_seconds", "Da publicação ao envio da mensagem a cada conexão.",
+                                 buckets=LATENCY_BUCKETS)
+WEBHOOK_EVENTS = Counter("webhook_events_total", "Eventos da fila de webhooks processados.", ["result"])
+WEBHOOK_PROCESSING_SECONDS = Histogram("webhook_processing_seconds", "Processamento de cada evento da fila de webhooks.",
+                                       buckets=LATENCY_BUCKETS)
+WEBHOOK_TO_BROADCAST_SECONDS = Histogram("webhook_to_broadcast_seconds",
+                                         "Do recebimento do webhook à publicação da mensagem para o painel.",
+                                         buckets=LATENCY_BUCKETS)
+
+_SQL_OPERATIONS = ("SELECT", "INSERT", "UPDATE", "DELETE")
+# Filhos dos rótulos resolvidos uma vez: o listener roda a cada consulta
+_DB_QUERY_BY_OPERATION = {operation: DB_QUERY_SECONDS.labels(operation) for operation in _SQL_OPERATIONS + ("OTHER",)}
+
+
+# ### LOGS ###
+
+# Atributos padrão do LogRecord; o que vier além deles (via `extra=`) vira campo do JSON
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging(level: str = LOG_LEVEL, log_format: str = LOG_FORMAT):
+    """
+    Configura o logger raiz: JSON em uma linha por evento (ou texto), sempre com o request id.
+    """
+    handler = logging.StreamHandler()
+    handler.addFilter(RequestIdFilter())
+    if log_format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"))
+    logging.basicConfig(level=level, handlers=[handler], force=True)
+    # O httpx registra cada chamada à Graph API em INFO; as métricas já cobrem essas chamadas
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+# ### SQL ###
+
+class _QueryStats:
+    __slots__ = ("count", "seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_started
+    operation = statement.lstrip()[:6].upper()
+    _DB_QUERY_BY_OPERATION.get(operation, _DB_QUERY_BY_OPERATION["OTHER"]).observe(elapsed)
+    stats = _query_stats.get()
+    if stats is not None:
+        stats.count += 1
+        stats.seconds += elapsed
+
+def instrument_engine(engine):
+    """
+    Mede as consultas de um engine (síncrono ou assíncrono). Dentro de uma requisição HTTP,
+    a contagem e o tempo também são somados à requisição.
+    """
+    target = getattr(engine, "sync_engine", engine)
+    event.listen(target, "before_cursor_execute", _before_cursor_execute)
+    event.listen(target, "after_cursor_execute", _after_cursor_execute)
+
+
+# ### HTTP ###
+
+def _incoming_request_id(scope) -> str | None:
+    for name, value in scope.get("headers") or ():
+        if name == REQUEST_ID_HEADER.encode():
+            # Aceita o id de um proxy na frente da aplicação, com tamanho limitado
+            return value.decode("latin-1")[:64] or None
+    return None
+
+
+class InstrumentationMiddleware:
+    """
+    Middleware ASGI: atribui um request id (ou reaproveita o do cabeçalho X-Request-ID),
+    devolve-o na resposta e registra latência, status e consultas SQL por rota. A rota é o
+    modelo do caminho ("/api/messages/{patient_id}"), para manter a cardinalidade baixa.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        request_id = _incoming_request_id(scope) or uuid.uuid4().hex
+        request_token = request_id_var.set(request_id)
+        if scope["type"] == "websocket":
+            # Conexões longas: só o request id, para correlacionar os logs da conexão
+            try:
+                return await self.app(scope, receive, send)
+            finally:
+                request_id_var.reset(request_token)
+
+        stats = _QueryStats()
+        stats_token = _query_stats.set(stats)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_request_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", ()), (REQUEST_ID_HEADER.encode(), request_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            elapsed = time.perf_counter() - started
+            route = getattr(scope.get("route"), "path", None) or "nao_mapeada"
+            method = scope["method"]
+            HTTP_REQUESTS.labels(method, route, str(status)).inc()
+            HTTP_LATENCY.labels(method, route).observe(elapsed)
+            HTTP_DB_QUERIES.labels(route).observe(stats.count)
+            HTTP_DB_SECONDS.labels(route).observe(stats.seconds)
+            logger.log(logging.WARNING if elapsed >= SLOW_REQUEST_SECONDS else logging.INFO, "requisição",
+                       extra={"method": method, "path": scope["path"], "route": route, "status": status,
+                              "duration_ms": round(elapsed * 1000, 2), "db_queries": stats.count,
+                              "db_ms": round(stats.seconds * 1000, 2)})
+            _query_stats.reset(stats_token)
+            request_id_var.reset(request_token)
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """
+    Conteúdo do /metrics no formato de exposição do Prometheus.
+    """
+    registry = REGISTRY
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+# ### INTEGRAÇÕES ###
+
+def observe_whatsapp_call(started: float, status_code: int | None):
+    if status_code is None:
+        outcome = "transport_error"
+    elif status_code < 400:
+        outcome = "ok"
+    elif status_code == 429:
+        outcome = "rate_limited"
+    elif status_code >= 500:
+        outcome = "server_error"
+    else:
+        outcome = "client_error"
+    WHATSAPP_REQUEST_SECONDS.labels(outcome).observe(time.perf_counter() - started)
+
+def channel_type(channel: str) -> str:
+    # "patient:<id>" -> "patient": um id por rótulo criaria uma série por paciente
+    return channel.split(":", 1)[0]
+
+def observe_webhook_to_broadcast():
+    """
+    Chamado quando a mensagem recebida foi publicada para o painel, dentro do processamento
+    de um evento da fila de webhooks.
+    """
+    received_at = webhook_received_at.get()
+    if received_at is not None:
+        WEBHOOK_TO_BROADCAST_SECONDS.observe(max(0.0, time.time() - received_at))
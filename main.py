@@ -1,56 +1,55 @@
 import os
 import json
-import httpx
-from fastapi import FastAPI, Request, HTTPException, Depends, Header, WebSocket, WebSocketDisconnect
-from pydantic import BaseModel, ConfigDict
+import uuid
+import logging
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, Response, HTTPException, Depends, Header, Query, WebSocket, WebSocketDisconnect
+from pydantic import BaseModel, ConfigDict, Field
 from sqlalchemy.orm import Session
+from datetime import datetime, timezone
 from typing import List, Annotated
-import google.generativeai as genai 
+from instrumentation import configure_logging, instrument_engine, render_metrics, observe_webhook_to_broadcast, InstrumentationMiddleware
+
+# Antes dos demais imports, para que os avisos emitidos ao importar já saiam no formato configurado
+configure_logging()
+logger = logging.getLogger(__name__)
 
 # NOVOS IMPORTS
 from passlib.context import CryptContext
 
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse
 from database import crud, models
-from database.database import engine, get_db
-from send_scheduled_messages import run_task
-
-# ... (ConnectionManager e models.Base permanecem os mesmos)
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: dict[int, list[WebSocket]] = {}
-    async def connect(self, websocket: WebSocket, patient_id: int):
-        await websocket.accept()
-        if patient_id not in self.active_connections:
-            self.active_connections[patient_id] = []
-        self.active_connections[patient_id].append(websocket)
-        print(f"Nova conexão WebSocket para o paciente {patient_id}.")
-    def disconnect(self, websocket: WebSocket, patient_id: int):
-        if patient_id in self.active_connections:
-            self.active_connections[patient_id].remove(websocket)
-            if not self.active_connections[patient_id]:
-                del self.active_connections[patient_id]
-            print(f"Conexão WebSocket fechada para o paciente {patient_id}.")
-    async def broadcast_to_patient_viewers(self, patient_id: int, message: dict):
-        if patient_id in self.active_connections:
-            for connection in self.active_connections[patient_id]:
-                await connection.send_json(message)
-                print(f"Mensagem enviada via WebSocket para observadores do paciente {patient_id}.")
-
-manager = ConnectionManager()
-models.Base.metadata.create_all(bind=engine)
+from database.database import engine, async_engine, get_db, SessionLocal, upgrade_schema, ensure_search_index, with_session, run_in_transaction
+from whatsapp import whatsapp_client
+from webhook_queue import WebhookQueue
+from outbox import outbox_dispatcher
+from alert_detector import alert_detector, AlertResult
+from ai_gateway import ai_gateway
+from summaries import summarizer
+from realtime import manager, patient_channel, PANEL_CHANNEL
+from scheduler import reminder_scheduler, next_occurrence, create_default_schedules, DEFAULT_REMINDER_TIMEZONE
+from archive import message_archiver
+from analytics import engagement_report
+
+instrument_engine(engine)
+instrument_engine(async_engine)
+
+# ... (models.Base permanece o mesmo)
+added_columns = upgrade_schema()
+if "patients.unread_alert_count" in added_columns:
+    with_session(crud.rebuild_patient_activity)
+# Banco existente: os contadores de engajamento começam vazios. A reconstrução lê todo o histórico
+# e não roda na importação (cada worker a repetiria); é feita uma vez, fora do servidor
+if "patients.pending_reminder_at" in added_columns:
+    logger.warning("Indicadores de engajamento vazios: execute `python analytics.py backfill` para reconstruí-los.")
+ensure_search_index()
 
 # ... (Variáveis de ambiente e cliente AI permanecem os mesmos)
 WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN")
 PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
 CRON_SECRET = os.getenv("CRON_SECRET")
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-
-if GOOGLE_API_KEY:
-    genai.configure(api_key=GOOGLE_API_KEY)
-else:
-    print("AVISO: Chave da API do Google não encontrada. A funcionalidade de IA estará desativada.")
 
 # ### NOVA SEÇÃO DE SEGURANÇA ###
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -62,12 +61,28 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 # ################################
 
-ALERT_KEYWORDS = ["dor", "febre", "difícil", "não tomei", "sem dormir", "ansioso", "triste"]
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await manager.start()
+    await webhook_queue.start()
+    await outbox_dispatcher.start()
+    await reminder_scheduler.start()
+    await message_archiver.start()
+    yield
+    await message_archiver.stop()
+    await reminder_scheduler.stop()
+    await outbox_dispatcher.stop()
+    await webhook_queue.stop()
+    await summarizer.stop()
+    await manager.stop()
+    await whatsapp_client.aclose()
+    await async_engine.dispose()
 
 app = FastAPI(
     title="Cuide.me Backend",
     description="API para o Sistema de Acompanhamento Inteligente de Pacientes.",
-    version="0.8.0" # Versão incrementada
+    version="0.8.0", # Versão incrementada
+    lifespan=lifespan
 )
 
 # ... (CORS permanece o mesmo)
@@ -81,7 +96,10 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Before-Cursor", "X-After-Cursor", "X-Request-ID"],
 )
+# Adicionado por último para envolver os demais: mede também o tempo do CORS
+app.add_middleware(InstrumentationMiddleware)
 
 # ### NOVOS MODELOS PYDANTIC (SCHEMAS) ###
 class ProfessionalCreate(BaseModel):
@@ -101,23 +119,70 @@ class PatientResponse(BaseModel):
     phone_number: str
     name: str | None = None
     has_alert: bool = False
+    unread_alert_count: int = 0
+    last_message_at: datetime | None = None
+    last_message_preview: str | None = None
     status: str
     model_config = ConfigDict(from_attributes=True)
 
-# ... (Função send_whatsapp_message permanece a mesma)
-def send_whatsapp_message(to_number: str, text: str):
-    url = f"https://graph.facebook.com/v19.0/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
-    data = {"messaging_product": "whatsapp", "to": to_number, "type": "text", "text": {"body": text}}
-    try:
-        with httpx.Client() as http_client:
-            response = http_client.post(url, headers=headers, json=data)
-            response.raise_for_status()
-        print(f"Mensagem enviada com sucesso para {to_number}.")
-        return True
-    except httpx.HTTPStatusError as e:
-        print(f"Erro ao enviar mensagem para {to_number}: {e.response.status_code}"); print(f"Detalhe do erro: {e.response.text}")
-        return False
+# "HH:MM" no fuso da agenda
+SEND_TIME_PATTERN = r"^([01]\d|2[0-3]):[0-5]\d$"
+
+class ScheduleCreate(BaseModel):
+    send_time: str = Field(pattern=SEND_TIME_PATTERN)
+    timezone: str = DEFAULT_REMINDER_TIMEZONE
+    template: str | None = None
+    recurrence: str = "daily"
+    active: bool = True
+    skip_manual: bool = True
+
+class ScheduleUpdate(BaseModel):
+    send_time: str | None = Field(None, pattern=SEND_TIME_PATTERN)
+    timezone: str | None = None
+    template: str | None = None
+    recurrence: str | None = None
+    active: bool | None = None
+    skip_manual: bool | None = None
+
+class ScheduleResponse(BaseModel):
+    id: int
+    patient_id: int
+    send_time: str
+    timezone: str
+    template: str | None = None
+    recurrence: str
+    active: bool
+    skip_manual: bool
+    is_default: bool
+    next_run_at: datetime | None = None
+    last_run_at: datetime | None = None
+    last_occurrence: str | None = None
+    model_config = ConfigDict(from_attributes=True)
+
+class MessageSearchResult(BaseModel):
+    id: int
+    patient_id: int
+    patient_name: str | None = None
+    text: str
+    sender: str
+    timestamp: datetime
+    has_alert: bool
+    alert_score: float = 0
+    alert_terms: list[str] = []
+    rank: float
+
+def patient_to_dict(patient: models.Patient):
+    return PatientResponse.model_validate(patient).model_dump(mode="json")
+
+def message_to_dict(msg: models.Message):
+    return {"id": msg.id, "text": msg.text, "sender": msg.sender, "timestamp": msg.timestamp.isoformat(),
+            "alert_score": msg.alert_score, "alert_terms": msg.alert_terms or [], "delivery_status": msg.delivery_status}
+
+def stream_messages_ndjson(patient_id: int, include_archive: bool = False):
+    # Sessão própria: o gerador continua sendo consumido depois que o endpoint retorna
+    with SessionLocal() as db:
+        for msg in crud.iter_patient_messages(db, patient_id, include_archive=include_archive):
+            yield json.dumps(message_to_dict(msg), ensure_ascii=False) + "\n"
 
 
 # ### NOVO ENDPOINT DE REGISTRO ###
@@ -128,117 +193,277 @@ def register_professional(professional: ProfessionalCreate, db: Session = Depend
         raise HTTPException(status_code=400, detail="Email já registrado")
     
     hashed_password = get_password_hash(professional.password)
-    return crud.create_professional(db=db, email=professional.email, hashed_password=hashed_password)
+    db_professional = crud.create_professional(db=db, email=professional.email, hashed_password=hashed_password)
+    db.commit()
+    return db_professional
 # ################################
 
 # ... (Todos os outros endpoints de /webhook até o final permanecem os mesmos)
 # (Cole aqui o restante dos seus endpoints, de /webhook até o final)
+def store_incoming_message(db: Session, from_number: str, message_text: str, external_id: str | None, alert: AlertResult):
+    # Paciente, mensagem e contadores do paciente na mesma transação (executada via run_in_transaction).
+    # Devolve None quando a mensagem já foi recebida antes (reentrega do webhook).
+    patient = crud.get_or_create_patient(db, phone_number=from_number)
+    first_contact = patient.last_patient_message_at is None
+    new_message = crud.create_message(db, patient_id=patient.id, text=message_text, has_alert=alert.has_alert, sender="patient", external_id=external_id,
+                                      alert_score=alert.score, alert_terms=alert.terms or None)
+    if new_message is None: return None
+    # Paciente novo: a agenda padrão é criada aqui, sem varrer todos os pacientes
+    schedules_created = create_default_schedules(db, [patient.id]) if first_contact else 0
+    return patient_to_dict(patient), message_to_dict(new_message), schedules_created
+
+async def process_incoming_message(message_data: dict):
+    if message_data.get("type", "text") != "text":
+        logger.info("Mensagem do tipo '%s' ignorada.", message_data.get("type")); return
+    from_number = message_data["from"]
+    message_text = message_data["text"]["body"]
+    external_id = message_data.get("id")
+    alert = alert_detector.detect(message_text)
+    has_alert = alert.has_alert
+    stored = await run_in_transaction(store_incoming_message, from_number, message_text, external_id, alert)
+    if stored is None:
+        logger.info("Mensagem %s já processada; reentrega ignorada.", external_id); return
+    patient, message_dict, schedules_created = stored
+    if schedules_created: reminder_scheduler.notify()
+    patient_id, phone_number, status = patient["id"], patient["phone_number"], patient["status"]
+    await manager.broadcast_to_patient_viewers(patient_id, message_dict)
+    manager.publish_patient_update(patient)
+    observe_webhook_to_broadcast()
+    # Deixa o resumo pronto para quando o profissional abrir o paciente com alerta
+    if has_alert and ai_gateway.enabled: summarizer.schedule_refresh(patient_id)
+    if not has_alert and status == 'automatico' and ai_gateway.enabled:
+        try:
+            ai_decision = await ai_gateway.decide_auto_reply(message_text)
+            if ai_decision.get("responder") is True and (response_text := ai_decision.get("texto_resposta")):
+                logger.info("IA decidiu responder ao paciente %s com: '%s'", patient_id, response_text)
+                key = f"auto_reply:{external_id or uuid.uuid4().hex}"
+                outbound = await run_in_transaction(crud.enqueue_outbound_message, key, phone_number, response_text, "auto_reply", patient_id=patient_id)
+                await outbox_dispatcher.deliver(outbound.id)
+        except Exception: logger.exception("Erro ao processar resposta da IA.")
+
+async def process_webhook_payload(data: dict):
+    """
+    Processa um payload da Meta, que pode agrupar várias entradas, mudanças e mensagens,
+    além dos callbacks de status (entregue/lida) dos envios, aplicados em lote na outbox.
+    """
+    statuses = []
+    for entry in data.get("entry") or []:
+        for change in entry.get("changes") or []:
+            value = change.get("value") or {}
+            statuses.extend(value.get("statuses") or [])
+            for message_data in value.get("messages") or []:
+                await process_incoming_message(message_data)
+    if statuses:
+        await run_in_transaction(crud.apply_outbound_statuses, statuses)
+
+webhook_queue = WebhookQueue(process_webhook_payload)
+
 @app.post("/webhook")
-async def handle_webhook(request: Request, db: Session = Depends(get_db)):
-    data = await request.json()
-    try:
-        if (data.get("entry") and data["entry"][0].get("changes") and data["entry"][0]["changes"][0].get("value") and data["entry"][0]["changes"][0]["value"].get("messages")):
-            message_data = data["entry"][0]["changes"][0]["value"]["messages"][0]
-            from_number = message_data["from"]
-            message_text = message_data["text"]["body"]
-            patient = crud.get_or_create_patient(db, phone_number=from_number)
-            lower_message_text = message_text.lower()
-            found_keywords = [keyword for keyword in ALERT_KEYWORDS if keyword in lower_message_text]
-            has_alert = bool(found_keywords)
-            new_message = crud.create_message(db, patient_id=patient.id, text=message_text, has_alert=has_alert, sender="patient")
-            message_dict = { "id": new_message.id, "text": new_message.text, "sender": new_message.sender, "timestamp": new_message.timestamp.isoformat() }
-            await manager.broadcast_to_patient_viewers(patient.id, message_dict)
-            if not has_alert and patient.status == 'automatico' and GOOGLE_API_KEY:
-                system_prompt = ("Você é um assistente de saúde. Analise a mensagem de um paciente. Sua tarefa é decidir se uma resposta automática de apoio é apropriada. Responda APENAS com um objeto JSON. Se a mensagem for uma simples atualização, um agradecimento ou uma afirmação positiva, retorne: {\"responder\": true, \"texto_resposta\": \"[uma frase curta de apoio]\"}. Exemplos de frases: 'Obrigado por compartilhar!', 'Entendido, continue assim!', 'Registro feito!'. Se a mensagem for uma pergunta, um pedido de ajuda, uma queixa (mesmo que sutil), ou qualquer coisa que exija atenção humana, retorne: {\"responder\": false}")
-                user_prompt = f"Analise esta mensagem do paciente: \"{message_text}\""
-                try:
-                    model = genai.GenerativeModel('gemini-1.5-flash')
-                    response = model.generate_content(prompt) # Corrigido para usar a variável prompt correta
-                    ai_decision = json.loads(response.text)
-                    if ai_decision.get("responder") is True and (response_text := ai_decision.get("texto_resposta")):
-                        print(f"IA decidiu responder ao paciente {patient.id} com: '{response_text}'")
-                        send_whatsapp_message(to_number=patient.phone_number, text=response_text)
-                except Exception as e: print(f"Erro ao processar resposta da IA: {e}")
-        return {"status": "ok"}
-    except Exception as e:
-        print(f"Erro fatal ao processar o webhook: {e}")
-        return {"status": "error", "detail": str(e)}
+async def handle_webhook(request: Request):
+    # Apenas persiste o payload e responde logo; o processamento fica com os workers da fila
+    body = await request.body()
+    try: json.loads(body)
+    except ValueError: raise HTTPException(status_code=400, detail="Payload inválido")
+    await webhook_queue.enqueue(body.decode("utf-8"))
+    webhook_queue.notify()
+    return {"status": "ok"}
 
-@app.websocket("/ws/{patient_id}")
-async def websocket_endpoint(websocket: WebSocket, patient_id: int):
-    await manager.connect(websocket, patient_id)
+@app.get("/api/webhook-queue/stats")
+def get_webhook_queue_stats():
+    return webhook_queue.stats()
+
+@app.get("/api/ai/stats")
+def get_ai_stats():
+    return ai_gateway.stats()
+
+# Formato de exposição do Prometheus (latência por rota, SQL por requisição, WhatsApp, Gemini, WebSockets, webhooks)
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    content, media_type = render_metrics()
+    return Response(content=content, media_type=media_type)
+
+@app.get("/api/archive/stats")
+def get_archive_stats():
+    return message_archiver.stats()
+
+# Indicadores de engajamento dos últimos `days` dias, lidos só dos contadores diários (analytics.py)
+@app.get("/api/analytics")
+def get_analytics(days: int = Query(30, ge=1, le=366), patient_id: int | None = None, db: Session = Depends(get_db)):
+    return engagement_report(db, days=days, patient_id=patient_id)
+
+@app.get("/api/realtime/stats")
+def get_realtime_stats():
+    return manager.stats()
+
+async def serve_websocket(websocket: WebSocket, channel: str, heartbeat: bool):
+    connection = await manager.connect(websocket, channel, heartbeat=heartbeat)
     try:
         while True: await websocket.receive_text()
-    except WebSocketDisconnect: manager.disconnect(websocket, patient_id)
+    except WebSocketDisconnect: pass
+    finally: manager.disconnect(connection)
 
+# Canal do painel: recebe {"type": "patient_update", "patient": {...}} a cada mudança na lista de pacientes
+@app.websocket("/ws/panel")
+async def panel_websocket_endpoint(websocket: WebSocket):
+    await serve_websocket(websocket, PANEL_CHANNEL, heartbeat=True)
+
+# Heartbeat opcional (?heartbeat=1) para não enviar mensagens de ping a clientes antigos
+@app.websocket("/ws/{patient_id}")
+async def websocket_endpoint(websocket: WebSocket, patient_id: int, heartbeat: bool = False):
+    await serve_websocket(websocket, patient_channel(patient_id), heartbeat=heartbeat)
+
+# Sem limit nem cursor devolve a lista inteira (o painel atual não pagina); com eles, páginas
+# de até 500 pacientes e o cursor da próxima em X-Next-Cursor
 @app.get("/api/patients", response_model=List[PatientResponse])
-def get_patients(db: Session = Depends(get_db)):
-    all_patients = db.query(models.Patient).all()
-    response_patients = []
-    for patient in all_patients:
-        has_alert = db.query(models.Message).filter(models.Message.patient_id == patient.id, models.Message.has_alert == True).first() is not None
-        response_patients.append({"id": patient.id, "phone_number": patient.phone_number, "name": patient.name, "has_alert": has_alert, "status": patient.status})
-    return response_patients
+def get_patients(response: Response, limit: int | None = Query(None, ge=1, le=500), cursor: str | None = None, db: Session = Depends(get_db)):
+    if cursor and limit is None: limit = 100
+    try: patients, next_cursor = crud.get_patients_page(db, limit=limit, cursor=cursor)
+    except ValueError as e: raise HTTPException(status_code=400, detail=str(e))
+    # O cursor da próxima página vai no cabeçalho para manter o corpo como lista
+    if next_cursor: response.headers["X-Next-Cursor"] = next_cursor
+    return patients
 
+# Por padrão só as mensagens em uso; ?include_archive=true continua a paginação pelo histórico arquivado
 @app.get("/api/messages/{patient_id}")
-def get_messages_for_patient(patient_id: int, db: Session = Depends(get_db)):
-    messages_from_db = db.query(models.Message).filter(models.Message.patient_id == patient_id).order_by(models.Message.timestamp.asc()).all()
-    response_data = [{"id": msg.id, "text": msg.text, "sender": msg.sender, "timestamp": msg.timestamp.isoformat()} for msg in messages_from_db]
-    db.query(models.Message).filter(models.Message.patient_id == patient_id, models.Message.has_alert == True).update({"has_alert": False}, synchronize_session=False)
-    db.commit()
+def get_messages_for_patient(patient_id: int, response: Response, limit: int = Query(100, ge=1, le=1000),
+                             before: int | None = None, after: int | None = None,
+                             format: str = Query("json", pattern="^(json|ndjson)$"), include_archive: bool = False,
+                             db: Session = Depends(get_db)):
+    if format == "ndjson":
+        # Exportação completa em streaming, sem montar a lista inteira na memória
+        return StreamingResponse(stream_messages_ndjson(patient_id, include_archive), media_type="application/x-ndjson")
+    if before is not None and after is not None: raise HTTPException(status_code=400, detail="Use apenas um dos cursores: before ou after.")
+    messages, has_more = crud.get_messages_page(db, patient_id, limit=limit, before=before, after=after, include_archive=include_archive)
+    if messages:
+        if after is None and has_more: response.headers["X-Before-Cursor"] = str(messages[0].id)
+        if after is not None and has_more: response.headers["X-After-Cursor"] = str(messages[-1].id)
+    response_data = [message_to_dict(msg) for msg in messages]
+    if crud.clear_patient_alerts(db, patient_id):
+        db.commit()
+        patient = db.query(models.Patient).filter(models.Patient.id == patient_id).first()
+        if patient: manager.publish_patient_update(patient_to_dict(patient))
     return response_data
 
+# Ex.: /api/search/messages?q=febre&since=2026-10-12T00:00:00-03:00 — "quem falou de febre nesta semana"
+@app.get("/api/search/messages", response_model=List[MessageSearchResult])
+def search_messages(response: Response, q: str = Query(..., min_length=2, max_length=200), patient_id: int | None = None,
+                    sender: str | None = Query(None, pattern="^(patient|professional)$"), since: datetime | None = None,
+                    until: datetime | None = None, has_alert: bool | None = None, limit: int = Query(50, ge=1, le=200),
+                    cursor: str | None = None, db: Session = Depends(get_db)):
+    try: results, next_cursor = crud.search_messages(db, q, patient_id=patient_id, sender=sender, since=since, until=until,
+                                                     has_alert=has_alert, limit=limit, cursor=cursor, alert_threshold=alert_detector.threshold)
+    except ValueError as e: raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor: response.headers["X-Next-Cursor"] = next_cursor
+    return [MessageSearchResult(id=msg.id, patient_id=msg.patient_id, patient_name=patient_name, text=msg.text, sender=msg.sender,
+                                timestamp=msg.timestamp, has_alert=bool(msg.has_alert), alert_score=msg.alert_score or 0,
+                                alert_terms=msg.alert_terms or [], rank=rank)
+            for msg, patient_name, rank in results]
+
 @app.post("/api/patients/{patient_id}/assume-control", status_code=200)
 def assume_conversation_control(patient_id: int, db: Session = Depends(get_db)):
     patient = db.query(models.Patient).filter(models.Patient.id == patient_id).first()
     if not patient: raise HTTPException(status_code=404, detail="Paciente não encontrado")
-    patient.status = "manual"; db.commit(); return {"status": "success", "message": "Controle manual ativado."}
+    patient.status = "manual"; db.commit(); manager.publish_patient_update(patient_to_dict(patient))
+    return {"status": "success", "message": "Controle manual ativado."}
 
 @app.post("/api/patients/{patient_id}/release-control", status_code=200)
 def release_conversation_control(patient_id: int, db: Session = Depends(get_db)):
     patient = db.query(models.Patient).filter(models.Patient.id == patient_id).first()
     if not patient: raise HTTPException(status_code=404, detail="Paciente não encontrado")
-    patient.status = "automatico"; db.commit(); return {"status": "success", "message": "Controle automático reativado."}
+    patient.status = "automatico"; db.commit(); manager.publish_patient_update(patient_to_dict(patient))
+    return {"status": "success", "message": "Controle automático reativado."}
+
+def queue_professional_message(db: Session, patient_id: int, text: str, idempotency_key: str):
+    created = crud.create_professional_message(db, patient_id, text, idempotency_key)
+    if created is None: return None
+    outbound, _ = created
+    # Só um envio novo (ou que ficou órfão) sai agora; os demais seguem o próprio estado na outbox
+    return outbound.id, outbound.status == "pending" and outbound.attempts == 0
 
+def load_professional_message(db: Session, outbound_id: int):
+    outbound, message, patient = crud.get_outbound_state(db, outbound_id)
+    return outbound.status, message_to_dict(message) if message else None, patient_to_dict(patient)
+
+# 201: enviada; 202: falha temporária, a outbox tenta de novo (delivery_status "pending"); 500: falha definitiva
+# (a mensagem fica no histórico como "failed"). Com o cabeçalho Idempotency-Key, um reenvio da mesma
+# requisição não gera nova mensagem e devolve o estado atual do envio.
 @app.post("/api/messages/send/{patient_id}", status_code=201)
-def send_message_to_patient(patient_id: int, message_request: MessageSendRequest, db: Session = Depends(get_db)):
-    patient = db.query(models.Patient).filter(models.Patient.id == patient_id).first()
-    if not patient: raise HTTPException(status_code=404, detail="Paciente não encontrado")
-    if not send_whatsapp_message(to_number=patient.phone_number, text=message_request.text):
+async def send_message_to_patient(patient_id: int, message_request: MessageSendRequest, idempotency_key: Annotated[str | None, Header()] = None):
+    key = f"manual:{idempotency_key or uuid.uuid4().hex}"
+    queued = await run_in_transaction(queue_professional_message, patient_id, message_request.text, key)
+    if queued is None: raise HTTPException(status_code=404, detail="Paciente não encontrado")
+    outbound_id, send_now = queued
+    # Uma única tentativa: com a Graph API fora do ar, a requisição não espera as retentativas
+    # (a mensagem fica pendente e sai pelo laço de retentativas da outbox)
+    if send_now: await outbox_dispatcher.deliver(outbound_id, max_retries=0)
+    status, message_dict, patient = await run_in_transaction(load_professional_message, outbound_id)
+    manager.publish_patient_update(patient)
+    if status == "failed":
         raise HTTPException(status_code=500, detail="Erro ao enviar mensagem pela API do WhatsApp.")
-    new_message = crud.create_message(db=db, patient_id=patient.id, text=message_request.text, sender="professional", has_alert=False)
-    return {"id": new_message.id, "text": new_message.text, "sender": new_message.sender, "timestamp": new_message.timestamp.isoformat()}
+    if status in ("pending", "sending"):
+        return JSONResponse(status_code=202, content=message_dict)
+    return message_dict
 
 @app.post("/api/messages/{patient_id}/summarize")
-def summarize_conversation(patient_id: int, db: Session = Depends(get_db)):
-    if not GOOGLE_API_KEY: raise HTTPException(status_code=503, detail="A funcionalidade de IA não está configurada no servidor.")
-    messages = db.query(models.Message).filter(models.Message.patient_id == patient_id).order_by(models.Message.timestamp.asc()).all()
-    if not messages: raise HTTPException(status_code=404, detail="Nenhuma mensagem encontrada para este paciente.")
-    conversation_text = ""
-    for msg in messages:
-        sender_name = "Profissional" if msg.sender == 'professional' else "Paciente"
-        conversation_text += f"{sender_name}: {msg.text}\n"
-    prompt = ("Você é um assistente de saúde inteligente. Sua tarefa é resumir a seguinte conversa entre um paciente em tratamento e um profissional de saúde para que o profissional possa entender rapidamente o estado do paciente. O resumo deve ser conciso e útil.\n\n"
-        "Por favor, resuma a conversa abaixo em bullet points, focando em: "
-        "1. Evolução de sintomas ou queixas. "
-        "2. Adesão ao tratamento (medicamentos, dieta, exercícios). "
-        "3. Efeitos colaterais mencionados. "
-        "4. Estado emocional ou humor geral relatado. "
-        "5. Dados numéricos específicos reportados (peso, pressão, etc.).\n\n"
-        "Seja direto ao ponto e não invente informações que não estão na conversa.\n\n"
-        f"--- CONVERSA ---\n{conversation_text}"
-        "\n--- RESUMO ---")
+async def summarize_conversation(patient_id: int, include_archive: bool = False):
+    if not ai_gateway.enabled: raise HTTPException(status_code=503, detail="A funcionalidade de IA não está configurada no servidor.")
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        response = model.generate_content(prompt)
-        summary = response.text; return {"summary": summary}
-    except Exception as e:
-        print(f"Erro na API do Google Gemini: {e}"); raise HTTPException(status_code=500, detail="Ocorreu um erro ao gerar o resumo.")
-
-@app.post("/trigger-daily-task")
-async def trigger_task(x_cron_secret: Annotated[str | None, Header()] = None):
+        result = await summarizer.summarize(patient_id, include_archive=include_archive)
+    except Exception:
+        logger.exception("Erro na API do Google Gemini."); raise HTTPException(status_code=500, detail="Ocorreu um erro ao gerar o resumo.")
+    if result is None: raise HTTPException(status_code=404, detail="Nenhuma mensagem encontrada para este paciente.")
+    return result
+
+def create_patient_schedule(db: Session, patient_id: int, fields: dict):
+    next_run_at = next_occurrence(fields["send_time"], fields["timezone"], fields["recurrence"], datetime.now(timezone.utc))
+    schedule = crud.create_schedule(db, patient_id, next_run_at=next_run_at, **fields)
+    return ScheduleResponse.model_validate(schedule) if schedule else None
+
+def update_patient_schedule(db: Session, schedule_id: int, changes: dict):
+    schedule = crud.get_schedule(db, schedule_id)
+    if schedule is None: return None
+    for field, value in changes.items(): setattr(schedule, field, value)
+    # Recalcula a próxima ocorrência a partir de agora (lança ValueError se a agenda ficou inválida)
+    schedule.next_run_at = next_occurrence(schedule.send_time, schedule.timezone, schedule.recurrence, datetime.now(timezone.utc))
+    return ScheduleResponse.model_validate(schedule)
+
+@app.get("/api/patients/{patient_id}/schedules", response_model=List[ScheduleResponse])
+def get_patient_schedules(patient_id: int, db: Session = Depends(get_db)):
+    return crud.get_patient_schedules(db, patient_id)
+
+@app.post("/api/patients/{patient_id}/schedules", response_model=ScheduleResponse, status_code=201)
+async def create_schedule(patient_id: int, schedule: ScheduleCreate):
+    try: created = await run_in_transaction(create_patient_schedule, patient_id, schedule.model_dump())
+    except ValueError as e: raise HTTPException(status_code=400, detail=str(e))
+    if created is None: raise HTTPException(status_code=404, detail="Paciente não encontrado")
+    reminder_scheduler.notify()
+    return created
+
+# Para desativar um lembrete use {"active": false}: pacientes sem nenhuma agenda recebem a padrão
+@app.patch("/api/schedules/{schedule_id}", response_model=ScheduleResponse)
+async def update_schedule(schedule_id: int, changes: ScheduleUpdate):
+    try: updated = await run_in_transaction(update_patient_schedule, schedule_id, changes.model_dump(exclude_unset=True))
+    except ValueError as e: raise HTTPException(status_code=400, detail=str(e))
+    if updated is None: raise HTTPException(status_code=404, detail="Agenda não encontrada")
+    reminder_scheduler.notify()
+    return updated
+
+@app.get("/api/scheduler/stats")
+def get_scheduler_stats():
+    return reminder_scheduler.stats()
+
+def verify_cron_secret(x_cron_secret: Annotated[str | None, Header()] = None):
     if not CRON_SECRET or x_cron_secret != CRON_SECRET: raise HTTPException(status_code=401, detail="Unauthorized")
-    run_task(); return {"status": "Task triggered successfully"}
+
+# Os lembretes saem pelo agendador; o cron só atua como watchdog: cria as agendas padrão que
+# faltam, reinicia o agendador se ele parou e força uma releitura (acordando a instância, se dormia)
+@app.post("/trigger-daily-task", status_code=202, dependencies=[Depends(verify_cron_secret)])
+async def trigger_task():
+    created = await reminder_scheduler.ensure_default_schedules()
+    restarted = await reminder_scheduler.ensure_running()
+    reminder_scheduler.notify()
+    return {"status": "Scheduler running", "restarted": restarted, "default_schedules_created": created,
+            "scheduler": reminder_scheduler.stats()}
 
 @app.get("/")
 def read_root(): return {"status": "API do Cuide.me está funcionando!"}
@@ -0,0 +1,71 @@
+import os
+import asyncio
+import logging
+from datetime import timedelta
+from database.database import run_in_transaction
+from database import crud
+from whatsapp import WhatsAppClient, SendResult, whatsapp_client
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "30"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "200"))
+# Tempo após o qual um envio preso em "sending" é considerado interrompido
+OUTBOX_SENDING_TIMEOUT = timedelta(seconds=float(os.getenv("OUTBOX_SENDING_TIMEOUT", "600")))
+
+
+class OutboxDispatcher:
+    """
+    Envia as mensagens registradas na outbox. Cada envio é reservado de forma atômica antes
+    de sair, então duas tentativas concorrentes nunca enviam a mesma linha. Um laço em
+    segundo plano repete os envios que falharam com erro temporário.
+    """
+    def __init__(self, client: WhatsAppClient = whatsapp_client, max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+                 poll_interval: float = OUTBOX_POLL_INTERVAL, batch_size: int = OUTBOX_BATCH_SIZE):
+        self.client = client
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self._task: asyncio.Task | None = None
+
+    async def deliver(self, outbound_id: int, max_retries: int | None = None) -> SendResult | None:
+        """
+        Envia um item da outbox. Devolve None se ele já foi enviado ou está sendo enviado por outro worker.
+        `max_retries` limita as novas tentativas imediatas do cliente (ex.: 0 dentro de uma requisição);
+        uma falha temporária volta para a fila e é reenviada pelo laço de retentativas.
+        """
+        claimed = await run_in_transaction(crud.claim_outbound_message, outbound_id)
+        if claimed is None:
+            return None
+        to_number, text, attempts = claimed
+        result = await self.client.send_text(to_number, text, max_retries=max_retries)
+        retry_in = None
+        if not result.ok and result.retryable and attempts < self.max_attempts:
+            retry_in = min(3600.0, 30.0 * 2 ** attempts)
+        await run_in_transaction(crud.record_outbound_result, outbound_id, result.ok,
+                                 result.message_id, result.error, retry_in)
+        return result
+
+    async def start(self):
+        self._task = asyncio.create_task(self._retry_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _retry_loop(self):
+        while True:
+            try:
+                await run_in_transaction(crud.fail_stale_outbound_messages, OUTBOX_SENDING_TIMEOUT)
+                due_ids = await run_in_transaction(crud.get_due_outbound_ids, self.batch_size)
+                await asyncio.gather(*(self.deliver(outbound_id) for outbound_id in due_ids))
+            except Exception:
+                logger.exception("Erro ao reenviar mensagens pendentes da outbox.")
+            await asyncio.sleep(self.poll_interval)
+
+
+# Instância compartilhada pela aplicação e pela tarefa de envio diário
+outbox_dispatcher = OutboxDispatcher()
@@ -0,0 +1,338 @@
+import os
+import json
+import uuid
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from fastapi import WebSocket
+from database.database import DATABASE_URL
+from database.models import RealtimePayload
+from instrumentation import WS_CONNECTIONS, WS_EVICTIONS, WS_BROADCAST_SECONDS, channel_type
+
+logger = logging.getLogger(__name__)
+
+# "memory" (processo único), "postgres" (LISTEN/NOTIFY no DATABASE_URL) ou "auto"
+REALTIME_BACKEND = os.getenv("REALTIME_BACKEND", "auto")
+REALTIME_PG_CHANNEL = os.getenv("REALTIME_PG_CHANNEL", "cuideme_realtime")
+# O NOTIFY do Postgres aceita payloads de até 8000 bytes; os maiores passam por uma tabela
+PG_NOTIFY_MAX_BYTES = 7900
+REALTIME_PG_TABLE = RealtimePayload.__tablename__
+# Quanto tempo uma mensagem grande fica na tabela para os outros processos a lerem
+PG_PAYLOAD_TTL_SECONDS = 300
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "100"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "25"))
+
+PANEL_CHANNEL = "panel"
+_PING = json.dumps({"type": "ping"})
+
+
+def patient_channel(patient_id: int) -> str:
+    return f"patient:{patient_id}"
+
+
+class Connection:
+    """
+    Uma conexão WebSocket com fila de saída própria e uma tarefa que escreve nela, para que
+    um navegador lento não atrase os demais.
+    """
+    def __init__(self, websocket: WebSocket, channel: str, heartbeat: bool, queue_size: int):
+        self.websocket = websocket
+        self.channel = channel
+        self.heartbeat = heartbeat
+        # (payload, momento da publicação) — o momento mede a latência até o envio
+        self.queue: asyncio.Queue[tuple[str, float]] = asyncio.Queue(maxsize=queue_size)
+        self.writer: asyncio.Task | None = None
+        self.closed = False
+
+
+class InMemoryBroker:
+    """
+    Backend de processo único: não há outros workers, então nada precisa ser repassado.
+    """
+    distributed = False
+
+    async def start(self, deliver: Callable[[str, str], None]):
+        pass
+
+    def publish(self, channel: str, payload: str):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class PostgresBroker:
+    """
+    Repassa as mensagens entre workers e instâncias com LISTEN/NOTIFY no próprio Postgres da
+    aplicação. Cada processo mantém uma única conexão em LISTEN, lida pelo loop de eventos, e
+    entrega localmente o que vem dos outros processos (as próprias mensagens já foram entregues).
+    Mensagens maiores que o limite do NOTIFY são gravadas em REALTIME_PG_TABLE (criada com as
+    demais tabelas, no upgrade_schema) e só o id é notificado; quem recebe lê a linha antes de entregar, mantendo a ordem das mensagens.
+    """
+    distributed = True
+
+    def __init__(self, dsn: str, channel: str = REALTIME_PG_CHANNEL):
+        self.dsn = dsn
+        self.channel = channel
+        self.origin = uuid.uuid4().hex
+        self._deliver: Callable[[str, str], None] | None = None
+        self._listen_conn = None
+        self._publish_conn = None
+        # Uma única thread (e conexão) de publicação preserva a ordem das mensagens; ela também
+        # lê as mensagens grandes recebidas
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="realtime-notify")
+        self._reconnect_task: asyncio.Task | None = None
+        self._deliver_task: asyncio.Task | None = None
+        self._received: asyncio.Queue | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    async def start(self, deliver: Callable[[str, str], None]):
+        self._deliver = deliver
+        self._loop = asyncio.get_running_loop()
+        self._received = asyncio.Queue()
+        await self._listen()
+        self._deliver_task = asyncio.create_task(self._deliver_loop())
+
+    async def _listen(self):
+        import psycopg2
+        conn = await asyncio.to_thread(psycopg2.connect, self.dsn)
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(f'LISTEN "{self.channel}"')
+        self._listen_conn = conn
+        self._loop.add_reader(conn.fileno(), self._on_readable)
+        logger.info("Realtime: escutando o canal %s no Postgres.", self.channel)
+
+    def _on_readable(self):
+        conn = self._listen_conn
+        try:
+            conn.poll()
+        except Exception as e:
+            logger.warning("Realtime: conexão de LISTEN perdida (%s); reconectando.", e)
+            self._loop.remove_reader(conn.fileno())
+            self._listen_conn = None
+            if self._reconnect_task is None or self._reconnect_task.done():
+                self._reconnect_task = asyncio.create_task(self._reconnect())
+            return
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            try:
+                envelope = json.loads(notify.payload)
+            except ValueError:
+                continue
+            if envelope.get("o") != self.origin:
+                self._received.put_nowait(envelope)
+
+    async def _deliver_loop(self):
+        while True:
+            envelope = await self._received.get()
+            payload = envelope.get("p")
+            if payload is None:
+                try:
+                    row = await self._loop.run_in_executor(self._executor, self._execute,
+                                                           f"SELECT payload FROM {REALTIME_PG_TABLE} WHERE id = %s", (envelope["r"],))
+                except Exception as e:
+                    logger.error("Realtime: erro ao ler a mensagem grande %s: %s", envelope.get("r"), e)
+                    continue
+                if row is None:
+                    logger.error("Realtime: mensagem grande %s não encontrada (expirada?).", envelope.get("r"))
+                    continue
+                payload = row[0]
+            try:
+                self._deliver(envelope["c"], payload)
+            except Exception:
+                logger.exception("Realtime: erro ao entregar mensagem do canal %s.", envelope.get("c"))
+
+    async def _reconnect(self):
+        delay = 1.0
+        while self._listen_conn is None:
+            await asyncio.sleep(delay)
+            try:
+                await self._listen()
+            except Exception as e:
+                logger.error("Realtime: falha ao reconectar ao Postgres: %s", e)
+                delay = min(30.0, delay * 2)
+
+    def _execute(self, sql: str, params: tuple = ()):
+        # Só na thread do executor: a conexão de publicação não é compartilhada
+        import psycopg2
+        for attempt in range(2):
+            try:
+                if self._publish_conn is None or self._publish_conn.closed:
+                    self._publish_conn = psycopg2.connect(self.dsn)
+                    self._publish_conn.autocommit = True
+                with self._publish_conn.cursor() as cursor:
+                    cursor.execute(sql, params)
+                    return cursor.fetchone() if cursor.description else None
+            except psycopg2.OperationalError:
+                # Conexão perdida: uma nova tentativa com outra conexão
+                self._publish_conn = None
+                if attempt:
+                    raise
+
+    def _notify(self, channel: str, payload: str):
+        try:
+            message = json.dumps({"o": self.origin, "c": channel, "p": payload}, ensure_ascii=False)
+            if len(message.encode("utf-8")) > PG_NOTIFY_MAX_BYTES:
+                # Mensagem grande: grava e notifica só o id, na mesma transação
+                (payload_id,) = self._execute(
+                    f"WITH removed AS (DELETE FROM {REALTIME_PG_TABLE} WHERE created_at < now() - make_interval(secs => %s)), "
+                    f"stored AS (INSERT INTO {REALTIME_PG_TABLE} (payload) VALUES (%s) RETURNING id) "
+                    "SELECT id FROM stored", (PG_PAYLOAD_TTL_SECONDS, payload))
+                message = json.dumps({"o": self.origin, "c": channel, "r": payload_id})
+            self._execute("SELECT pg_notify(%s, %s)", (self.channel, message))
+        except Exception as e:
+            logger.error("Realtime: erro ao publicar no Postgres: %s", e)
+
+    def publish(self, channel: str, payload: str):
+        self._executor.submit(self._notify, channel, payload)
+
+    async def stop(self):
+        for task in (self._reconnect_task, self._deliver_task):
+            if task is not None:
+                task.cancel()
+        if self._listen_conn is not None:
+            self._loop.remove_reader(self._listen_conn.fileno())
+            self._listen_conn.close()
+            self._listen_conn = None
+        # Espera as publicações pendentes fora do loop de eventos
+        await asyncio.to_thread(self._executor.shutdown, wait=True)
+        if self._publish_conn is not None:
+            self._publish_conn.close()
+
+
+def create_broker(backend: str = REALTIME_BACKEND, database_url: str | None = DATABASE_URL):
+    is_postgres = bool(database_url) and database_url.startswith("postgresql")
+    if backend == "postgres" or (backend == "auto" and is_postgres):
+        # psycopg2 entende apenas o esquema sem o driver ("postgresql+psycopg2://" -> "postgresql://")
+        return PostgresBroker("postgresql://" + database_url.split("://", 1)[1])
+    return InMemoryBroker()
+
+
+class ConnectionManager:
+    """
+    Distribui mensagens para os WebSockets inscritos em cada canal ("patient:<id>" ou "panel").
+    Cada mensagem é serializada uma única vez; conexões cuja fila enche ou cujo envio trava
+    são desconectadas. O `broker` leva as mensagens aos demais workers/instâncias.
+    """
+    def __init__(self, broker=None, queue_size: int = WS_QUEUE_SIZE, send_timeout: float = WS_SEND_TIMEOUT,
+                 heartbeat_interval: float = WS_HEARTBEAT_INTERVAL):
+        self.broker = broker or InMemoryBroker()
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.channels: dict[str, set[Connection]] = {}
+        self.evicted_count = 0
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        await self.broker.start(self._publish_local)
+
+    async def stop(self):
+        await self.broker.stop()
+
+    async def connect(self, websocket: WebSocket, channel: str, heartbeat: bool = False) -> Connection:
+        await websocket.accept()
+        self._loop = asyncio.get_running_loop()
+        connection = Connection(websocket, channel, heartbeat, self.queue_size)
+        connection.writer = asyncio.create_task(self._write_loop(connection))
+        self.channels.setdefault(channel, set()).add(connection)
+        WS_CONNECTIONS.labels(channel_type(channel)).inc()
+        logger.info("Nova conexão WebSocket no canal %s.", channel)
+        return connection
+
+    def disconnect(self, connection: Connection):
+        connections = self.channels.get(connection.channel)
+        if connections is not None and connection in connections:
+            connections.discard(connection)
+            if not connections:
+                del self.channels[connection.channel]
+            WS_CONNECTIONS.labels(channel_type(connection.channel)).dec()
+            logger.info("Conexão WebSocket fechada no canal %s.", connection.channel)
+        if connection.writer is not None and connection.writer is not asyncio.current_task():
+            connection.writer.cancel()
+
+    async def _evict(self, connection: Connection, reason: str):
+        if connection.closed:
+            return
+        connection.closed = True
+        self.evicted_count += 1
+        WS_EVICTIONS.inc()
+        logger.warning("Conexão WebSocket removida do canal %s: %s", connection.channel, reason)
+        self.disconnect(connection)
+        try:
+            await connection.websocket.close(code=1013)
+        except Exception:
+            pass
+
+    async def _write_loop(self, connection: Connection):
+        timeout = self.heartbeat_interval if connection.heartbeat else None
+        while True:
+            try:
+                payload, published_at = await asyncio.wait_for(connection.queue.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                payload, published_at = _PING, None
+            try:
+                await asyncio.wait_for(connection.websocket.send_text(payload), timeout=self.send_timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await self._evict(connection, f"{type(e).__name__}: {e}")
+                return
+            if published_at is not None:
+                WS_BROADCAST_SECONDS.observe(time.perf_counter() - published_at)
+
+    def _publish_local(self, channel: str, payload: str):
+        published_at = time.perf_counter()
+        for connection in list(self.channels.get(channel, ())):
+            if connection.closed:
+                continue
+            try:
+                connection.queue.put_nowait((payload, published_at))
+            except asyncio.QueueFull:
+                asyncio.create_task(self._evict(connection, "fila de envio cheia"))
+
+    def publish(self, channel: str, message: dict):
+        """
+        Enfileira a mensagem para todas as conexões do canal sem esperar os envios. Pode ser
+        chamada de endpoints síncronos (threadpool): nesse caso é repassada ao loop de eventos.
+        """
+        if not self.broker.distributed and channel not in self.channels:
+            return
+        payload = json.dumps(message, ensure_ascii=False, default=str)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._dispatch, channel, payload)
+            return
+        self._dispatch(channel, payload)
+
+    def _dispatch(self, channel: str, payload: str):
+        self._publish_local(channel, payload)
+        self.broker.publish(channel, payload)
+
+    async def broadcast_to_patient_viewers(self, patient_id: int, message: dict):
+        self.publish(patient_channel(patient_id), message)
+
+    def publish_patient_update(self, patient: dict):
+        """
+        Envia ao painel o estado atualizado de um paciente (novo alerta, nova mensagem, etc.).
+        """
+        self.publish(PANEL_CHANNEL, {"type": "patient_update", "patient": patient})
+
+    def stats(self):
+        return {
+            "connections": sum(len(connections) for connections in self.channels.values()),
+            "channels": len(self.channels),
+            "panel_connections": len(self.channels.get(PANEL_CHANNEL, ())),
+            "evicted": self.evicted_count,
+            "backend": type(self.broker).__name__,
+        }
+
+
+manager = ConnectionManager(broker=create_broker())
@@ -0,0 +1,266 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+from datetime import datetime, timezone, timedelta, time as dt_time
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from sqlalchemy.orm import Session
+from database.database import run_in_transaction
+from database import crud, models
+from outbox import OutboxDispatcher, outbox_dispatcher
+from send_scheduled_messages import MESSAGE_TO_SEND
+
+logger = logging.getLogger(__name__)
+
+# Agenda criada para pacientes sem nenhuma (equivalente ao antigo disparo das 12:00 UTC)
+DEFAULT_REMINDERS_ENABLED = os.getenv("DEFAULT_REMINDERS_ENABLED", "true").lower() in ("1", "true", "yes")
+DEFAULT_REMINDER_TIME = os.getenv("DEFAULT_REMINDER_TIME", "09:00")
+DEFAULT_REMINDER_TIMEZONE = os.getenv("DEFAULT_REMINDER_TIMEZONE", "America/Sao_Paulo")
+SCHEDULER_BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "200"))
+# Cada agenda é deslocada por um atraso fixo entre 0 e este valor, para espalhar os envios
+# (e as respostas dos pacientes) em vez de disparar todos no mesmo segundo
+SCHEDULER_JITTER_SECONDS = float(os.getenv("SCHEDULER_JITTER_SECONDS", "600"))
+# Quanto à frente as ocorrências são lidas do banco para o heap, e a cada quanto tempo
+SCHEDULER_LOOKAHEAD = timedelta(seconds=float(os.getenv("SCHEDULER_LOOKAHEAD_SECONDS", "900")))
+SCHEDULER_REFRESH_INTERVAL = float(os.getenv("SCHEDULER_REFRESH_INTERVAL", "60"))
+# Ocorrências atrasadas além disso (ex.: servidor parado a noite toda) não são enviadas
+SCHEDULER_MAX_LATENESS = timedelta(hours=float(os.getenv("SCHEDULER_MAX_LATENESS_HOURS", "6")))
+SCHEDULER_ERROR_BACKOFF = 5.0
+
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+
+def parse_recurrence(recurrence: str) -> set[int]:
+    """
+    "daily", "weekdays" ou dias separados por vírgula ("mon,wed,fri") -> dias da semana (segunda = 0).
+    """
+    if recurrence == "daily":
+        return set(range(7))
+    if recurrence == "weekdays":
+        return set(range(5))
+    days = {day.strip() for day in recurrence.split(",") if day.strip()}
+    if not days or not days <= set(WEEKDAYS):
+        raise ValueError(f"Recorrência inválida: {recurrence!r}. Use daily, weekdays ou dias como mon,wed,fri.")
+    return {WEEKDAYS.index(day) for day in days}
+
+def parse_send_time(send_time: str) -> dt_time:
+    try:
+        hour, minute = (int(part) for part in send_time.split(":"))
+        return dt_time(hour, minute)
+    except ValueError as e:
+        raise ValueError(f"Horário inválido: {send_time!r}. Use HH:MM.") from e
+
+def get_zone(timezone_name: str) -> ZoneInfo:
+    try:
+        return ZoneInfo(timezone_name)
+    except (ZoneInfoNotFoundError, ValueError) as e:
+        raise ValueError(f"Fuso horário inválido: {timezone_name!r}.") from e
+
+def next_occurrence(send_time: str, timezone_name: str, recurrence: str, after: datetime) -> datetime:
+    """
+    Próxima ocorrência (em UTC) estritamente depois de `after`. Lança ValueError se a agenda é inválida.
+    """
+    zone, days, at = get_zone(timezone_name), parse_recurrence(recurrence), parse_send_time(send_time)
+    local_after = after.astimezone(zone)
+    for offset in range(8):
+        day = local_after.date() + timedelta(days=offset)
+        if day.weekday() not in days:
+            continue
+        candidate = datetime.combine(day, at, tzinfo=zone)
+        if candidate > local_after:
+            return candidate.astimezone(timezone.utc)
+    raise ValueError("Agenda sem ocorrência futura.")
+
+def occurrence_key(schedule: models.ReminderSchedule, occurrence_at: datetime) -> str:
+    # Data local da ocorrência: identifica o lembrete do dia mesmo que o horário mude depois
+    return occurrence_at.astimezone(get_zone(schedule.timezone)).date().isoformat()
+
+def render_message(schedule: models.ReminderSchedule, patient: models.Patient) -> str:
+    return (schedule.template or MESSAGE_TO_SEND).replace("{nome}", patient.name or "")
+
+def _as_utc(value: datetime) -> datetime:
+    # O SQLite devolve datas sem fuso; elas são gravadas sempre em UTC
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+def create_default_schedules(db: Session, patient_ids: list[int] | None = None) -> int:
+    """
+    Agenda padrão para os pacientes sem nenhuma agenda (todos, ou só `patient_ids`).
+    """
+    if not DEFAULT_REMINDERS_ENABLED:
+        return 0
+    next_run_at = next_occurrence(DEFAULT_REMINDER_TIME, DEFAULT_REMINDER_TIMEZONE, "daily", datetime.now(timezone.utc))
+    return crud.ensure_default_schedules(db, DEFAULT_REMINDER_TIME, DEFAULT_REMINDER_TIMEZONE, next_run_at, patient_ids)
+
+def _process_due(db: Session, schedule_ids: list[int], now: datetime, max_lateness: timedelta):
+    """
+    Registra na outbox os lembretes das agendas vencidas e avança `next_run_at`, na mesma
+    transação. A chave "schedule:<id>:<data local>" impede envio duplicado da mesma ocorrência.
+    Devolve (ids de outbox pendentes, pulados por atendimento manual, pulados por atraso).
+    """
+    rows, skipped_manual, skipped_late = [], 0, 0
+    for schedule, patient in crud.lock_due_schedules(db, schedule_ids, now):
+        occurrence_at = _as_utc(schedule.next_run_at)
+        occurrence = occurrence_key(schedule, occurrence_at)
+        schedule.next_run_at = next_occurrence(schedule.send_time, schedule.timezone, schedule.recurrence, max(now, occurrence_at))
+        if now - occurrence_at > max_lateness:
+            skipped_late += 1
+            continue
+        if schedule.skip_manual and patient.status == "manual":
+            skipped_manual += 1
+            continue
+        schedule.last_run_at = now
+        schedule.last_occurrence = occurrence
+        rows.append({"idempotency_key": f"schedule:{schedule.id}:{occurrence}", "patient_id": patient.id,
+                     "to_number": patient.phone_number, "text": render_message(schedule, patient), "source": "schedule"})
+    return crud.enqueue_outbound_batch(db, rows), skipped_manual, skipped_late
+
+
+class ReminderScheduler:
+    """
+    Agendador em processo dos lembretes por paciente. As ocorrências dos próximos minutos são
+    lidas do banco para um heap, ordenadas pelo horário de disparo (com o jitter de cada agenda),
+    e disparadas em lotes. O estado fica no banco (`next_run_at`, `last_occurrence`), então um
+    reinício retoma as ocorrências pendentes sem pular nem repetir lembretes.
+    """
+    def __init__(self, dispatcher: OutboxDispatcher = outbox_dispatcher, batch_size: int = SCHEDULER_BATCH_SIZE,
+                 jitter: float = SCHEDULER_JITTER_SECONDS, lookahead: timedelta = SCHEDULER_LOOKAHEAD,
+                 refresh_interval: float = SCHEDULER_REFRESH_INTERVAL, max_lateness: timedelta = SCHEDULER_MAX_LATENESS):
+        self.dispatcher = dispatcher
+        self.batch_size = batch_size
+        self.jitter = jitter
+        self.lookahead = lookahead
+        self.refresh_interval = refresh_interval
+        self.max_lateness = max_lateness
+        # (horário de disparo, id da agenda, next_run_at lido do banco)
+        self._heap: list[tuple[float, int, datetime]] = []
+        self._queued: dict[int, datetime] = {}
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.sent_count = 0
+        self.failed_count = 0
+        self.skipped_manual_count = 0
+        self.skipped_late_count = 0
+        self.last_refresh_at: datetime | None = None
+        self.last_error: str | None = None
+
+    def _fire_at(self, schedule_id: int, next_run_at: datetime) -> float:
+        # Deslocamento fixo por agenda (hash multiplicativo): estável entre reinícios e uniforme na janela
+        return next_run_at.timestamp() + (schedule_id * 2654435761 % 2 ** 32) / 2 ** 32 * self.jitter
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def ensure_running(self) -> bool:
+        """
+        Reinicia o laço se ele não estiver rodando. Devolve True se precisou reiniciar.
+        """
+        if self.running:
+            return False
+        await self.stop()
+        await self.start()
+        return True
+
+    def notify(self):
+        """
+        Pede uma releitura imediata das agendas (ex.: uma agenda foi criada ou alterada).
+        """
+        self._wakeup.set()
+
+    async def ensure_default_schedules(self) -> int:
+        """
+        Varre todos os pacientes (anti-join): roda na partida e pelo watchdog. Pacientes novos
+        recebem a agenda padrão ao chegar a primeira mensagem (create_default_schedules).
+        """
+        return await run_in_transaction(create_default_schedules)
+
+    async def refresh(self):
+        now = datetime.now(timezone.utc)
+        for schedule_id, next_run_at in await run_in_transaction(crud.get_upcoming_schedules, now + self.lookahead):
+            next_run_at = _as_utc(next_run_at)
+            if self._queued.get(schedule_id) != next_run_at:
+                self._queued[schedule_id] = next_run_at
+                heapq.heappush(self._heap, (self._fire_at(schedule_id, next_run_at), schedule_id, next_run_at))
+        self.last_refresh_at = now
+
+    def _pop_due(self, now: float) -> list[int]:
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+            _, schedule_id, next_run_at = heapq.heappop(self._heap)
+            # Entradas substituídas por uma leitura mais recente da mesma agenda são descartadas
+            if self._queued.get(schedule_id) == next_run_at:
+                del self._queued[schedule_id]
+                due.append(schedule_id)
+        return due
+
+    async def _run_batch(self, schedule_ids: list[int]):
+        pending_ids, skipped_manual, skipped_late = await run_in_transaction(
+            _process_due, schedule_ids, datetime.now(timezone.utc), self.max_lateness)
+        self.skipped_manual_count += skipped_manual
+        self.skipped_late_count += skipped_late
+        # Se o processo cair aqui, os envios já registrados saem pelo laço de retentativas da outbox
+        for result in await asyncio.gather(*(self.dispatcher.deliver(outbound_id) for outbound_id in pending_ids)):
+            if result is None:
+                continue
+            if result.ok:
+                self.sent_count += 1
+            else:
+                self.failed_count += 1
+
+    async def _run(self):
+        next_refresh = 0.0
+        defaults_checked = False
+        while True:
+            try:
+                if not defaults_checked:
+                    await self.ensure_default_schedules()
+                    defaults_checked = True
+                if self._wakeup.is_set() or time.monotonic() >= next_refresh:
+                    self._wakeup.clear()
+                    await self.refresh()
+                    next_refresh = time.monotonic() + self.refresh_interval
+                due = self._pop_due(time.time())
+                if due:
+                    await self._run_batch(due)
+                    continue
+            except Exception as e:
+                self.last_error = str(e)
+                logger.exception("Erro no agendador de lembretes.")
+                # As agendas não enviadas continuam vencidas no banco e voltam na próxima leitura
+                next_refresh = min(next_refresh, time.monotonic() + SCHEDULER_ERROR_BACKOFF)
+                await asyncio.sleep(SCHEDULER_ERROR_BACKOFF)
+                continue
+            timeout = next_refresh - time.monotonic()
+            if self._heap:
+                timeout = min(timeout, self._heap[0][0] - time.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, timeout))
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "queued": len(self._queued),
+            "next_fire_at": datetime.fromtimestamp(self._heap[0][0], tz=timezone.utc).isoformat() if self._heap else None,
+            "sent": self.sent_count,
+            "failed": self.failed_count,
+            "skipped_manual": self.skipped_manual_count,
+            "skipped_late": self.skipped_late_count,
+            "last_refresh_at": self.last_refresh_at.isoformat() if self.last_refresh_at else None,
+            "last_error": self.last_error,
+        }
+
+
+reminder_scheduler = ReminderScheduler()
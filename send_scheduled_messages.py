@@ -1,84 +1,141 @@
 import os
-import httpx
+import uuid
+import asyncio
+import logging
+from datetime import datetime, timezone
 from sqlalchemy.orm import Session
-from database.database import SessionLocal
-from database import crud, models
+from database.database import async_engine, run_in_transaction
+from database import crud
+from whatsapp import whatsapp_client
+from outbox import OutboxDispatcher, outbox_dispatcher
+from instrumentation import configure_logging
 
-# Carrega as variáveis de ambiente necessárias para a API do WhatsApp
-WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN" )
-PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
-# Garante que a versão da API do Graph seja uma mais recente
-WHATSAPP_API_URL = f"https://graph.facebook.com/v20.0/{PHONE_NUMBER_ID}/messages"
+logger = logging.getLogger(__name__)
 
 # Mensagem que será enviada aos pacientes
 # IMPORTANTE: Para um ambiente de produção, esta mensagem precisa ser um "Template"
 # pré-aprovado pela Meta. Para nosso número de teste, podemos enviar texto livre.
 MESSAGE_TO_SEND = "Olá! Este é um lembrete automático do Cuide.me. Como você está se sentindo hoje?"
 
-def send_whatsapp_message(phone_number: str, message: str ):
+# Quantidade de pacientes lidos do banco por vez
+PATIENT_BATCH_SIZE = int(os.getenv("PATIENT_BATCH_SIZE", "500"))
+
+
+class BulkSendJob:
     """
-    Função que envia uma mensagem de texto para um número de WhatsApp específico.
+    Estado de um disparo em massa. Os lembretes do dia a dia saem pelo agendador (scheduler.py);
+    este disparo para todos os pacientes fica para envios avulsos pela linha de comando.
     """
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
-        "Content-Type": "application/json",
-    }
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": phone_number,
-        "type": "text",
-        "text": {"body": message},
-    }
-    
-    try:
-        with httpx.Client( ) as client:
-            response = client.post(WHATSAPP_API_URL, json=payload, headers=headers)
-            response.raise_for_status()  # Lança um erro se a resposta for 4xx ou 5xx
-        
-        print(f"Mensagem enviada com sucesso para {phone_number}. Status: {response.status_code}")
-        return True
-    except httpx.HTTPStatusError as e:
-        print(f"Erro ao enviar mensagem para {phone_number}: {e.response.status_code}" )
-        print(f"Detalhe do erro: {e.response.text}")
-        return False
-    except Exception as e:
-        print(f"Ocorreu um erro inesperado: {e}")
-        return False
+    def __init__(self, text: str, key: str | None = None):
+        self.id = uuid.uuid4().hex
+        self.text = text
+        # Prefixo das chaves de idempotência na outbox: repetir um job com a mesma chave
+        # só envia para quem ainda não recebeu
+        self.key = key or f"bulk:{self.id}"
+        self.status = "pending"
+        self.total = 0
+        self.success_count = 0
+        self.failure_count = 0
+        self.skipped_count = 0
+        # Envios que já tinham falhado em uma execução anterior com a mesma chave (não repetidos)
+        self.previously_failed_count = 0
+        self.error: str | None = None
+        self.created_at = datetime.now(timezone.utc)
+        self.finished_at: datetime | None = None
 
-def run_task():
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "total": self.total,
+            "processed": self.success_count + self.failure_count + self.skipped_count + self.previously_failed_count,
+            "success_count": self.success_count,
+            "failure_count": self.failure_count,
+            "skipped_count": self.skipped_count,
+            "previously_failed_count": self.previously_failed_count,
+            "error": self.error,
+            "created_at": self.created_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+def _prepare_batch(db: Session, job: BulkSendJob, after_id: int, limit: int):
+    """
+    Lê o próximo lote de pacientes e registra os envios na outbox. Devolve o último id lido
+    (None ao fim da tabela), os ids de outbox ainda pendentes, quantos já tinham sido enviados
+    (ou estão em andamento) e quantos já tinham falhado.
+    """
+    patients = crud.get_patients_batch(db, after_id=after_id, limit=limit)
+    if not patients:
+        return None, [], 0, 0
+    rows = [{"idempotency_key": f"{job.key}:{p.id}", "patient_id": p.id, "to_number": p.phone_number,
+             "text": job.text, "source": "daily"} for p in patients]
+    pending_ids = crud.enqueue_outbound_batch(db, rows)
+    failed = crud.count_outbound_by_status(db, [row["idempotency_key"] for row in rows], "failed")
+    return patients[-1].id, pending_ids, len(patients) - len(pending_ids) - failed, failed
+
+
+async def run_bulk_send(job: BulkSendJob, dispatcher: OutboxDispatcher = outbox_dispatcher, batch_size: int = PATIENT_BATCH_SIZE):
     """
-    Função principal do script: busca todos os pacientes e envia a mensagem para cada um.
+    Percorre os pacientes em lotes e envia a mensagem do `job` para cada um pela outbox.
+    A concorrência e o limite de taxa ficam a cargo do cliente do WhatsApp; o próximo lote
+    é lido enquanto o atual é enviado.
     """
-    print("--- INICIANDO TAREFA DE ENVIO DE MENSAGENS PROGRAMADAS ---")
-    
-    # Cria uma sessão com o banco de dados
-    db: Session = SessionLocal()
-    
+    logger.info("--- INICIANDO TAREFA DE ENVIO DE MENSAGENS PROGRAMADAS (job %s) ---", job.id)
+    job.status = "running"
+
+    async def send_one(outbound_id: int):
+        result = await dispatcher.deliver(outbound_id)
+        if result is None:
+            job.skipped_count += 1
+        elif result.ok:
+            job.success_count += 1
+        else:
+            job.failure_count += 1
+
     try:
-        patients = crud.get_all_patients(db)
-        if not patients:
-            print("Nenhum paciente encontrado no banco de dados. Tarefa encerrada.")
-            return
-
-        print(f"Encontrados {len(patients)} pacientes. Iniciando envios...")
-        
-        success_count = 0
-        failure_count = 0
-
-        for patient in patients:
-            # Adiciona uma verificação para não enviar para si mesmo se não quiser
-            # if patient.phone_number == "SEU_NUMERO_DE_TESTE": continue
-            if send_whatsapp_message(patient.phone_number, MESSAGE_TO_SEND):
-                success_count += 1
-            else:
-                failure_count += 1
-        
-        print("--- TAREFA CONCLUÍDA ---")
-        print(f"Resumo: {success_count} mensagens enviadas com sucesso, {failure_count} falhas.")
+        job.total = await run_in_transaction(crud.count_patients)
+        last_id, pending_ids, skipped, failed = await run_in_transaction(_prepare_batch, job, 0, batch_size)
+        while last_id is not None:
+            job.skipped_count += skipped
+            job.previously_failed_count += failed
+            next_batch = asyncio.create_task(run_in_transaction(_prepare_batch, job, last_id, batch_size))
+            await asyncio.gather(*(send_one(outbound_id) for outbound_id in pending_ids))
+            last_id, pending_ids, skipped, failed = await next_batch
+        job.status = "completed"
+    except Exception as e:
+        job.status = "failed"
+        job.error = str(e)
+        logger.exception("Erro fatal na tarefa de envio %s.", job.id)
+    finally:
+        job.finished_at = datetime.now(timezone.utc)
+
+    logger.info("--- TAREFA CONCLUÍDA ---")
+    logger.info("Resumo: %s mensagens enviadas com sucesso, %s falhas, %s já enviadas anteriormente, "
+                "%s que já tinham falhado (não repetidas).",
+                job.success_count, job.failure_count, job.skipped_count, job.previously_failed_count,
+                extra={"job_id": job.id, "sent": job.success_count, "failed": job.failure_count, "skipped": job.skipped_count,
+                       "previously_failed": job.previously_failed_count})
+    return job
+
+
+def daily_job_key() -> str:
+    return f"daily:{datetime.now(timezone.utc).date().isoformat()}"
 
+
+async def _run_standalone():
+    try:
+        await run_bulk_send(BulkSendJob(MESSAGE_TO_SEND, key=daily_job_key()))
     finally:
-        # Garante que a conexão com o banco de dados seja sempre fechada
-        db.close()
+        await whatsapp_client.aclose()
+        await async_engine.dispose()
+
+def run_task():
+    """
+    Função principal do script: envia a mensagem a todos os pacientes e aguarda o término.
+    """
+    configure_logging()
+    asyncio.run(_run_standalone())
 
 if __name__ == "__main__":
     run_task()
@@ -0,0 +1,127 @@
+import os
+import asyncio
+import logging
+from database.database import run_in_transaction
+from database import crud
+from ai_gateway import AIGateway, ai_gateway
+
+logger = logging.getLogger(__name__)
+
+# Orçamento aproximado de tokens de conversa nova enviados por chamada ao modelo
+SUMMARY_TOKEN_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", "6000"))
+CHARS_PER_TOKEN = 4
+SUMMARY_FETCH_BATCH = 500
+# Espera antes de atualizar o resumo em segundo plano, para agrupar rajadas de mensagens
+SUMMARY_PRECOMPUTE_DELAY = float(os.getenv("SUMMARY_PRECOMPUTE_DELAY", "60"))
+
+SUMMARY_INSTRUCTIONS = ("Você é um assistente de saúde inteligente. Sua tarefa é resumir a seguinte conversa entre um paciente em tratamento e um profissional de saúde para que o profissional possa entender rapidamente o estado do paciente. O resumo deve ser conciso e útil.\n\n"
+    "Por favor, resuma a conversa abaixo em bullet points, focando em: "
+    "1. Evolução de sintomas ou queixas. "
+    "2. Adesão ao tratamento (medicamentos, dieta, exercícios). "
+    "3. Efeitos colaterais mencionados. "
+    "4. Estado emocional ou humor geral relatado. "
+    "5. Dados numéricos específicos reportados (peso, pressão, etc.).\n\n"
+    "Seja direto ao ponto e não invente informações que não estão na conversa.\n\n")
+
+UPDATE_INSTRUCTIONS = ("Abaixo está o resumo já existente da conversa e as mensagens trocadas depois dele. "
+    "Atualize o resumo incorporando as novas mensagens, mantendo as informações anteriores que continuam relevantes "
+    "e destacando mudanças recentes. Mantenha o resumo com no máximo 300 palavras.\n\n")
+
+
+def build_prompt(previous_summary: str | None, lines: list[str]) -> str:
+    conversation = "\n".join(lines)
+    if previous_summary is None:
+        return f"{SUMMARY_INSTRUCTIONS}--- CONVERSA ---\n{conversation}\n--- RESUMO ---"
+    return (f"{SUMMARY_INSTRUCTIONS}{UPDATE_INSTRUCTIONS}--- RESUMO ANTERIOR ---\n{previous_summary}\n"
+            f"--- NOVAS MENSAGENS ---\n{conversation}\n--- RESUMO ATUALIZADO ---")
+
+
+def _load_chunk(db, patient_id: int, after_id: int, char_budget: int, include_archive: bool = False):
+    """
+    Lê as mensagens seguintes a `after_id` até o limite de caracteres (ao menos uma mensagem).
+    O bloco para antes de uma mensagem do profissional ainda na outbox: ela entra no resumo
+    quando for enviada (e fica de fora se falhar). Devolve (linhas, id da última mensagem incluída).
+    """
+    lines, last_id, used = [], None, 0
+    for msg in crud.get_messages_after(db, patient_id, after_id=after_id, limit=SUMMARY_FETCH_BATCH, include_archive=include_archive):
+        if msg.delivery_status == "pending":
+            break
+        sender_name = "Profissional" if msg.sender == 'professional' else "Paciente"
+        line = f"{sender_name}: {msg.text}"
+        if lines and used + len(line) > char_budget:
+            break
+        lines.append(line)
+        last_id = msg.id
+        used += len(line) + 1
+    return lines, last_id
+
+def _load_state(db, patient_id: int):
+    stored = crud.get_conversation_summary(db, patient_id)
+    return (stored.summary, stored.last_message_id, bool(stored.includes_archive)) if stored else (None, 0, False)
+
+
+class ConversationSummarizer:
+    """
+    Resumos incrementais: cada pedido envia ao modelo só o resumo anterior e as mensagens
+    novas desde a última cobertura, em blocos limitados por um orçamento de tokens. Sem
+    mensagens novas, devolve o resumo salvo sem chamar o modelo.
+    """
+    def __init__(self, gateway: AIGateway = ai_gateway, token_budget: int = SUMMARY_TOKEN_BUDGET,
+                 precompute_delay: float = SUMMARY_PRECOMPUTE_DELAY):
+        self.gateway = gateway
+        self.char_budget = token_budget * CHARS_PER_TOKEN
+        self.precompute_delay = precompute_delay
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._scheduled: dict[int, asyncio.Task] = {}
+
+    async def summarize(self, patient_id: int, include_archive: bool = False) -> dict | None:
+        """
+        Devolve {"summary", "cached", "last_message_id", "includes_archive"} ou None se o paciente
+        não tem mensagens. Com `include_archive`, um resumo salvo que só cobria as mensagens em uso
+        é refeito desde o início do arquivo; depois disso, as atualizações continuam incluindo o arquivo.
+        """
+        lock = self._locks.setdefault(patient_id, asyncio.Lock())
+        async with lock:
+            summary, last_id, with_archive = await run_in_transaction(_load_state, patient_id)
+            if include_archive and not with_archive:
+                # As mensagens arquivadas têm ids anteriores aos já cobertos: recomeça do início
+                summary, last_id, with_archive = None, 0, True
+            cached = True
+            while True:
+                lines, chunk_last_id = await run_in_transaction(_load_chunk, patient_id, last_id, self.char_budget, with_archive)
+                if not lines:
+                    break
+                cached = False
+                summary = await self.gateway.generate(build_prompt(summary, lines), kind="summary")
+                last_id = chunk_last_id
+                # Salva a cada bloco: se um bloco falhar, o progresso dos anteriores não se perde
+                await run_in_transaction(crud.save_conversation_summary, patient_id, summary, last_id, len(lines), with_archive)
+        if summary is None:
+            return None
+        return {"summary": summary, "cached": cached, "last_message_id": last_id, "includes_archive": with_archive}
+
+    def schedule_refresh(self, patient_id: int):
+        """
+        Agenda a atualização do resumo em segundo plano (ex.: após um alerta), uma por paciente.
+        """
+        if patient_id in self._scheduled:
+            return
+        self._scheduled[patient_id] = asyncio.create_task(self._refresh_later(patient_id))
+
+    async def _refresh_later(self, patient_id: int):
+        try:
+            await asyncio.sleep(self.precompute_delay)
+            await self.summarize(patient_id)
+        except Exception:
+            logger.exception("Erro ao atualizar o resumo do paciente %s em segundo plano.", patient_id)
+        finally:
+            self._scheduled.pop(patient_id, None)
+
+    async def stop(self):
+        tasks = list(self._scheduled.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+summarizer = ConversationSummarizer()
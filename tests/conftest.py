@@ -0,0 +1,40 @@
+"""
+Configuração comum dos testes. Os módulos da aplicação leem as variáveis de ambiente na
+importação: sem DATABASE_URL, os testes usam um SQLite temporário.
+
+Uso (a partir da raiz do projeto):
+    pip install pytest
+    python -m pytest -q
+"""
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/testes.db")
+os.environ.setdefault("REALTIME_BACKEND", "memory")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+@pytest.fixture
+def db():
+    """
+    Sessão em um banco com as tabelas criadas; o que o teste gravou é apagado ao final.
+    """
+    from database.database import SessionLocal, engine, async_engine, ensure_search_index
+    from database import models
+    models.Base.metadata.create_all(bind=engine)
+    ensure_search_index()
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+        with engine.begin() as conn:
+            for table in reversed(models.Base.metadata.sorted_tables):
+                conn.execute(table.delete())
+        # Cada TestClient roda o próprio loop de eventos: conexões assíncronas não são reaproveitadas
+        async_engine.sync_engine.dispose(close=False)
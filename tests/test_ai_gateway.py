@@ -0,0 +1,109 @@
+import asyncio
+import pytest
+from ai_gateway import AIGateway, StubModel, TTLCache, auto_reply_cache_key
+
+
+class FailingModel:
+    def __init__(self, error: Exception | None = None, text: str = "", latency: float = 0.0):
+        self.error = error
+        self.text = text
+        self.latency = latency
+        self.calls = 0
+
+    async def generate_content_async(self, prompt: str):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if self.error is not None:
+            raise self.error
+        return StubModel._Response(self.text)
+
+
+def _gateway(model, **options) -> AIGateway:
+    return AIGateway(model_factory=lambda: model, **options)
+
+
+def test_chave_mantem_interrogacao_e_paciente():
+    assert auto_reply_cache_key("Tomei o remédio!") == auto_reply_cache_key("tomei  o remedio")
+    assert auto_reply_cache_key("Tudo bem?") != auto_reply_cache_key("tudo bem")
+    assert auto_reply_cache_key("Tudo bem??") == auto_reply_cache_key("tudo bem ?")
+
+
+def test_cache_reaproveita_a_decisao_para_mensagens_equivalentes():
+    model = StubModel()
+    gateway = _gateway(model)
+
+    async def run():
+        first = await gateway.decide_auto_reply("Tomei o remédio!")
+        second = await gateway.decide_auto_reply("tomei o remedio")
+        question = await gateway.decide_auto_reply("tomei o remedio?")
+        return first, second, question
+
+    first, second, _ = asyncio.run(run())
+    assert first == second == {"responder": True, "texto_resposta": "Obrigado por compartilhar!"}
+    assert model.calls == 2
+    assert (gateway.cache_hits, gateway.cache_misses) == (1, 2)
+
+
+def test_pedidos_simultaneos_compartilham_a_chamada():
+    model = StubModel(latency=0.05)
+    gateway = _gateway(model)
+
+    async def run():
+        return await asyncio.gather(*(gateway.decide_auto_reply("estou bem") for _ in range(5)))
+
+    results = asyncio.run(run())
+    assert model.calls == 1
+    assert all(result == results[0] for result in results)
+    assert gateway._inflight == {}
+
+
+def test_erro_chega_a_todos_e_nao_fica_em_cache():
+    model = FailingModel(error=RuntimeError("quota"), latency=0.02)
+    gateway = _gateway(model)
+
+    async def run():
+        return await asyncio.gather(*(gateway.decide_auto_reply("estou bem") for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert model.calls == 1
+    assert len(gateway.cache) == 0
+    assert gateway.stats()["calls"]["auto_reply"]["errors"] == 1
+    # A próxima mensagem tenta de novo
+    model.error, model.text = None, '{"responder": false}'
+    assert asyncio.run(gateway.decide_auto_reply("estou bem")) == {"responder": False}
+    assert model.calls == 2
+
+
+def test_json_invalido_nao_fica_em_cache():
+    model = FailingModel(text="não sei")
+    gateway = _gateway(model)
+    with pytest.raises(ValueError):
+        asyncio.run(gateway.decide_auto_reply("estou bem"))
+    assert len(gateway.cache) == 0
+
+
+def test_resposta_em_bloco_de_codigo():
+    gateway = _gateway(FailingModel(text='```json\n{"responder": false}\n```'))
+    assert asyncio.run(gateway.decide_auto_reply("preciso de ajuda")) == {"responder": False}
+
+
+def test_timeout():
+    model = FailingModel(text='{"responder": false}', latency=0.2)
+    gateway = _gateway(model, timeout=0.01)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(gateway.decide_auto_reply("estou bem"))
+    assert gateway.stats()["calls"]["auto_reply"]["timeouts"] == 1
+
+
+def test_ttl_cache_expira_e_limita_o_tamanho():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    # "b" foi o menos usado recentemente
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
+    expired = TTLCache(maxsize=2, ttl=-1)
+    expired.put("a", 1)
+    assert expired.get("a") is None
@@ -0,0 +1,74 @@
+import os
+import json
+import pytest
+from alert_detector import AlertDetector, normalize_text, alert_detector
+
+
+@pytest.mark.parametrize("text", [
+    "não aguento a dor no peito",
+    "nao sei se é febre",
+    "estou com febre",
+    "Dor de cabeça forte",
+    "não tenho dor, mas estou com febre",
+    "nunca senti uma dor assim",
+    "sem remédio e com dor",
+    "não tomei o remédio",
+    "passei a noite sem dormir",
+    "me sinto triste",
+    "estou muito ansiosa",
+])
+def test_alerta_mantido(text):
+    assert alert_detector.detect(text).has_alert, text
+
+
+@pytest.mark.parametrize("text", [
+    "sem febre hoje",
+    "não tenho febre",
+    "nunca tive febre",
+    "estou sem dor",
+    "nenhuma dor desde ontem",
+    "não sinto dor",
+    "tudo bem, obrigado",
+])
+def test_negacao_direta_ou_sem_termo(text):
+    assert not alert_detector.detect(text).has_alert, text
+
+
+def test_negacao_nao_atravessa_a_oracao():
+    result = alert_detector.detect("não. dor forte")
+    assert result.terms == ["dor"]
+
+
+def test_negacao_registrada():
+    result = alert_detector.detect("sem febre, mas com dor")
+    assert result.negated == ["febre"]
+    assert result.terms == ["dor"]
+
+
+def test_limites_de_palavra():
+    assert not alert_detector.detect("o cuidador adorei").terms
+
+
+def test_acentos_e_curinga():
+    assert alert_detector.detect("Está DIFICIL").terms == ["difícil"]
+    assert alert_detector.detect("ando ansioso").terms == ["ansios*"]
+
+
+def test_pontuacao_soma_gravidades():
+    result = alert_detector.detect("febre e dor")
+    assert result.score == 5
+
+
+def test_normalize_text():
+    assert normalize_text("  Não   Está ") == "nao esta"
+
+
+def test_recarrega_lexico(tmp_path):
+    path = tmp_path / "lexico.json"
+    path.write_text(json.dumps({"threshold": 1, "terms": [{"term": "febre"}]}))
+    detector = AlertDetector(str(path), check_interval=0)
+    assert detector.detect("tosse").terms == []
+    path.write_text(json.dumps({"threshold": 1, "terms": [{"term": "tosse"}]}))
+    # Garante mtime diferente mesmo em sistemas de arquivos com resolução baixa
+    os.utime(path, (1, 1))
+    assert detector.detect("tosse").terms == ["tosse"]
@@ -0,0 +1,39 @@
+from sqlalchemy import select
+from database import crud, models
+from analytics import rebuild_engagement_batch
+
+
+def _counters(db, patient_id):
+    db.expire_all()
+    rows = db.scalars(select(models.PatientDailyStats).where(models.PatientDailyStats.patient_id == patient_id)).all()
+    return {name: sum(getattr(row, name) for row in rows) for name in crud.DAILY_STATS_COUNTERS}
+
+
+def test_resposta_do_profissional_so_conta_depois_do_envio(db):
+    patient = crud.get_or_create_patient(db, "5511900000001")
+    crud.create_message(db, patient.id, "estou com febre", False)
+    db.commit()
+
+    outbound, _ = crud.create_professional_message(db, patient.id, "como está?", "falha")
+    db.commit()
+    crud.claim_outbound_message(db, outbound.id)
+    crud.record_outbound_result(db, outbound.id, False, error="número inválido")
+    db.commit()
+    assert _counters(db, patient.id)["professional_replies"] == 0
+    assert db.get(models.Patient, patient.id).awaiting_reply_since is not None
+
+    outbound, _ = crud.create_professional_message(db, patient.id, "ainda pendente", "pendente")
+    db.commit()
+    assert _counters(db, patient.id)["professional_replies"] == 0
+
+    crud.claim_outbound_message(db, outbound.id)
+    crud.record_outbound_result(db, outbound.id, True, "wamid.ok")
+    db.commit()
+    incremental = _counters(db, patient.id)
+    assert (incremental["professional_replies"], incremental["professional_messages"]) == (1, 1)
+    assert db.get(models.Patient, patient.id).awaiting_reply_since is None
+
+    rebuild_engagement_batch(db, 0, 100, alert_threshold=1.0)
+    db.commit()
+    rebuilt = _counters(db, patient.id)
+    assert (rebuilt["professional_replies"], rebuilt["professional_messages"], rebuilt["patient_messages"]) == (1, 1, 1)
@@ -0,0 +1,29 @@
+import asyncio
+from database import crud
+from outbox import OutboxDispatcher
+from send_scheduled_messages import BulkSendJob, run_bulk_send
+from whatsapp import SendResult
+
+
+class FakeWhatsApp:
+    def __init__(self, failing: set[str]):
+        self.failing = failing
+
+    async def send_text(self, to_number: str, text: str, max_retries: int | None = None) -> SendResult:
+        if to_number in self.failing:
+            return SendResult(ok=False, status_code=400, error="número inválido")
+        return SendResult(ok=True, status_code=200, message_id=f"wamid.{to_number}")
+
+
+def test_repeticao_separa_enviadas_e_falhas_anteriores(db):
+    for phone in ("5511900000001", "5511900000002", "5511900000003"):
+        crud.get_or_create_patient(db, phone)
+    db.commit()
+    dispatcher = OutboxDispatcher(client=FakeWhatsApp({"5511900000002"}))
+
+    first = asyncio.run(run_bulk_send(BulkSendJob("Olá", key="teste"), dispatcher, batch_size=2))
+    assert (first.success_count, first.failure_count, first.skipped_count, first.previously_failed_count) == (2, 1, 0, 0)
+
+    again = asyncio.run(run_bulk_send(BulkSendJob("Olá", key="teste"), dispatcher, batch_size=2))
+    assert again.status == "completed"
+    assert (again.success_count, again.failure_count, again.skipped_count, again.previously_failed_count) == (0, 0, 2, 1)
@@ -0,0 +1,65 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from sqlalchemy import text
+from database import crud, models
+from database.database import engine, with_session, run_in_transaction, upgrade_schema
+
+
+def test_get_or_create_patient_devolve_o_paciente_existente(db):
+    first = crud.get_or_create_patient(db, "5511900000001")
+    first.name = "Ana"
+    db.commit()
+    again = crud.get_or_create_patient(db, "5511900000001")
+    assert again.id == first.id and again.name == "Ana"
+    assert crud.count_patients(db) == 1
+
+
+def test_primeiras_mensagens_simultaneas_chegam_ao_mesmo_paciente(db):
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        ids = list(pool.map(lambda _: with_session(crud.get_or_create_patient, "5511900000001").id, range(8)))
+    assert len(set(ids)) == 1
+    assert crud.count_patients(db) == 1
+
+
+def test_mensagem_repetida_do_whatsapp_e_descartada(db):
+    patient = crud.get_or_create_patient(db, "5511900000001")
+    first = crud.create_message(db, patient.id, "dor forte", True, external_id="wamid.1")
+    assert crud.create_message(db, patient.id, "dor forte", True, external_id="wamid.1") is None
+    db.commit()
+    db.expire_all()
+    assert db.query(models.Message).count() == 1
+    assert db.get(models.Message, first.id).external_id == "wamid.1"
+    assert db.get(models.Patient, patient.id).unread_alert_count == 1
+
+
+def _create_and_fail(db, phone_number):
+    crud.get_or_create_patient(db, phone_number)
+    raise RuntimeError("falha no meio da transação")
+
+
+def test_with_session_confirma_ou_desfaz(db):
+    with_session(crud.get_or_create_patient, "5511900000001")
+    with pytest.raises(RuntimeError):
+        with_session(_create_and_fail, "5511900000002")
+    assert [p.phone_number for p in crud.get_all_patients(db)] == ["5511900000001"]
+
+
+def test_run_in_transaction_confirma_ou_desfaz(db):
+    async def run():
+        patient = await run_in_transaction(crud.get_or_create_patient, "5511900000001")
+        with pytest.raises(RuntimeError):
+            await run_in_transaction(_create_and_fail, "5511900000002")
+        return patient
+
+    patient = asyncio.run(run())
+    # expire_on_commit=False: o objeto devolvido continua legível depois do commit
+    assert patient.phone_number == "5511900000001"
+    assert [p.phone_number for p in crud.get_all_patients(db)] == ["5511900000001"]
+
+
+def test_upgrade_schema_adiciona_so_as_colunas_que_faltam(db):
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE conversation_summaries DROP COLUMN includes_archive"))
+    assert upgrade_schema() == {"conversation_summaries.includes_archive"}
+    assert upgrade_schema() == set()
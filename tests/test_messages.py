@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import update
+from database import crud, models
+import main
+
+
+@pytest.fixture
+def history(db):
+    """
+    Seis mensagens em ordem cronológica; a terceira e a quarta têm o mesmo horário (o id desempata).
+    """
+    patient = crud.get_or_create_patient(db, "5511900000001")
+    start = datetime.now(timezone.utc) - timedelta(days=10)
+    ids = []
+    for i, minutes in enumerate((0, 1, 2, 2, 3, 4)):
+        message = crud.create_message(db, patient.id, f"mensagem {i}", False)
+        db.execute(update(models.Message).where(models.Message.id == message.id).values(timestamp=start + timedelta(minutes=minutes)))
+        ids.append(message.id)
+    db.commit()
+    return patient.id, ids
+
+
+def _ids(messages):
+    return [message.id for message in messages]
+
+
+@pytest.mark.parametrize("include_archive", [False, True])
+def test_paginas_para_tras_e_para_frente(db, history, include_archive):
+    patient_id, ids = history
+    page, has_more = crud.get_messages_page(db, patient_id, limit=2, include_archive=include_archive)
+    assert (_ids(page), has_more) == (ids[4:], True)
+
+    older, seen = [], ids[4:]
+    while True:
+        page, has_more = crud.get_messages_page(db, patient_id, limit=2, before=seen[0], include_archive=include_archive)
+        seen = _ids(page)
+        older = seen + older
+        if not has_more:
+            break
+    assert older == ids[:4]
+
+    page, has_more = crud.get_messages_page(db, patient_id, limit=2, after=ids[1], include_archive=include_archive)
+    assert (_ids(page), has_more) == (ids[2:4], True)
+    page, has_more = crud.get_messages_page(db, patient_id, limit=2, after=ids[3], include_archive=include_archive)
+    assert (_ids(page), has_more) == (ids[4:], False)
+
+
+def test_paginacao_atravessa_o_arquivo(db, history):
+    patient_id, ids = history
+    crud.archive_messages(db, datetime.now(timezone.utc), limit=3)
+    db.commit()
+    hot, _ = crud.get_messages_page(db, patient_id, limit=10)
+    assert _ids(hot) == ids[3:]
+
+    page, has_more = crud.get_messages_page(db, patient_id, limit=2, before=ids[3], include_archive=True)
+    assert (_ids(page), has_more) == (ids[1:3], True)
+    page, has_more = crud.get_messages_page(db, patient_id, limit=10, after=ids[0], include_archive=True)
+    assert (_ids(page), has_more) == (ids[1:], False)
+    assert crud.get_messages_page(db, patient_id, limit=2, before=999999, include_archive=True) == ([], False)
+
+
+def test_endpoint_devolve_cursores_nos_cabecalhos(db, history):
+    patient_id, ids = history
+    client = TestClient(main.app)
+    latest = client.get(f"/api/messages/{patient_id}", params={"limit": 4})
+    assert [m["id"] for m in latest.json()] == ids[2:]
+    assert latest.headers["X-Before-Cursor"] == str(ids[2])
+
+    older = client.get(f"/api/messages/{patient_id}", params={"limit": 4, "before": latest.headers["X-Before-Cursor"]})
+    assert [m["id"] for m in older.json()] == ids[:2]
+    assert "X-Before-Cursor" not in older.headers
+
+    newer = client.get(f"/api/messages/{patient_id}", params={"limit": 2, "after": ids[0]})
+    assert newer.headers["X-After-Cursor"] == str(ids[2])
+    assert client.get(f"/api/messages/{patient_id}", params={"before": ids[3], "after": ids[0]}).status_code == 400
@@ -0,0 +1,60 @@
+from datetime import datetime, timedelta, timezone
+from fastapi.testclient import TestClient
+from database import crud, models
+import main
+
+
+def _patients(db):
+    # (telefone, alertas não lidos, horas desde a última mensagem)
+    now = datetime.now(timezone.utc)
+    for phone, alerts, hours in (("5511900000001", 5, 48), ("5511900000002", 1, 1),
+                                 ("5511900000003", 0, 0), ("5511900000004", 0, 24)):
+        patient = crud.get_or_create_patient(db, phone)
+        patient.unread_alert_count = alerts
+        patient.last_message_at = now - timedelta(hours=hours)
+    db.commit()
+
+EXPECTED = ["5511900000002", "5511900000001", "5511900000003", "5511900000004"]
+
+
+def test_alerta_recente_vem_antes_de_muitos_alertas_antigos(db):
+    _patients(db)
+    patients, next_cursor = crud.get_patients_page(db, limit=None)
+    assert [p.phone_number for p in patients] == EXPECTED
+    assert next_cursor is None
+
+
+def test_cursor_percorre_todas_as_paginas(db):
+    _patients(db)
+    phones, cursor = [], None
+    while True:
+        patients, cursor = crud.get_patients_page(db, limit=1, cursor=cursor)
+        phones += [p.phone_number for p in patients]
+        if cursor is None:
+            break
+    assert phones == EXPECTED
+
+
+def test_endpoint_sem_parametros_devolve_todos(db):
+    _patients(db)
+    client = TestClient(main.app)
+    response = client.get("/api/patients")
+    assert response.status_code == 200
+    assert [p["phone_number"] for p in response.json()] == EXPECTED
+    assert "X-Next-Cursor" not in response.headers
+
+    first = client.get("/api/patients", params={"limit": 3})
+    assert [p["phone_number"] for p in first.json()] == EXPECTED[:3]
+    rest = client.get("/api/patients", params={"cursor": first.headers["X-Next-Cursor"]})
+    assert [p["phone_number"] for p in rest.json()] == EXPECTED[3:]
+    assert client.get("/api/patients", params={"cursor": "inválido"}).status_code == 400
+
+
+def test_ultima_atividade_usa_o_horario_da_mensagem(db):
+    patient = crud.get_or_create_patient(db, "5511900000001")
+    message = crud.create_message(db, patient.id, "bom dia", False)
+    db.commit()
+    db.expire_all()
+    patient = db.get(models.Patient, patient.id)
+    assert crud._as_utc(patient.last_message_at) == crud._as_utc(message.timestamp)
+    assert crud._as_utc(patient.last_patient_message_at) == crud._as_utc(message.timestamp)
@@ -0,0 +1,101 @@
+import pytest
+from datetime import timedelta
+from fastapi.testclient import TestClient
+from sqlalchemy import select
+from database import crud, models
+from whatsapp import SendResult
+import main
+
+
+class FakeWhatsApp:
+    def __init__(self, *results: SendResult):
+        self.results = list(results)
+        self.sent = []
+        self.max_retries = []
+
+    async def send_text(self, to_number: str, text: str, max_retries: int | None = None) -> SendResult:
+        self.sent.append((to_number, text))
+        self.max_retries.append(max_retries)
+        return self.results.pop(0)
+
+
+@pytest.fixture
+def patient(db):
+    patient = crud.get_or_create_patient(db, "5511900000001")
+    crud.create_message(db, patient.id, "oi, tudo bem", False)
+    db.commit()
+    return patient.id
+
+
+def _client(monkeypatch, *results):
+    fake = FakeWhatsApp(*results)
+    monkeypatch.setattr(main.outbox_dispatcher, "client", fake)
+    return TestClient(main.app), fake
+
+
+def _patient(db, patient_id):
+    db.expire_all()
+    return db.get(models.Patient, patient_id)
+
+
+def test_envio_ok(db, monkeypatch, patient):
+    client, fake = _client(monkeypatch, SendResult(ok=True, status_code=200, message_id="wamid.1"))
+    response = client.post(f"/api/messages/send/{patient}", json={"text": "Como está?"}, headers={"Idempotency-Key": "a"})
+    assert response.status_code == 201
+    assert response.json()["delivery_status"] == "sent"
+    assert _patient(db, patient).last_message_preview == "Como está?"
+    # Repetição com a mesma chave: mesma mensagem, sem novo envio
+    again = client.post(f"/api/messages/send/{patient}", json={"text": "Como está?"}, headers={"Idempotency-Key": "a"})
+    assert again.status_code == 201 and again.json()["id"] == response.json()["id"]
+    assert len(fake.sent) == 1
+
+
+def test_falha_definitiva_marca_a_mensagem(db, monkeypatch, patient):
+    client, fake = _client(monkeypatch, SendResult(ok=False, status_code=400, error="número inválido"))
+    response = client.post(f"/api/messages/send/{patient}", json={"text": "Olá"}, headers={"Idempotency-Key": "b"})
+    assert response.status_code == 500
+    message = db.scalars(select(models.Message).where(models.Message.sender == "professional")).one()
+    assert message.delivery_status == "failed"
+    # A lista de pacientes volta a mostrar a última mensagem que de fato existe na conversa
+    assert _patient(db, patient).last_message_preview == "oi, tudo bem"
+    again = client.post(f"/api/messages/send/{patient}", json={"text": "Olá"}, headers={"Idempotency-Key": "b"})
+    assert again.status_code == 500
+    assert len(fake.sent) == 1
+
+
+def test_falha_temporaria_devolve_202(db, monkeypatch, patient):
+    client, fake = _client(monkeypatch, SendResult(ok=False, status_code=503, error="indisponível", retryable=True))
+    response = client.post(f"/api/messages/send/{patient}", json={"text": "Olá"})
+    assert response.status_code == 202
+    # Uma única tentativa na requisição; as retentativas ficam com a outbox
+    assert fake.max_retries == [0]
+    assert response.json()["delivery_status"] == "pending"
+    outbound = db.scalars(select(models.OutboundMessage)).one()
+    assert outbound.status == "pending" and outbound.next_attempt_at is not None
+    # A nova tentativa da outbox conclui o envio
+    crud.record_outbound_result(db, outbound.id, True, "wamid.2")
+    db.commit()
+    assert db.get(models.Message, outbound.message_id).delivery_status == "sent"
+
+
+def test_envio_interrompido_marca_a_mensagem(db, patient):
+    outbound, message = crud.create_professional_message(db, patient, "Olá", "manual:c")
+    db.commit()
+    crud.claim_outbound_message(db, outbound.id)
+    db.commit()
+    assert crud.fail_stale_outbound_messages(db, timedelta(seconds=-1)) == 1
+    db.commit()
+    db.expire_all()
+    assert db.get(models.Message, message.id).delivery_status == "failed"
+
+
+def test_callback_de_falha_marca_a_mensagem(db, patient):
+    outbound, message = crud.create_professional_message(db, patient, "Olá", "manual:d")
+    db.commit()
+    crud.claim_outbound_message(db, outbound.id)
+    crud.record_outbound_result(db, outbound.id, True, "wamid.3")
+    crud.apply_outbound_statuses(db, [{"id": "wamid.3", "status": "failed", "timestamp": "1700000000",
+                                       "errors": [{"title": "Re-engagement message"}]}])
+    db.commit()
+    db.expire_all()
+    assert db.get(models.Message, message.id).delivery_status == "failed"
@@ -0,0 +1,125 @@
+import json
+import asyncio
+from prometheus_client import REGISTRY
+from realtime import ConnectionManager, PANEL_CHANNEL, patient_channel
+
+
+class FakeWebSocket:
+    """
+    Guarda o que foi enviado. Com `stuck`, o envio nunca termina (navegador que parou de ler).
+    """
+    def __init__(self, stuck: bool = False):
+        self.stuck = stuck
+        self.sent = []
+        self.close_code = None
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, payload: str):
+        if self.stuck:
+            await asyncio.Event().wait()
+        self.sent.append(json.loads(payload))
+
+    async def close(self, code: int = 1000):
+        self.close_code = code
+
+
+async def _until(condition, timeout: float = 5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "tempo esgotado"
+        await asyncio.sleep(0.01)
+
+
+def _open_connections(kind: str) -> float:
+    return REGISTRY.get_sample_value("websocket_connections", {"channel_type": kind}) or 0.0
+
+
+def test_consumidor_parado_e_removido_e_os_demais_continuam_recebendo():
+    manager = ConnectionManager(queue_size=2, send_timeout=60)
+    channel = patient_channel(1)
+
+    async def run():
+        await manager.start()
+        stuck_ws, ws = FakeWebSocket(stuck=True), FakeWebSocket()
+        stuck = await manager.connect(stuck_ws, channel)
+        await manager.connect(ws, channel)
+        # O consumidor saudável acompanha as publicações; o parado fica com a fila cheia
+        for n in range(5):
+            manager.publish(channel, {"n": n})
+            await _until(lambda: len(ws.sent) == n + 1)
+        await _until(lambda: stuck_ws.close_code is not None)
+        # Depois da remoção, o consumidor saudável segue recebendo
+        manager.publish(channel, {"n": 5})
+        await _until(lambda: len(ws.sent) == 6)
+        await asyncio.sleep(0)
+        writer_cancelled = stuck.writer.cancelled()
+        await manager.stop()
+        return stuck_ws, ws, writer_cancelled
+
+    stuck_ws, ws, writer_cancelled = asyncio.run(run())
+    assert stuck_ws.close_code == 1013
+    assert writer_cancelled
+    assert [message["n"] for message in ws.sent] == list(range(6))
+    assert manager.evicted_count == 1
+    assert manager.stats()["connections"] == 1
+
+
+def test_desconectar_e_idempotente():
+    manager = ConnectionManager()
+    before = _open_connections("panel")
+
+    async def run():
+        await manager.start()
+        connection = await manager.connect(FakeWebSocket(), PANEL_CHANNEL)
+        evicted = await manager.connect(FakeWebSocket(), PANEL_CHANNEL)
+        assert _open_connections("panel") == before + 2
+        manager.disconnect(connection)
+        manager.disconnect(connection)
+        # Conexão já removida por lentidão: o `finally` do endpoint ainda chama disconnect
+        await manager._evict(evicted, "teste")
+        manager.disconnect(evicted)
+        await manager.stop()
+
+    asyncio.run(run())
+    assert _open_connections("panel") == before
+    assert manager.channels == {}
+    assert manager.evicted_count == 1
+
+
+def test_painel_recebe_publicacoes_do_loop_e_de_endpoints_sincronos():
+    manager = ConnectionManager()
+
+    async def run():
+        await manager.start()
+        panel, viewer = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(panel, PANEL_CHANNEL)
+        await manager.connect(viewer, patient_channel(1))
+        manager.publish_patient_update({"id": 1, "status": "manual"})
+        # Endpoint síncrono: roda no threadpool, sem loop de eventos, e usa call_soon_threadsafe
+        await asyncio.to_thread(manager.publish_patient_update, {"id": 2, "status": "automatico"})
+        await _until(lambda: len(panel.sent) == 2)
+        await asyncio.sleep(0.05)
+        await manager.stop()
+        return panel, viewer
+
+    panel, viewer = asyncio.run(run())
+    assert panel.sent == [{"type": "patient_update", "patient": {"id": 1, "status": "manual"}},
+                          {"type": "patient_update", "patient": {"id": 2, "status": "automatico"}}]
+    # Mensagens do painel não vão para quem acompanha um paciente
+    assert viewer.sent == []
+
+
+def test_heartbeat_envia_ping_em_conexao_ociosa():
+    manager = ConnectionManager(heartbeat_interval=0.02)
+
+    async def run():
+        await manager.start()
+        ws = FakeWebSocket()
+        await manager.connect(ws, PANEL_CHANNEL, heartbeat=True)
+        await _until(lambda: len(ws.sent) >= 2)
+        await manager.stop()
+        return ws
+
+    assert asyncio.run(run()).sent[:2] == [{"type": "ping"}, {"type": "ping"}]
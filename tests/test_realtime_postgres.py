@@ -0,0 +1,89 @@
+"""
+Integração do PostgresBroker entre processos: um processo escuta, outro publica. Requer um
+Postgres local em TEST_POSTGRES_URL (ex.: postgresql://postgres@localhost/cuideme_test);
+sem ele os testes são pulados.
+"""
+import os
+import sys
+import json
+import subprocess
+import pytest
+
+POSTGRES_URL = os.getenv("TEST_POSTGRES_URL")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Processo filho: "listen N" imprime as N mensagens recebidas; "publish" publica as mensagens
+# lidas da entrada padrão (uma por linha: [canal, payload]) e termina
+CHILD = """
+import sys, json, asyncio
+from realtime import create_broker
+
+async def main(role, count=0):
+    received = []
+    done = asyncio.Event()
+    def deliver(channel, payload):
+        received.append([channel, payload])
+        if len(received) >= count:
+            done.set()
+    broker = create_broker("postgres")
+    await broker.start(deliver)
+    print("pronto", flush=True)
+    if role == "listen":
+        try:
+            await asyncio.wait_for(done.wait(), 20)
+        finally:
+            print(json.dumps(received), flush=True)
+    else:
+        for line in sys.stdin:
+            broker.publish(*json.loads(line))
+        # Dá tempo para receber (e descartar) as próprias mensagens
+        await asyncio.sleep(0.5)
+        print(json.dumps(received), flush=True)
+    await broker.stop()
+
+asyncio.run(main(sys.argv[1], *map(int, sys.argv[2:])))
+"""
+
+
+def _postgres_available() -> bool:
+    if not POSTGRES_URL:
+        return False
+    try:
+        import psycopg2
+        psycopg2.connect(POSTGRES_URL).close()
+        return True
+    except Exception:
+        return False
+
+
+pytestmark = pytest.mark.skipif(not _postgres_available(), reason="Postgres local indisponível (defina TEST_POSTGRES_URL)")
+
+
+@pytest.fixture(scope="module", autouse=True)
+def schema():
+    # Como na inicialização da aplicação: a tabela de mensagens grandes vem dos modelos
+    subprocess.run([sys.executable, "-c", "from database import models; from database.database import upgrade_schema; upgrade_schema()"],
+                   cwd=ROOT, env={**os.environ, "DATABASE_URL": POSTGRES_URL}, check=True)
+
+
+def _spawn(*args):
+    env = {**os.environ, "DATABASE_URL": POSTGRES_URL, "REALTIME_BACKEND": "postgres", "LOG_LEVEL": "WARNING"}
+    return subprocess.Popen([sys.executable, "-c", CHILD, *args], cwd=ROOT, env=env, text=True,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+
+def test_mensagens_chegam_ao_outro_processo_em_ordem():
+    large = json.dumps({"type": "new_message", "text": "á" * 20000})
+    messages = [["panel", '{"n": 1}'], ["patient:7", large], ["panel", '{"n": 3}']]
+    listener = _spawn("listen", str(len(messages)))
+    try:
+        assert listener.stdout.readline().strip() == "pronto"
+        publisher = _spawn("publish")
+        assert publisher.stdout.readline().strip() == "pronto"
+        out, _ = publisher.communicate("".join(json.dumps(m) + "\n" for m in messages), timeout=30)
+        # O processo que publica não recebe de volta as próprias mensagens
+        assert json.loads(out) == []
+        out, _ = listener.communicate(timeout=30)
+    finally:
+        listener.kill()
+    assert json.loads(out) == messages
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from database import crud, models
+from scheduler import next_occurrence, create_default_schedules, _process_due
+import main
+
+UTC = timezone.utc
+
+
+def test_proxima_ocorrencia_e_estritamente_posterior():
+    # 09:00 em São Paulo = 12:00 UTC
+    assert next_occurrence("09:00", "America/Sao_Paulo", "daily", datetime(2026, 10, 14, 11, 0, tzinfo=UTC)) == datetime(2026, 10, 14, 12, 0, tzinfo=UTC)
+    assert next_occurrence("09:00", "America/Sao_Paulo", "daily", datetime(2026, 10, 14, 12, 0, tzinfo=UTC)) == datetime(2026, 10, 15, 12, 0, tzinfo=UTC)
+
+def test_recorrencia_por_dias_da_semana():
+    friday_evening = datetime(2026, 10, 16, 22, 0, tzinfo=UTC)
+    assert next_occurrence("09:00", "America/Sao_Paulo", "weekdays", friday_evening) == datetime(2026, 10, 19, 12, 0, tzinfo=UTC)
+    assert next_occurrence("09:00", "America/Sao_Paulo", "wed,sat", friday_evening) == datetime(2026, 10, 17, 12, 0, tzinfo=UTC)
+
+@pytest.mark.parametrize("send_time, zone, recurrence", [("25:00", "UTC", "daily"), ("09:00", "Marte/Olympus", "daily"),
+                                                          ("09:00", "UTC", "mon,feriado"), ("09:00", "UTC", "")])
+def test_agenda_invalida(send_time, zone, recurrence):
+    with pytest.raises(ValueError):
+        next_occurrence(send_time, zone, recurrence, datetime.now(UTC))
+
+def test_horario_local_se_mantem_na_troca_de_horario_de_verao():
+    # Nova York adianta o relógio em 08/03/2026 e atrasa em 01/11/2026
+    zone = "America/New_York"
+    assert next_occurrence("09:00", zone, "daily", datetime(2026, 3, 7, 15, 0, tzinfo=UTC)) == datetime(2026, 3, 8, 13, 0, tzinfo=UTC)
+    assert next_occurrence("09:00", zone, "daily", datetime(2026, 3, 7, 13, 0, tzinfo=UTC)) == datetime(2026, 3, 7, 14, 0, tzinfo=UTC)
+    assert next_occurrence("09:00", zone, "daily", datetime(2026, 10, 31, 14, 0, tzinfo=UTC)) == datetime(2026, 11, 1, 14, 0, tzinfo=UTC)
+
+
+@pytest.fixture
+def schedule(db):
+    patient = crud.get_or_create_patient(db, "5511900000001")
+    schedule = crud.create_schedule(db, patient.id, send_time="09:00", timezone="America/Sao_Paulo", recurrence="daily",
+                                    next_run_at=datetime(2026, 10, 14, 12, 0, tzinfo=UTC))
+    db.commit()
+    return schedule.id
+
+def _schedule(db, schedule_id):
+    db.expire_all()
+    return db.get(models.ReminderSchedule, schedule_id)
+
+
+def test_ocorrencia_atrasada_demais_e_pulada(db, schedule):
+    now = datetime(2026, 10, 14, 20, 0, tzinfo=UTC)
+    assert _process_due(db, [schedule], now, timedelta(hours=6)) == ([], 0, 1)
+    db.commit()
+    stored = _schedule(db, schedule)
+    assert crud._as_utc(stored.next_run_at) == datetime(2026, 10, 15, 12, 0, tzinfo=UTC)
+    assert stored.last_occurrence is None
+    assert db.query(models.OutboundMessage).count() == 0
+
+
+def test_paciente_em_atendimento_manual_e_pulado(db, schedule):
+    db.query(models.Patient).update({"status": "manual"})
+    db.commit()
+    assert _process_due(db, [schedule], datetime(2026, 10, 14, 12, 5, tzinfo=UTC), timedelta(hours=6)) == ([], 1, 0)
+
+
+def test_repetir_a_mesma_ocorrencia_nao_envia_de_novo(db, schedule):
+    now = datetime(2026, 10, 14, 12, 5, tzinfo=UTC)
+    pending, _, _ = _process_due(db, [schedule], now, timedelta(hours=6))
+    db.commit()
+    assert len(pending) == 1
+    outbound = db.get(models.OutboundMessage, pending[0])
+    assert outbound.idempotency_key == f"schedule:{schedule}:2026-10-14"
+    crud.claim_outbound_message(db, outbound.id)
+    crud.record_outbound_result(db, outbound.id, True, "wamid.1")
+    # Ex.: o processo caiu antes do commit que avançou next_run_at e a ocorrência é lida de novo
+    _schedule(db, schedule).next_run_at = datetime(2026, 10, 14, 12, 0, tzinfo=UTC)
+    db.commit()
+    assert _process_due(db, [schedule], now + timedelta(minutes=1), timedelta(hours=6)) == ([], 0, 0)
+    db.commit()
+    assert db.query(models.OutboundMessage).count() == 1
+    assert _schedule(db, schedule).last_occurrence == "2026-10-14"
+
+
+def test_agenda_padrao_so_para_os_pacientes_informados(db):
+    first = crud.get_or_create_patient(db, "5511900000001")
+    second = crud.get_or_create_patient(db, "5511900000002")
+    assert create_default_schedules(db, [first.id]) == 1
+    assert create_default_schedules(db, [first.id]) == 0
+    assert [s.patient_id for s in db.query(models.ReminderSchedule)] == [first.id]
+    assert create_default_schedules(db) == 1
+    assert sorted(s.patient_id for s in db.query(models.ReminderSchedule)) == [first.id, second.id]
+
+
+def test_primeira_mensagem_cria_a_agenda_padrao(db):
+    alert = main.alert_detector.detect("bom dia")
+    assert main.store_incoming_message(db, "5511900000001", "bom dia", "wamid.1", alert)[2] == 1
+    assert main.store_incoming_message(db, "5511900000001", "tudo bem", "wamid.2", alert)[2] == 0
+    assert db.query(models.ReminderSchedule).count() == 1
@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from sqlalchemy import update
+from database import crud, models
+
+
+@pytest.fixture
+def messages(db):
+    ana = crud.get_or_create_patient(db, "5511900000001")
+    bruno = crud.get_or_create_patient(db, "5511900000002")
+    rows = [(ana, "estou com febre desde ontem", True, "patient", 3),
+            (ana, "a febre baixou", False, "patient", 1),
+            (ana, "meça a febre de novo amanhã", False, "professional", 1),
+            (bruno, "febre alta e dor de cabeça", True, "patient", 2),
+            (bruno, "tomei o remédio", False, "patient", 0)]
+    now = datetime.now(timezone.utc)
+    ids = []
+    for patient, text, has_alert, sender, days_ago in rows:
+        message = crud.create_message(db, patient.id, text, has_alert, sender=sender, alert_score=2.0 if has_alert else 0.0)
+        db.execute(update(models.Message).where(models.Message.id == message.id).values(timestamp=now - timedelta(days=days_ago)))
+        ids.append(message.id)
+    db.commit()
+    return ana.id, bruno.id, ids
+
+
+def _ids(results):
+    return [message.id for message, _, _ in results]
+
+
+def test_cursor_percorre_todos_os_resultados_sem_repetir(db, messages):
+    everything, cursor = crud.search_messages(db, "febre", limit=10)
+    assert cursor is None and len(everything) == 4
+
+    paged, cursor = [], None
+    while True:
+        page, cursor = crud.search_messages(db, "febre", limit=1, cursor=cursor)
+        paged += _ids(page)
+        if cursor is None:
+            break
+    assert paged == _ids(everything)
+
+
+def test_filtros(db, messages):
+    ana, bruno, ids = messages
+    assert sorted(_ids(crud.search_messages(db, "febre", patient_id=ana)[0])) == ids[:3]
+    assert _ids(crud.search_messages(db, "febre", sender="professional")[0]) == [ids[2]]
+    assert sorted(_ids(crud.search_messages(db, "febre", has_alert=True)[0])) == [ids[0], ids[3]]
+    since = datetime.now(timezone.utc) - timedelta(days=1, hours=12)
+    assert sorted(_ids(crud.search_messages(db, "febre", since=since)[0])) == ids[1:3]
+    # Datas sem fuso são UTC
+    until = (datetime.now(timezone.utc) - timedelta(days=2, hours=12)).replace(tzinfo=None)
+    assert _ids(crud.search_messages(db, "febre", until=until)[0]) == [ids[0]]
+    assert _ids(crud.search_messages(db, "febre", patient_id=bruno, has_alert=False)[0]) == []
+
+
+def test_alerta_ja_lido_continua_no_filtro(db, messages):
+    ana, _, ids = messages
+    crud.clear_patient_alerts(db, ana)
+    db.commit()
+    assert db.get(models.Message, ids[0]).has_alert is False
+    assert sorted(_ids(crud.search_messages(db, "febre", has_alert=True)[0])) == [ids[0], ids[3]]
+    assert sorted(_ids(crud.search_messages(db, "febre", has_alert=False)[0])) == ids[1:3]
+
+
+def test_acentos_e_consultas_sem_palavras(db, messages):
+    _, _, ids = messages
+    assert _ids(crud.search_messages(db, "cabeca")[0]) == [ids[3]]
+    assert _ids(crud.search_messages(db, "REMÉDIO")[0]) == [ids[4]]
+    assert crud.search_messages(db, "***") == ([], None)
+
+
+def test_cursor_invalido(db, messages):
+    with pytest.raises(ValueError):
+        crud.search_messages(db, "febre", cursor="inválido")
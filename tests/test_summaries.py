@@ -0,0 +1,78 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from database import crud
+from database.database import with_session
+from summaries import ConversationSummarizer
+
+
+class FakeGateway:
+    def __init__(self):
+        self.prompts = []
+
+    async def generate(self, prompt: str, kind: str) -> str:
+        self.prompts.append(prompt)
+        return f"resumo {len(self.prompts)}"
+
+
+def test_incluir_arquivo_refaz_resumo_que_so_cobria_mensagens_em_uso(db):
+    patient = crud.get_or_create_patient(db, "5511900000001")
+    for text in ("mensagem antiga 1", "mensagem antiga 2", "mensagem recente"):
+        crud.create_message(db, patient.id, text, False)
+    crud.archive_messages(db, datetime.now(timezone.utc) + timedelta(minutes=1), limit=2)
+    db.commit()
+    gateway = FakeGateway()
+    summarizer = ConversationSummarizer(gateway=gateway)
+
+    async def run():
+        hot = await summarizer.summarize(patient.id)
+        full = await summarizer.summarize(patient.id, include_archive=True)
+        again = await summarizer.summarize(patient.id, include_archive=True)
+        await asyncio.to_thread(with_session, crud.create_message, patient.id, "mensagem nova", False)
+        updated = await summarizer.summarize(patient.id)
+        return hot, full, again, updated
+
+    hot, full, again, updated = asyncio.run(run())
+    assert (hot["summary"], hot["includes_archive"]) == ("resumo 1", False)
+    assert "antiga" not in gateway.prompts[0]
+
+    assert (full["summary"], full["cached"], full["includes_archive"]) == ("resumo 2", False, True)
+    assert all(text in gateway.prompts[1] for text in ("antiga 1", "antiga 2", "recente"))
+    assert "RESUMO ANTERIOR" not in gateway.prompts[1]
+
+    assert again["cached"] and again["summary"] == "resumo 2"
+
+    assert (updated["summary"], updated["includes_archive"]) == ("resumo 3", True)
+    assert "resumo 2" in gateway.prompts[2] and "mensagem nova" in gateway.prompts[2]
+    assert "antiga" not in gateway.prompts[2]
+
+    db.expire_all()
+    stored = crud.get_conversation_summary(db, patient.id)
+    assert (stored.includes_archive, stored.message_count) == (True, 4)
+
+
+
+def test_mensagens_do_profissional_nao_enviadas_ficam_fora_do_resumo(db):
+    patient = crud.get_or_create_patient(db, "5511900000001")
+    crud.create_message(db, patient.id, "estou com tontura", False)
+    failed, _ = crud.create_professional_message(db, patient.id, "mensagem que falhou", "falha")
+    pending, _ = crud.create_professional_message(db, patient.id, "mensagem na fila", "fila")
+    db.commit()
+    crud.claim_outbound_message(db, failed.id)
+    crud.record_outbound_result(db, failed.id, False, error="número inválido")
+    db.commit()
+    gateway = FakeGateway()
+    summarizer = ConversationSummarizer(gateway=gateway)
+
+    async def run():
+        first = await summarizer.summarize(patient.id)
+        await asyncio.to_thread(with_session, crud.claim_outbound_message, pending.id)
+        await asyncio.to_thread(with_session, crud.record_outbound_result, pending.id, True, "wamid.1")
+        second = await summarizer.summarize(patient.id)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert "tontura" in gateway.prompts[0]
+    assert "falhou" not in gateway.prompts[0] and "na fila" not in gateway.prompts[0]
+    # A mensagem que estava na fila entra quando é enviada
+    assert not second["cached"] and "na fila" in gateway.prompts[1]
+    assert all("falhou" not in prompt for prompt in gateway.prompts)
@@ -0,0 +1,136 @@
+import json
+import asyncio
+from datetime import datetime, timezone
+from database import crud, models
+from database.database import with_session
+from webhook_queue import WebhookQueue
+
+
+def _enqueue(*payloads):
+    return [with_session(crud.enqueue_webhook_event, json.dumps(payload)) for payload in payloads]
+
+def _statuses(db):
+    db.expire_all()
+    return {event.id: (event.status, event.attempts) for event in db.query(models.WebhookEvent)}
+
+async def _until(condition, timeout: float = 5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "tempo esgotado"
+        await asyncio.sleep(0.01)
+
+
+def test_reserva_respeita_limite_e_prazo_de_visibilidade(db):
+    ids = _enqueue({"n": 1}, {"n": 2}, {"n": 3})
+    claimed = with_session(crud.claim_webhook_events, 2, 300)
+    assert [event[0] for event in claimed] == ids[:2]
+    assert [event[2] for event in claimed] == [1, 1]
+    assert [event[0] for event in with_session(crud.claim_webhook_events, 10, 300)] == ids[2:]
+    assert with_session(crud.claim_webhook_events, 10, 300) == []
+    # Presos em "processing" além do prazo (queda do processo) voltam à fila
+    reclaimed = with_session(crud.claim_webhook_events, 10, 0)
+    assert [(event[0], event[2]) for event in reclaimed] == [(event_id, 2) for event_id in ids]
+
+
+def test_falha_com_nova_tentativa_e_descarte(db):
+    retry, dead = _enqueue({"n": 1}, {"n": 2})
+    with_session(crud.claim_webhook_events, 10, 300)
+    with_session(crud.fail_webhook_event, retry, "erro temporário", 60)
+    with_session(crud.fail_webhook_event, dead, "erro definitivo", None)
+    assert _statuses(db) == {retry: ("pending", 1), dead: ("failed", 1)}
+    # A nova tentativa só fica disponível depois do intervalo
+    assert with_session(crud.claim_webhook_events, 10, 300) == []
+
+
+def _run(queue: WebhookQueue, scenario):
+    async def run():
+        await queue.start()
+        try:
+            return await scenario()
+        finally:
+            await queue.stop()
+    return asyncio.run(run())
+
+
+def test_worker_processa_reenvia_e_descarta(db):
+    ok, invalid, flaky, exhausted = _enqueue({"kind": "ok"}, {"kind": "invalid"}, {"kind": "flaky"}, {"kind": "exhausted"})
+    # O último já está na tentativa máxima: a próxima falha o descarta
+    db.query(models.WebhookEvent).filter(models.WebhookEvent.id == exhausted).update({"attempts": 2})
+    db.commit()
+
+    async def handler(payload):
+        if payload["kind"] == "invalid":
+            raise ValueError("payload inválido")
+        if payload["kind"] in ("flaky", "exhausted"):
+            raise RuntimeError("Graph indisponível")
+
+    queue = WebhookQueue(handler, workers=2, poll_interval=0.05, max_attempts=3)
+
+    async def scenario():
+        await _until(lambda: queue.processed_count + queue.failed_count == 3)
+        await asyncio.sleep(0.1)
+
+    _run(queue, scenario)
+    statuses = _statuses(db)
+    assert statuses[ok] == ("done", 1)
+    assert statuses[invalid] == ("failed", 1)
+    assert statuses[flaky] == ("pending", 1)
+    assert statuses[exhausted] == ("failed", 3)
+    event = db.get(models.WebhookEvent, flaky)
+    assert "Graph" in event.last_error
+    available_at = event.available_at.replace(tzinfo=timezone.utc) if event.available_at.tzinfo is None else event.available_at
+    assert available_at > datetime.now(timezone.utc)
+
+
+def test_worker_sobrevive_a_erro_do_banco(db, monkeypatch):
+    first, second = _enqueue({"n": 1}, {"n": 2})
+    complete = crud.complete_webhook_event
+    calls = []
+
+    def flaky_complete(db, event_id):
+        calls.append(event_id)
+        if len(calls) == 1:
+            raise RuntimeError("conexão perdida")
+        complete(db, event_id)
+
+    monkeypatch.setattr(crud, "complete_webhook_event", flaky_complete)
+    processed = []
+
+    async def handler(payload):
+        processed.append(payload["n"])
+
+    queue = WebhookQueue(handler, workers=1, poll_interval=0.05, error_backoff=0)
+
+    async def scenario():
+        await _until(lambda: len(calls) == 2)
+        await asyncio.sleep(0.05)
+        return [task.done() for task in queue._tasks]
+
+    assert _run(queue, scenario) == [False, False]
+    assert processed == [1, 2]
+    # O evento cujo resultado não foi gravado continua reservado e volta após o prazo de visibilidade
+    assert _statuses(db) == {first: ("processing", 1), second: ("done", 1)}
+
+
+def test_reserva_so_para_workers_livres(db):
+    ids = _enqueue({"n": 1}, {"n": 2}, {"n": 3})
+    release = asyncio.Event()
+    started = []
+
+    async def handler(payload):
+        started.append(payload["n"])
+        await release.wait()
+
+    queue = WebhookQueue(handler, workers=1, batch_size=10, poll_interval=0.05)
+
+    async def scenario():
+        await _until(lambda: started == [1])
+        await asyncio.sleep(0.2)
+        in_progress = _statuses(db)
+        release.set()
+        await _until(lambda: queue.processed_count == 3)
+        return in_progress
+
+    in_progress = _run(queue, scenario)
+    assert in_progress == {ids[0]: ("processing", 1), ids[1]: ("pending", 0), ids[2]: ("pending", 0)}
+    assert started == [1, 2, 3]
@@ -0,0 +1,41 @@
+import asyncio
+import httpx
+import whatsapp
+from whatsapp import WhatsAppClient
+
+
+def _client(handler, **kwargs) -> WhatsAppClient:
+    client = WhatsAppClient(token="token", phone_number_id="123", **kwargs)
+    client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return client
+
+
+def test_retry_after_e_limitado(monkeypatch):
+    delays = []
+
+    async def fake_sleep(seconds):
+        delays.append(seconds)
+
+    monkeypatch.setattr(whatsapp.asyncio, "sleep", fake_sleep)
+    responses = iter([httpx.Response(429, headers={"Retry-After": "3600"}, text="limite"),
+                      httpx.Response(429, headers={"Retry-After": "2"}, text="limite"),
+                      httpx.Response(200, json={"messages": [{"id": "wamid.1"}]})])
+    client = _client(lambda request: next(responses), max_retries=2)
+
+    result = asyncio.run(client.send_text("5511900000001", "oi"))
+    assert result.ok and result.message_id == "wamid.1"
+    assert delays == [whatsapp.WHATSAPP_MAX_BACKOFF_SECONDS, 2.0]
+
+
+def test_sem_novas_tentativas_devolve_a_falha_sem_esperar(monkeypatch):
+    delays = []
+
+    async def fake_sleep(seconds):
+        delays.append(seconds)
+
+    monkeypatch.setattr(whatsapp.asyncio, "sleep", fake_sleep)
+    client = _client(lambda request: httpx.Response(503, text="indisponível"), max_retries=0)
+
+    result = asyncio.run(client.send_text("5511900000001", "oi"))
+    assert (result.ok, result.status_code, result.retryable) == (False, 503, True)
+    assert delays == []
@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Awaitable, Callable
+from database.database import with_session, run_in_transaction
+from database import crud
+from instrumentation import request_id_var, webhook_received_at, WEBHOOK_EVENTS, WEBHOOK_PROCESSING_SECONDS
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_CLAIM_BATCH = int(os.getenv("WEBHOOK_CLAIM_BATCH", "50"))
+# Intervalo de varredura da tabela quando ninguém avisa sobre eventos novos (ex.: outra instância gravou)
+WEBHOOK_POLL_INTERVAL = float(os.getenv("WEBHOOK_POLL_INTERVAL", "2"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "5"))
+WEBHOOK_VISIBILITY_TIMEOUT = float(os.getenv("WEBHOOK_VISIBILITY_TIMEOUT", "300"))
+# Pausa do worker depois de um erro do banco ao registrar o resultado de um evento
+WEBHOOK_ERROR_BACKOFF = float(os.getenv("WEBHOOK_ERROR_BACKOFF", "1"))
+# Por quanto tempo os eventos processados ficam na tabela antes de serem apagados
+WEBHOOK_RETENTION = timedelta(hours=float(os.getenv("WEBHOOK_RETENTION_HOURS", "72")))
+PURGE_INTERVAL_SECONDS = 3600
+
+
+class WebhookQueue:
+    """
+    Fila de webhooks apoiada na tabela webhook_events. Um laço reserva eventos em lotes, só
+    quantos houver workers livres (um evento reservado não espera na memória enquanto o prazo de
+    visibilidade corre), e os distribui para um pool de workers assíncronos que executam o `handler`.
+    """
+    def __init__(self, handler: Callable[[dict], Awaitable[None]], workers: int = WEBHOOK_WORKERS,
+                 batch_size: int = WEBHOOK_CLAIM_BATCH, poll_interval: float = WEBHOOK_POLL_INTERVAL,
+                 max_attempts: int = WEBHOOK_MAX_ATTEMPTS, visibility_timeout: float = WEBHOOK_VISIBILITY_TIMEOUT,
+                 error_backoff: float = WEBHOOK_ERROR_BACKOFF):
+        self.handler = handler
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.visibility_timeout = visibility_timeout
+        self.error_backoff = error_backoff
+        self._wakeup = asyncio.Event()
+        self._worker_free = asyncio.Event()
+        self._busy = 0
+        self._queue: asyncio.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+        self.processed_count = 0
+        self.failed_count = 0
+        self._processing_seconds = 0.0
+
+    async def enqueue(self, payload: str) -> int:
+        """
+        Grava o payload bruto e devolve o id do evento.
+        """
+        return await run_in_transaction(crud.enqueue_webhook_event, payload)
+
+    def notify(self):
+        self._wakeup.set()
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._claim_loop())]
+        self._tasks += [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _claim_loop(self):
+        last_purge = 0.0
+        while True:
+            if time.monotonic() - last_purge > PURGE_INTERVAL_SECONDS:
+                last_purge = time.monotonic()
+                try:
+                    await run_in_transaction(crud.purge_webhook_events, WEBHOOK_RETENTION)
+                except Exception as e:
+                    logger.error("Erro ao limpar eventos antigos da fila de webhooks: %s", e)
+            free = self.workers - self._busy - self._queue.qsize()
+            if free <= 0:
+                self._worker_free.clear()
+                await self._worker_free.wait()
+                continue
+            limit = min(self.batch_size, free)
+            try:
+                events = await run_in_transaction(crud.claim_webhook_events, limit, self.visibility_timeout)
+            except Exception as e:
+                logger.error("Erro ao reservar eventos da fila de webhooks: %s", e)
+                events = []
+            for event in events:
+                self._queue.put_nowait(event)
+            if len(events) < limit:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _worker(self):
+        while True:
+            event_id, payload, attempts, received_at = await self._queue.get()
+            self._busy += 1
+            if received_at is not None and received_at.tzinfo is None:
+                received_at = received_at.replace(tzinfo=timezone.utc)
+            # Os logs e métricas do processamento ficam associados ao evento
+            request_token = request_id_var.set(f"webhook-{event_id}")
+            received_token = webhook_received_at.set(received_at.timestamp() if received_at is not None else None)
+            started = time.perf_counter()
+            try:
+                await self.handler(json.loads(payload))
+            except Exception as e:
+                # Payload inválido não melhora com novas tentativas
+                retry_in = None if isinstance(e, ValueError) or attempts >= self.max_attempts else min(300.0, 2.0 ** attempts)
+                if retry_in is None:
+                    self.failed_count += 1
+                WEBHOOK_EVENTS.labels("failed" if retry_in is None else "retried").inc()
+                logger.exception("Erro ao processar o webhook %s (tentativa %s).", event_id, attempts)
+                await self._record(event_id, crud.fail_webhook_event, event_id, str(e), retry_in)
+            else:
+                self.processed_count += 1
+                WEBHOOK_EVENTS.labels("processed").inc()
+                await self._record(event_id, crud.complete_webhook_event, event_id)
+            finally:
+                elapsed = time.perf_counter() - started
+                self._processing_seconds += elapsed
+                WEBHOOK_PROCESSING_SECONDS.observe(elapsed)
+                webhook_received_at.reset(received_token)
+                request_id_var.reset(request_token)
+                self._busy -= 1
+                self._worker_free.set()
+                self._queue.task_done()
+
+    async def _record(self, event_id: int, fn, *args):
+        """
+        Grava o resultado do evento. Um erro do banco aqui não pode derrubar o worker: o evento
+        fica em "processing" e volta à fila depois do prazo de visibilidade (o handler é idempotente).
+        """
+        try:
+            await run_in_transaction(fn, *args)
+        except Exception:
+            logger.exception("Erro ao registrar o resultado do webhook %s; ele será reprocessado.", event_id)
+            await asyncio.sleep(self.error_backoff)
+
+    def stats(self):
+        counts, oldest = with_session(crud.get_webhook_queue_stats)
+        lag = None
+        if oldest is not None:
+            if oldest.tzinfo is None:
+                oldest = oldest.replace(tzinfo=timezone.utc)
+            lag = max(0.0, (datetime.now(timezone.utc) - oldest).total_seconds())
+        finished = self.processed_count + self.failed_count
+        return {
+            "depth": counts.get("pending", 0),
+            "in_progress": counts.get("processing", 0),
+            "failed_total": counts.get("failed", 0),
+            "lag_seconds": lag,
+            "workers": self.workers,
+            "processed": self.processed_count,
+            "failed": self.failed_count,
+            "avg_processing_seconds": self._processing_seconds / finished if finished else None,
+        }
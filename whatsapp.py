@@ -0,0 +1,134 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from dataclasses import dataclass
+import httpx
+from instrumentation import observe_whatsapp_call, WHATSAPP_SENDS
+
+logger = logging.getLogger(__name__)
+
+# Carrega as variáveis de ambiente necessárias para a API do WhatsApp
+WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
+PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
+GRAPH_API_VERSION = os.getenv("GRAPH_API_VERSION", "v20.0")
+# Permite apontar para um servidor local (ex.: stub de testes de carga)
+WHATSAPP_API_BASE_URL = os.getenv("WHATSAPP_API_BASE_URL", "https://graph.facebook.com")
+
+# A Cloud API aceita por padrão ~80 mensagens/segundo por número de telefone.
+WHATSAPP_RATE_PER_SECOND = float(os.getenv("WHATSAPP_RATE_PER_SECOND", "80"))
+WHATSAPP_BURST = int(os.getenv("WHATSAPP_BURST", "80"))
+WHATSAPP_MAX_CONCURRENCY = int(os.getenv("WHATSAPP_MAX_CONCURRENCY", "32"))
+WHATSAPP_MAX_RETRIES = int(os.getenv("WHATSAPP_MAX_RETRIES", "4"))
+WHATSAPP_TIMEOUT_SECONDS = float(os.getenv("WHATSAPP_TIMEOUT_SECONDS", "15"))
+# Espera máxima entre tentativas, inclusive a pedida pelo Retry-After: a espera ocupa uma vaga
+# de concorrência, e esperas maiores ficam para o laço de retentativas da outbox
+WHATSAPP_MAX_BACKOFF_SECONDS = 30.0
+
+
+class TokenBucket:
+    """
+    Limitador de taxa do tipo token bucket: libera até `capacity` envios de uma vez
+    e repõe `rate` tokens por segundo.
+    """
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+@dataclass
+class SendResult:
+    ok: bool
+    status_code: int | None = None
+    message_id: str | None = None
+    error: str | None = None
+    retryable: bool = False
+
+
+class WhatsAppClient:
+    """
+    Cliente assíncrono da Graph API com um único pool de conexões, concorrência limitada,
+    limite de taxa por número e novas tentativas com backoff em 429/5xx.
+    """
+    def __init__(self, token: str | None = WHATSAPP_TOKEN, phone_number_id: str | None = PHONE_NUMBER_ID,
+                 base_url: str = WHATSAPP_API_BASE_URL, rate_per_second: float = WHATSAPP_RATE_PER_SECOND,
+                 burst: int = WHATSAPP_BURST, max_concurrency: int = WHATSAPP_MAX_CONCURRENCY,
+                 max_retries: int = WHATSAPP_MAX_RETRIES, timeout: float = WHATSAPP_TIMEOUT_SECONDS):
+        self.url = f"{base_url}/{GRAPH_API_VERSION}/{phone_number_id}/messages"
+        self.headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self._bucket = TokenBucket(rate_per_second, burst)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client: httpx.AsyncClient | None = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+            self._client = httpx.AsyncClient(limits=limits, timeout=self.timeout)
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _backoff(self, attempt: int, response: httpx.Response | None) -> float:
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(WHATSAPP_MAX_BACKOFF_SECONDS, float(retry_after))
+        return min(WHATSAPP_MAX_BACKOFF_SECONDS, 0.5 * 2 ** attempt) * (0.5 + random.random())
+
+    async def send_text(self, to_number: str, text: str, max_retries: int | None = None) -> SendResult:
+        """
+        Envia um texto. `max_retries` substitui o padrão do cliente (0: uma única tentativa).
+        """
+        max_retries = self.max_retries if max_retries is None else max_retries
+        payload = {"messaging_product": "whatsapp", "to": to_number, "type": "text", "text": {"body": text}}
+        result = SendResult(ok=False)
+        async with self._semaphore:
+            for attempt in range(max_retries + 1):
+                await self._bucket.acquire()
+                response = None
+                started = time.perf_counter()
+                try:
+                    response = await self._get_client().post(self.url, json=payload, headers=self.headers)
+                except httpx.TransportError as e:
+                    observe_whatsapp_call(started, None)
+                    result = SendResult(ok=False, error=f"{type(e).__name__}: {e}", retryable=True)
+                else:
+                    observe_whatsapp_call(started, response.status_code)
+                    if response.is_success:
+                        WHATSAPP_SENDS.labels("sent").inc()
+                        messages = response.json().get("messages") or [{}]
+                        return SendResult(ok=True, status_code=response.status_code, message_id=messages[0].get("id"))
+                    retryable = response.status_code == 429 or response.status_code >= 500
+                    result = SendResult(ok=False, status_code=response.status_code, error=response.text, retryable=retryable)
+                    if not retryable:
+                        break
+                if attempt < max_retries:
+                    await asyncio.sleep(self._backoff(attempt, response))
+        WHATSAPP_SENDS.labels("failed").inc()
+        logger.warning("Erro ao enviar mensagem para %s: %s %s", to_number, result.status_code, result.error,
+                       extra={"status_code": result.status_code, "retryable": result.retryable})
+        return result
+
+
+# Instância compartilhada pela aplicação (o pool é criado sob demanda no loop atual)
+whatsapp_client = WhatsAppClient()